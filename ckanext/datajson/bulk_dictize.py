@@ -0,0 +1,137 @@
+from collections import defaultdict
+
+from sqlalchemy import select
+
+import ckan.lib.dictization as d
+import ckan.lib.dictization.model_dictize as model_dictize
+
+# packages dictized together, bounds the size of the IN (...) lists
+BATCH_SIZE = 1000
+
+
+def package_list_dictize(packages, context):
+    """
+    Bulk counterpart of model_dictize.package_dictize (latest revision only).
+    Resources, tags, extras, groups, organizations and relationships are loaded
+    with one query per table for a whole batch of packages, instead of one
+    query per table and package.
+    :param packages: list of model.Package
+    :param context: dict with 'model'
+    :return: list of dicts, in the order of packages
+    """
+    result = []
+    for start in range(0, len(packages), BATCH_SIZE):
+        result.extend(_package_batch_dictize(packages[start:start + BATCH_SIZE], context))
+    return result
+
+
+def _package_batch_dictize(packages, context):
+    model = context['model']
+    execute = model.Session.execute
+    ids = [pkg.id for pkg in packages]
+
+    res = model.resource_table
+    resources = _rows_by(execute(select([res]).where(res.c.package_id.in_(ids))), 'package_id')
+
+    extra = model.package_extra_table
+    extras = _rows_by(execute(select([extra]).where(extra.c.package_id.in_(ids))), 'package_id')
+
+    # tags and groups are shared by many packages, each one is dictized once
+    pkg_tag = model.package_tag_table
+    package_tags = _rows_by(execute(select([pkg_tag]).where(pkg_tag.c.package_id.in_(ids))), 'package_id')
+    tag_ids = set(row.tag_id for rows in package_tags.itervalues() for row in rows)
+    tag = model.tag_table
+    tags = dict((row.id, d.table_dictize(row, context))
+                for row in _select_in(execute, tag, tag.c.id, tag_ids))
+
+    member = model.member_table
+    group = model.group_table
+    memberships = _rows_by(execute(select([member])
+                                   .where(member.c.table_id.in_(ids))
+                                   .where(member.c.state == 'active')), 'table_id')
+    group_ids = set(row.group_id for rows in memberships.itervalues() for row in rows)
+    groups = dict((row.id, row) for row in _select_in(execute, group, group.c.id, group_ids)
+                  if not row.is_organization)
+
+    owner_orgs = set(pkg.owner_org for pkg in packages if pkg.owner_org)
+    organizations = dict((row.id, d.table_dictize(row, context))
+                         for row in _select_in(execute, group, group.c.id, owner_orgs)
+                         if row.state == 'active')
+
+    rel = model.package_relationship_table
+    relationships_as_subject = _rows_by(execute(select([rel]).where(rel.c.subject_package_id.in_(ids))),
+                                        'subject_package_id')
+    relationships_as_object = _rows_by(execute(select([rel]).where(rel.c.object_package_id.in_(ids))),
+                                       'object_package_id')
+
+    result = []
+    for pkg in packages:
+        result_dict = d.table_dictize(pkg, context)
+        # strip whitespace from title
+        if result_dict.get('title'):
+            result_dict['title'] = result_dict['title'].strip()
+
+        result_dict['resources'] = model_dictize.resource_list_dictize(resources.get(pkg.id, []), context)
+        result_dict['num_resources'] = len(result_dict['resources'])
+
+        package_tag_list = []
+        # every package_tag row, deleted ones included, as package_dictize does
+        for row in package_tags.get(pkg.id, []):
+            tag_dict = dict(tags[row.tag_id])
+            tag_dict['state'] = row.state
+            tag_dict['display_name'] = tag_dict['name']
+            package_tag_list.append(tag_dict)
+        result_dict['tags'] = sorted(package_tag_list, key=lambda x: x['name'])
+        result_dict['num_tags'] = len(result_dict['tags'])
+
+        result_dict['extras'] = model_dictize.extras_list_dictize(extras.get(pkg.id, []), context)
+
+        group_context = dict(context, with_capacity=True)
+        result_dict['groups'] = model_dictize.group_list_dictize(
+            [(groups[row.group_id], row.capacity) for row in memberships.get(pkg.id, [])
+             if row.group_id in groups],
+            group_context, with_package_counts=False)
+
+        organization = organizations.get(pkg.owner_org)
+        result_dict['organization'] = dict(organization) if organization else None
+
+        result_dict['relationships_as_subject'] = d.obj_list_dictize(
+            relationships_as_subject.get(pkg.id, []), context)
+        result_dict['relationships_as_object'] = d.obj_list_dictize(
+            relationships_as_object.get(pkg.id, []), context)
+
+        # isopen
+        result_dict['isopen'] = pkg.isopen if isinstance(pkg.isopen, bool) else pkg.isopen()
+
+        # type
+        # if null assign the default value to make searching easier
+        result_dict['type'] = pkg.type or u'dataset'
+
+        # license
+        if pkg.license and pkg.license.url:
+            result_dict['license_url'] = pkg.license.url
+            result_dict['license_title'] = pkg.license.title.split('::')[-1]
+        elif pkg.license:
+            result_dict['license_title'] = pkg.license.title
+        else:
+            result_dict['license_title'] = pkg.license_id
+
+        # creation and modification date
+        result_dict['metadata_modified'] = pkg.metadata_modified.isoformat()
+        result_dict['metadata_created'] = pkg.metadata_created.isoformat() if pkg.metadata_created else None
+
+        result.append(result_dict)
+    return result
+
+
+def _select_in(execute, table, column, values):
+    if not values:
+        return []
+    return execute(select([table]).where(column.in_(list(values)))).fetchall()
+
+
+def _rows_by(rows, column):
+    grouped = defaultdict(list)
+    for row in rows:
+        grouped[row[column]].append(row)
+    return grouped
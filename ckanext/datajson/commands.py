@@ -0,0 +1,404 @@
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+
+from ckan.lib.cli import CkanCommand
+
+try:
+    from collections import OrderedDict  # 2.7
+except ImportError:
+    from sqlalchemy.util import OrderedDict
+
+log = logging.getLogger(__name__)
+
+# datasets sent to a validate worker at a time
+VALIDATION_BATCH_SIZE = 200
+
+
+class DataJsonCommand(CkanCommand):
+    """
+    data.json exports
+
+    Usage:
+
+      datajson export <output directory> [--processes=N]
+        - Writes the site-wide catalog to <output directory>/data.json and the
+          catalog of every organization to
+          <output directory>/organization/<organization name>/data.json
+          Organizations are exported side by side in N processes (one per CPU
+          by default), every dataset is converted once.
+
+      datajson update-bureau-codes
+        - Downloads the current list of OMB bureau codes used by the /pod/validate
+          validator from project-open-data.cio.gov, in place of the bundled one.
+
+      datajson validate <file or directory> ... [--processes=N] [--report=<file>]
+        - Validates data.json files like /pod/validate does, and every *.json
+          file of the directories given. Datasets are validated side by side
+          in N processes (one per CPU by default). Prints the number of errors
+          of each file and writes all of them to the report file as JSON.
+          Exits with status 1 if any file has errors.
+    """
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+    max_args = None
+    min_args = 1
+
+    def __init__(self, name):
+        super(DataJsonCommand, self).__init__(name)
+        self.parser.add_option('--processes', dest='processes', type='int',
+                               default=multiprocessing.cpu_count(),
+                               help='Number of export or validation processes')
+        self.parser.add_option('--report', dest='report', default=None,
+                               help='File the validation errors are written to, as JSON')
+
+    def command(self):
+        cmd = self.args[0]
+        if cmd == 'export':
+            if len(self.args) < 2:
+                print self.usage
+                sys.exit(1)
+            self._load_config()
+            self.export(self.args[1])
+        elif cmd == 'update-bureau-codes':
+            self.update_bureau_codes()
+        elif cmd == 'validate':
+            if len(self.args) < 2:
+                print self.usage
+                sys.exit(1)
+            self.validate(self.args[1:])
+        else:
+            print 'Command %s not recognized' % cmd
+            print self.usage
+            sys.exit(1)
+
+    def export(self, output_dir):
+        """
+        Exports the organization catalogs in a process pool, then assembles the
+        site-wide catalog from their 'dataset' arrays. Every file is written to
+        a temporary file first and renamed into place once complete.
+        """
+        from ckan import model
+        from ckanext.datajson.helpers import get_export_map_json
+        from ckanext.datajson.plugin import DataJsonPlugin, _indexed_organizations
+
+        json_export_map = get_export_map_json(DataJsonPlugin.map_filename)
+        if not json_export_map:
+            print 'No export map found'
+            sys.exit(1)
+
+        organizations = set(name for (name,) in model.Session.query(model.Group.name)
+                            .filter(model.Group.is_organization == True)
+                            .filter(model.Group.state == 'active'))
+        # the datasets of the organizations that are not active anymore, and the
+        # ones without an organization, only end up in the site-wide catalog
+        shards = [(org, org in organizations) for org in sorted(organizations | set(_indexed_organizations()))]
+        shards.append((None, False))
+
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        work_dir = tempfile.mkdtemp(dir=output_dir, prefix='.datajson-export-')
+
+        # the worker processes must not share the database connections of this one
+        model.Session.remove()
+        model.meta.engine.dispose()
+
+        pool = multiprocessing.Pool(max(1, min(self.options.processes, len(shards))))
+        try:
+            catalogs = []
+            for org, active, path, fragments, in_site_catalog in pool.imap(
+                    _export_shard, [(org, active, output_dir, work_dir) for org, active in shards]):
+                if active:
+                    print 'organization %s: %d datasets' % (org, len(fragments))
+                if in_site_catalog:
+                    catalogs.append((path, fragments))
+            pool.close()
+
+            total = _write_site_catalog(os.path.join(output_dir, 'data.json'), catalogs, json_export_map, work_dir)
+            print 'data.json: %d datasets' % total
+        finally:
+            pool.terminate()
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def update_bureau_codes(self):
+        from ckanext.datajson.datajsonvalidator import OMB_BUREAU_CODES_PATH, OMB_BUREAU_CODES_URL, \
+            update_omb_bureau_codes
+
+        count = update_omb_bureau_codes()
+        print '%d bureau codes from %s written to %s' % (count, OMB_BUREAU_CODES_URL, OMB_BUREAU_CODES_PATH)
+
+    def validate(self, paths):
+        """
+        Validates the catalogs at paths in a process pool, in batches of
+        datasets. Each dataset is checked on its own in the pool, its errors
+        are merged here and its identifier checked against the other datasets
+        of the catalog.
+        """
+        from ckanext.datajson.datajsonvalidator import add_duplicate_identifier_error, merge_errors
+
+        catalog_paths = list(_iter_catalog_paths(paths))
+        catalogs = [_CatalogValidation(path) for path in catalog_paths]
+
+        processes = max(1, self.options.processes)
+        pool = multiprocessing.Pool(processes) if processes > 1 else None
+        try:
+            batches = _iter_validation_batches(catalog_paths)
+            # batches are validated in order, so that the first occurrence of an identifier is the valid one
+            results = pool.imap(_validate_batch, batches) if pool else itertools.imap(_validate_batch, batches)
+            for index, datasets, error in results:
+                catalog = catalogs[index]
+                if catalog.errors:
+                    # like /pod/validate, a catalog is not read past a dataset that is not valid JSON
+                    continue
+                if error:
+                    catalog.errors.append(error)
+                for dataset_name, errs, identifier in datasets:
+                    catalog.count += 1
+                    merge_errors(catalog.errs, add_duplicate_identifier_error(errs, identifier, dataset_name,
+                                                                             catalog.seen_identifiers))
+            if pool:
+                pool.close()
+        finally:
+            if pool:
+                pool.terminate()
+
+        report = [catalog.report() for catalog in catalogs]
+        for catalog in report:
+            print '%s: %d datasets, %d errors' % (catalog['path'], catalog['datasets'],
+                                                  sum(len(error['datasets']) or 1 for error in catalog['errors']))
+        if self.options.report:
+            _write_atomic(os.path.abspath(self.options.report), [json.dumps(report, indent=2)],
+                          os.path.dirname(os.path.abspath(self.options.report)))
+        if any(catalog['errors'] for catalog in report):
+            sys.exit(1)
+
+
+class _CatalogValidation(object):
+    """
+    Errors of one catalog of the validate command, as they are merged
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self.errs = {}
+        self.seen_identifiers = set()
+        # errors of the catalog itself, as (heading, [descriptions])
+        self.errors = []
+
+    def report(self):
+        """
+        :return: OrderedDict of the path, number of datasets and errors, most
+            severe first
+        """
+        if not self.errors and not self.count:
+            self.errors.append(("Catalog Is Empty", ["There are no entries in your file."]))
+        errors = [OrderedDict([('severity', 0), ('heading', heading), ('description', description), ('datasets', [])])
+                  for heading, descriptions in self.errors for description in descriptions]
+        for severity, heading in sorted(self.errs):
+            descriptions = self.errs[(severity, heading)]
+            for description in sorted(descriptions, key=lambda d: (-len(descriptions[d]), d)):
+                errors.append(OrderedDict([('severity', severity), ('heading', heading),
+                                           ('description', description),
+                                           ('datasets', sorted(descriptions[description]))]))
+        return OrderedDict([('path', self.path), ('datasets', self.count), ('errors', errors)])
+
+
+def _iter_catalog_paths(paths):
+    """
+    :return: iterator of paths, with the *.json files of the directories
+        among them in place of the directories
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    if filename.endswith('.json'):
+                        yield os.path.join(directory, filename)
+        else:
+            yield path
+
+
+def _iter_validation_batches(catalog_paths):
+    """
+    Reads the catalogs one after the other, as JSON text, without parsing
+    their datasets
+    :return: iterator of (index of the catalog, number of the first dataset,
+        [JSON text of VALIDATION_BATCH_SIZE datasets], error of the catalog as
+        (heading, [descriptions]) or None)
+    """
+    from ckanext.datajson.jsonstream import iter_catalog_datasets
+
+    for index, path in enumerate(catalog_paths):
+        batch = []
+        start = 1
+        try:
+            with open(path, 'rb') as catalog:
+                for text in iter_catalog_datasets(catalog, raw=True):
+                    batch.append(text)
+                    if len(batch) == VALIDATION_BATCH_SIZE:
+                        yield index, start, batch, None
+                        start += len(batch)
+                        batch = []
+        except IOError as e:
+            yield index, start, batch, ("Error Loading File", ["The file could not be read: " + unicode(e)])
+        except ValueError as e:
+            yield index, start, batch, ("Invalid JSON", ["The file does not meet basic JSON syntax requirements: " +
+                                                         unicode(e) + ". Try using JSONLint.com."])
+        else:
+            if batch:
+                yield index, start, batch, None
+
+
+def _validate_batch(args):
+    """
+    Pool worker: validates a batch of datasets of a catalog
+    :return: (index of the catalog, [(dataset name, errors, identifier)] as
+        returned by datajsonvalidator.validate_dataset_text, error of the
+        catalog)
+    """
+    index, start, batch, error = args
+
+    from ckanext.datajson.datajsonvalidator import validate_dataset_text
+
+    datasets = []
+    for number, text in enumerate(batch, start):
+        try:
+            datasets.append(validate_dataset_text(text, "dataset %d" % number))
+        except ValueError as e:
+            # the brackets and quotes of a dataset are matched while reading, but it is parsed here
+            error = ("Invalid JSON", ["The file does not meet basic JSON syntax requirements: " +
+                                      unicode(e) + ". Try using JSONLint.com."])
+            break
+    return index, datasets, error
+
+
+def _export_shard(args):
+    """
+    Pool worker: writes the catalog of one organization, with the datasets
+    /organization/{org}/data.json exports (org None: of the datasets without
+    organization, and organizations that are not active: to work_dir only)
+    :return: (org, active, path of the catalog, list of (identifier, size) of
+        its datasets, whether they belong in the site-wide catalog)
+    """
+    org, active, output_dir, work_dir = args
+
+    from ckan import model
+    from ckanext.datajson.helpers import get_export_map_json
+    from ckanext.datajson.package2pod import Package2Pod
+    from ckanext.datajson.plugin import DataJsonController, DataJsonPlugin, _iter_keyset_pages, _peek, \
+        _search_query
+
+    try:
+        json_export_map = get_export_map_json(DataJsonPlugin.map_filename)
+        controller = DataJsonController()
+
+        if org:
+            packages = _peek(DataJsonController._iter_ckan_datasets(org=org))
+            # the indexed datasets of org, the site-wide catalog is made of them
+            in_site_catalog = packages is not None
+            if packages is None:
+                # as DataJsonController.stream_json does, never load private datasets here
+                packages = controller.get_packages(owner_org=org, with_private=False) if active else []
+        else:
+            q, fq = _search_query()
+            fq += ' AND -organization:[* TO *]'
+            packages = (pkg for page in _iter_keyset_pages(q, fq, DataJsonPlugin.search_rows) for pkg in page)
+            in_site_catalog = True
+        if active:
+            path = os.path.join(output_dir, 'organization', org, 'data.json')
+        else:
+            path = os.path.join(work_dir, 'organization-%s.json' % org if org else 'no-organization.json')
+
+        fragments = []
+
+        def listed(items):
+            for fragment, identifier in items:
+                fragment = _encode(fragment)
+                fragments.append((identifier, len(fragment)))
+                yield fragment
+
+        items = controller._iter_identified_fragments(packages, json_export_map)
+        _write_atomic(path, Package2Pod.iter_json_catalog(listed(items), json_export_map), work_dir)
+        return org, active, path, fragments, in_site_catalog
+    except Exception:
+        log.exception('data.json export of organization %s failed', org)
+        raise
+    finally:
+        model.Session.remove()
+
+
+def _write_site_catalog(path, catalogs, json_export_map, work_dir):
+    """
+    Writes the catalog of all the datasets of catalogs, by copying the datasets
+    of their 'dataset' arrays one after the other. With validation enabled, a
+    dataset whose identifier was already copied from another catalog is left
+    out, as the duplicate identifiers check of the web export does.
+    :param catalogs: list of (path, list of (identifier, size) of its datasets)
+    :return: number of datasets
+    """
+    from ckanext.datajson.package2pod import Package2Pod, SeenIdentifiers
+
+    # a catalog is written by iter_json_catalog as opening + datasets + closing,
+    # each dataset after a separator
+    opening, first, following, closing = [_encode(chunk) for chunk in
+                                          Package2Pod.iter_json_catalog(['{}', '{}'], json_export_map)]
+    first_separator, separator = first[:-len('{}')], following[:-len('{}')]
+    seen_identifiers = SeenIdentifiers() if json_export_map.get('validation_enabled') else None
+    count = [0]
+
+    def datasets():
+        for catalog_path, fragments in catalogs:
+            if not fragments:
+                continue
+            with open(catalog_path, 'rb') as catalog:
+                catalog.seek(len(opening))
+                for i, (identifier, size) in enumerate(fragments):
+                    catalog.seek(len(separator if i else first_separator), os.SEEK_CUR)
+                    if seen_identifiers is not None and not seen_identifiers.add_if_new(identifier):
+                        log.warn('Dataset %s of %s omitted from the site-wide catalog, '
+                                 'its identifier is used more than once', identifier, catalog_path)
+                        catalog.seek(size, os.SEEK_CUR)
+                        continue
+                    count[0] += 1
+                    yield catalog.read(size)
+
+    _write_atomic(path, Package2Pod.iter_json_catalog(datasets(), json_export_map), work_dir)
+    return count[0]
+
+
+def _write_atomic(path, chunks, work_dir):
+    """
+    Writes chunks to a temporary file in work_dir and renames it to path
+    """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # created by another worker meanwhile
+            if not os.path.isdir(directory):
+                raise
+
+    fd, tmp_path = tempfile.mkstemp(dir=work_dir, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            for chunk in chunks:
+                tmp.write(_encode(chunk))
+        os.chmod(tmp_path, 0644)
+        os.rename(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _encode(chunk):
+    if isinstance(chunk, unicode):
+        return chunk.encode('utf8')
+    return chunk
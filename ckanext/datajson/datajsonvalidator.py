@@ -1,6 +1,15 @@
+import csv
+import json
+import os
 import re
+import tempfile
+import urllib2
+
+import lepl.apps.rfc3696
 import rfc3987 as rfc3987_url
 
+from cache import LRUCache
+
 # from the iso8601 package, plus ^ and $ on the edges
 ISO8601_REGEX = re.compile(r"^([0-9]{4})(-([0-9]{1,2})(-([0-9]{1,2})"
                            r"((.)([0-9]{2}):([0-9]{2})(:([0-9]{2})(\.([0-9]+))?)?"
@@ -79,17 +88,165 @@ REDACTED_REGEX = re.compile(
     r'^(\[\[REDACTED).*?(\]\])$'
 )
 
-import lepl.apps.rfc3696
+# Common http(s) URLs, a subset of what the rfc3987 IRI_reference rule accepts
+_URL_PCHAR = r"(?:[A-Za-z0-9\-._~!$&'()*+,;=:@]|%[0-9A-Fa-f]{2})"
+SIMPLE_URL_REGEX = re.compile(
+    r"^https?://[A-Za-z0-9.\-]*(?::[0-9]*)?(?:/" + _URL_PCHAR + r"*)*"
+    r"(?:\?(?:" + _URL_PCHAR + r"|[/?])*)?(?:#(?:" + _URL_PCHAR + r"|[/?])*)?$"
+)
+
+# Characters that no IRI reference contains
+NOT_URL_REGEX = re.compile(r'[ "<>\\^`{|}]')
+
+# number of results kept by each of the memoized checks below
+VALIDATION_CACHE_SIZE = 10000
 
 email_validator = lepl.apps.rfc3696.Email()
 
-# load the OMB bureau codes on first load of this module
-import urllib
-import csv
 
-omb_burueau_codes = set()
-for row in csv.DictReader(urllib.urlopen("https://project-open-data.cio.gov/data/omb_bureau_codes.csv")):
-    omb_burueau_codes.add(row["Agency Code"] + ":" + row["Bureau Code"])
+def memoized(check):
+    """
+    Keeps the results of check for the last VALIDATION_CACHE_SIZE strings it
+    was called with, catalogs repeat the same URLs and dates a lot
+    """
+    cache = LRUCache(VALIDATION_CACHE_SIZE)
+
+    def memoized_check(value):
+        if not isinstance(value, basestring):
+            return check(value)
+        result = cache.get(value)
+        if result is None:
+            result = check(value)
+            cache.set(value, result)
+        return result
+    memoized_check.cache = cache
+    return memoized_check
+
+
+@memoized
+def is_url(value):
+    """
+    Whether value is a rfc3987 URL (IRI reference)
+    """
+    if SIMPLE_URL_REGEX.match(value):
+        return True
+    if NOT_URL_REGEX.search(value):
+        return False
+    return rfc3987_url.match(value) is not None
+
+
+@memoized
+def is_email(value):
+    return bool(email_validator(value))
+
+
+@memoized
+def is_modified_date(value):
+    return bool(MODIFIED_REGEX_1.match(value) or MODIFIED_REGEX_2.match(value) or MODIFIED_REGEX_3.match(value))
+
+
+@memoized
+def is_temporal(value):
+    return bool(TEMPORAL_REGEX_1.match(value) or TEMPORAL_REGEX_2.match(value) or TEMPORAL_REGEX_3.match(value))
+
+
+@memoized
+def is_issued_date(value):
+    return bool(ISSUED_REGEX.match(value))
+
+
+OMB_BUREAU_CODES_URL = "https://project-open-data.cio.gov/data/omb_bureau_codes.csv"
+
+# sorted list of the "agency code:bureau code" pairs, see update_omb_bureau_codes
+OMB_BUREAU_CODES_PATH = os.path.join(os.path.dirname(__file__), "resources", "omb-bureau-codes.json")
+
+_omb_bureau_codes = None
+
+
+def get_omb_bureau_codes():
+    """
+    Valid OMB bureau codes, loaded from the bundled list on first use
+    :return: frozenset of "agency code:bureau code"
+    """
+    global _omb_bureau_codes
+    if _omb_bureau_codes is None:
+        with open(OMB_BUREAU_CODES_PATH, "r") as codes_file:
+            _omb_bureau_codes = frozenset(json.load(codes_file))
+    return _omb_bureau_codes
+
+
+def update_omb_bureau_codes(url=OMB_BUREAU_CODES_URL, path=OMB_BUREAU_CODES_PATH):
+    """
+    Replaces the bundled list of OMB bureau codes with the one published at url
+    :return: number of codes
+    """
+    global _omb_bureau_codes
+
+    codes = set()
+    for row in csv.DictReader(urllib2.urlopen(url, timeout=60)):
+        if row.get("Agency Code") and row.get("Bureau Code"):
+            codes.add(row["Agency Code"] + ":" + row["Bureau Code"])
+    if not codes:
+        raise ValueError("No bureau codes found at %s" % url)
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as tmp:
+            json.dump(sorted(codes), tmp, indent=2)
+            tmp.write("\n")
+        os.chmod(tmp_path, 0644)
+        os.rename(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    _omb_bureau_codes = frozenset(codes)
+    return len(codes)
+
+
+def add_identifier(seen_identifiers, identifier):
+    """
+    Adds identifier to seen_identifiers, a set or an object with an atomic
+    add_if_new() (shared by threads converting the datasets of one catalog)
+    :return: False if the identifier had already been seen
+    """
+    if hasattr(seen_identifiers, 'add_if_new'):
+        return seen_identifiers.add_if_new(identifier)
+    if identifier in seen_identifiers:
+        return False
+    seen_identifiers.add(identifier)
+    return True
+
+
+def check_duplicate_identifier(identifier, dataset_name, errs, seen_identifiers):
+    """
+    Adds an error to errs if identifier is in seen_identifiers, adds it there
+    otherwise
+    """
+    if not add_identifier(seen_identifiers, identifier):
+        add_error(errs, 5, "Invalid Required Field Value",
+                  "The dataset identifier \"%s\" is used more than once." % identifier,
+                  dataset_name)
+
+
+def add_duplicate_identifier_error(errs, identifier, dataset_name, seen_identifiers):
+    """
+    Duplicate identifier check of a dataset validated with
+    validate_dataset_text
+    :param identifier: identifier of the dataset, None if it is not valid
+    :return: errs, or a copy of errs with the error if the identifier is in
+        seen_identifiers already
+    """
+    if identifier is None:
+        return errs
+    duplicate = {}
+    check_duplicate_identifier(identifier, dataset_name, duplicate, seen_identifiers)
+    if not duplicate:
+        return errs
+    merged = {}
+    merge_errors(merged, errs)
+    merge_errors(merged, duplicate)
+    return merged
 
 
 # main function for validation
@@ -109,289 +266,327 @@ def do_validation(doc, errors_array, seen_identifiers):
             dataset_name = "dataset %d" % (i + 1)
 
             for item in doc_item.get('dataset', []):
-                # title
-                if check_required_string_field(item, "title", 1, dataset_name, errs):
-                    dataset_name = '"%s"' % item.get("title", "").strip()
-
-                # accessLevel # required
-                if check_required_string_field(item, "accessLevel", 3, dataset_name, errs):
-                    if item["accessLevel"] not in ("public", "restricted public", "non-public"):
-                        add_error(errs, 5, "Invalid Required Field Value",
-                                  "The field 'accessLevel' had an invalid value: \"%s\"" % item["accessLevel"],
-                                  dataset_name)
-
-                # bureauCode # required
-                if not is_redacted(item.get('bureauCode')):
-                    if check_required_field(item, "bureauCode", list, dataset_name, errs):
-                        for bc in item["bureauCode"]:
-                            if not isinstance(bc, (str, unicode)):
-                                add_error(errs, 5, "Invalid Required Field Value", "Each bureauCode must be a string",
-                                          dataset_name)
-                            elif ":" not in bc:
-                                add_error(errs, 5, "Invalid Required Field Value",
-                                          "The bureau code \"%s\" is invalid. "
-                                          "Start with the agency code, then a colon, then the bureau code." % bc,
-                                          dataset_name)
-                            elif bc not in omb_burueau_codes:
-                                add_error(errs, 5, "Invalid Required Field Value",
-                                          "The bureau code \"%s\" was not found in our list "
-                                          "(https://project-open-data.cio.gov/data/omb_bureau_codes.csv)." % bc,
-                                          dataset_name)
-
-                # contactPoint # required
-                if check_required_field(item, "contactPoint", dict, dataset_name, errs):
-                    cp = item["contactPoint"]
-                    # contactPoint - fn # required
-                    check_required_string_field(cp, "fn", 1, dataset_name, errs)
-
-                    # contactPoint - hasEmail # required
-                    if check_required_string_field(cp, "hasEmail", 9, dataset_name, errs):
-                        if not is_redacted(cp.get('hasEmail')):
-                            email = cp["hasEmail"].replace('mailto:', '')
-                            if not email_validator(email):
-                                add_error(errs, 5, "Invalid Required Field Value",
-                                          "The email address \"%s\" is not a valid email address." % email,
-                                          dataset_name)
-
-                # description # required
-                check_required_string_field(item, "description", 1, dataset_name, errs)
-
-                # identifier #required
-                if check_required_string_field(item, "identifier", 1, dataset_name, errs):
-                    if item["identifier"] in seen_identifiers:
-                        add_error(errs, 5, "Invalid Required Field Value",
-                                  "The dataset identifier \"%s\" is used more than once." % item["identifier"],
-                                  dataset_name)
-                    seen_identifiers.add(item["identifier"])
-
-                # keyword # required
-                if isinstance(item.get("keyword"), (str, unicode)):
-                    if not is_redacted(item.get("keyword")):
-                        add_error(errs, 5, "Update Your File!",
-                                  "The keyword field used to be a string but now it must be an array.", dataset_name)
-                elif check_required_field(item, "keyword", list, dataset_name, errs):
-                    for kw in item["keyword"]:
-                        if not isinstance(kw, (str, unicode)):
-                            add_error(errs, 5, "Invalid Required Field Value",
-                                      "Each keyword in the keyword array must be a string", dataset_name)
-                        elif len(kw.strip()) == 0:
-                            add_error(errs, 5, "Invalid Required Field Value",
-                                      "A keyword in the keyword array was an empty string.", dataset_name)
-
-                # modified # required
-                if check_required_string_field(item, "modified", 1, dataset_name, errs):
-                    if not is_redacted(item['modified']) \
-                            and not MODIFIED_REGEX_1.match(item['modified']) \
-                            and not MODIFIED_REGEX_2.match(item['modified']) \
-                            and not MODIFIED_REGEX_3.match(item['modified']):
-                        add_error(errs, 5, "Invalid Required Field Value",
-                                  "The field \"modified\" is not in valid format: \"%s\"" % item['modified'], dataset_name)
-
-                # programCode # required
-                if not is_redacted(item.get('programCode')):
-                    if check_required_field(item, "programCode", list, dataset_name, errs):
-                        for pc in item["programCode"]:
-                            if not isinstance(pc, (str, unicode)):
-                                add_error(errs, 5, "Invalid Required Field Value",
-                                          "Each programCode in the programCode array must be a string", dataset_name)
-                            elif not PROGRAM_CODE_REGEX.match(pc):
-                                add_error(errs, 50, "Invalid Field Value (Optional Fields)",
-                                          "One of programCodes is not in valid format (ex. 018:001): \"%s\"" % pc,
-                                          dataset_name)
-
-                # publisher # required
-                if check_required_field(item, "publisher", dict, dataset_name, errs):
-                    # publisher - name # required
-                    check_required_string_field(item["publisher"], "name", 1, dataset_name, errs)
-
-                # Required-If-Applicable
-
-                # dataQuality # Required-If-Applicable
-                if item.get("dataQuality") is None or is_redacted(item.get("dataQuality")):
-                    pass  # not required or REDACTED
-                elif not isinstance(item["dataQuality"], bool):
-                    add_error(errs, 50, "Invalid Field Value (Optional Fields)",
-                              "The field 'dataQuality' must be true or false, "
-                              "as a JSON boolean literal (not the string \"true\" or \"false\").",
+                dataset_name = validate_dataset(item, dataset_name, errs, seen_identifiers)
+
+    format_errors(errs, errors_array)
+
+
+def validate_dataset(item, dataset_name, errs, seen_identifiers):
+    """
+    Checks one dataset of a catalog, adding its errors to errs (see add_error)
+    :param dataset_name: name of the dataset in the errors if it has no title
+    :return: name of the dataset in the errors
+    """
+    # title
+    if check_required_string_field(item, "title", 1, dataset_name, errs):
+        dataset_name = '"%s"' % item.get("title", "").strip()
+
+    # accessLevel # required
+    if check_required_string_field(item, "accessLevel", 3, dataset_name, errs):
+        if item["accessLevel"] not in ("public", "restricted public", "non-public"):
+            add_error(errs, 5, "Invalid Required Field Value",
+                      "The field 'accessLevel' had an invalid value: \"%s\"" % item["accessLevel"],
+                      dataset_name)
+
+    # bureauCode # required
+    if not is_redacted(item.get('bureauCode')):
+        if check_required_field(item, "bureauCode", list, dataset_name, errs):
+            for bc in item["bureauCode"]:
+                if not isinstance(bc, (str, unicode)):
+                    add_error(errs, 5, "Invalid Required Field Value", "Each bureauCode must be a string",
+                              dataset_name)
+                elif ":" not in bc:
+                    add_error(errs, 5, "Invalid Required Field Value",
+                              "The bureau code \"%s\" is invalid. "
+                              "Start with the agency code, then a colon, then the bureau code." % bc,
+                              dataset_name)
+                elif bc not in get_omb_bureau_codes():
+                    add_error(errs, 5, "Invalid Required Field Value",
+                              "The bureau code \"%s\" was not found in our list "
+                              "(https://project-open-data.cio.gov/data/omb_bureau_codes.csv)." % bc,
                               dataset_name)
 
-                # distribution # Required-If-Applicable
-                if item.get("distribution") is None:
-                    pass  # not required
-                elif not isinstance(item["distribution"], list):
-                    if isinstance(item["distribution"], (str, unicode)) and is_redacted(item.get("distribution")):
-                        pass
-                    else:
-                        add_error(errs, 50, "Invalid Field Value (Optional Fields)",
-                                  "The field 'distribution' must be an array, if present.", dataset_name)
-                else:
-                    for j, dt in enumerate(item["distribution"]):
-                        if isinstance(dt, (str, unicode)):
-                            if is_redacted(dt):
-                                continue
-                        distribution_name = dataset_name + (" distribution %d" % (j + 1))
-                        # distribution - downloadURL # Required-If-Applicable
-                        check_url_field(False, dt, "downloadURL", distribution_name, errs, allow_redacted=True)
-
-                        # distribution - mediaType # Required-If-Applicable
-                        if 'downloadURL' in dt:
-                            if check_required_string_field(dt, "mediaType", 1, distribution_name, errs):
-                                if not IANA_MIME_REGEX.match(dt["mediaType"]) \
-                                        and not is_redacted(dt["mediaType"]):
-                                    add_error(errs, 5, "Invalid Field Value",
-                                              "The distribution mediaType \"%s\" is invalid. "
-                                              "It must be in IANA MIME format." % dt["mediaType"],
-                                              distribution_name)
-
-                        # distribution - accessURL # optional
-                        check_url_field(False, dt, "accessURL", distribution_name, errs, allow_redacted=True)
-
-                        # distribution - conformsTo # optional
-                        check_url_field(False, dt, "conformsTo", distribution_name, errs, allow_redacted=True)
-
-                        # distribution - describedBy # optional
-                        check_url_field(False, dt, "describedBy", distribution_name, errs, allow_redacted=True)
-
-                        # distribution - describedByType # optional
-                        if dt.get("describedByType") is None or is_redacted(dt.get("describedByType")):
-                            pass  # not required or REDACTED
-                        elif not IANA_MIME_REGEX.match(dt["describedByType"]):
-                            add_error(errs, 5, "Invalid Field Value",
-                                      "The describedByType \"%s\" is invalid. "
-                                      "It must be in IANA MIME format." % dt["describedByType"],
-                                      distribution_name)
-
-                        # distribution - description # optional
-                        if dt.get("description") is not None:
-                            check_required_string_field(dt, "description", 1, distribution_name, errs)
-
-                        # distribution - format # optional
-                        if dt.get("format") is not None:
-                            check_required_string_field(dt, "format", 1, distribution_name, errs)
-
-                        # distribution - title # optional
-                        if dt.get("title") is not None:
-                            check_required_string_field(dt, "title", 1, distribution_name, errs)
-
-                # license # Required-If-Applicable
-                check_url_field(False, item, "license", dataset_name, errs, allow_redacted=True)
-
-                # rights # Required-If-Applicable
-                # TODO move to warnings
-                # if item.get("accessLevel") != "public":
-                # check_string_field(item, "rights", 1, dataset_name, errs)
-
-                # spatial # Required-If-Applicable
-                # TODO: There are more requirements than it be a string.
-                if item.get("spatial") is not None and not isinstance(item.get("spatial"), (str, unicode)):
-                    add_error(errs, 50, "Invalid Field Value (Optional Fields)",
-                              "The field 'spatial' must be a string value if specified.", dataset_name)
-
-                # temporal # Required-If-Applicable
-                if item.get("temporal") is None or is_redacted(item.get("temporal")):
-                    pass  # not required or REDACTED
-                elif not isinstance(item["temporal"], (str, unicode)):
-                    add_error(errs, 10, "Invalid Field Value (Optional Fields)",
-                              "The field 'temporal' must be a string value if specified.", dataset_name)
-                elif "/" not in item["temporal"]:
-                    add_error(errs, 10, "Invalid Field Value (Optional Fields)",
-                              "The field 'temporal' must be two dates separated by a forward slash.", dataset_name)
-                elif not TEMPORAL_REGEX_1.match(item['temporal']) \
-                        and not TEMPORAL_REGEX_2.match(item['temporal']) \
-                        and not TEMPORAL_REGEX_3.match(item['temporal']):
+    # contactPoint # required
+    if check_required_field(item, "contactPoint", dict, dataset_name, errs):
+        cp = item["contactPoint"]
+        # contactPoint - fn # required
+        check_required_string_field(cp, "fn", 1, dataset_name, errs)
+
+        # contactPoint - hasEmail # required
+        if check_required_string_field(cp, "hasEmail", 9, dataset_name, errs):
+            if not is_redacted(cp.get('hasEmail')):
+                email = cp["hasEmail"].replace('mailto:', '')
+                if not is_email(email):
+                    add_error(errs, 5, "Invalid Required Field Value",
+                              "The email address \"%s\" is not a valid email address." % email,
+                              dataset_name)
+
+    # description # required
+    check_required_string_field(item, "description", 1, dataset_name, errs)
+
+    # identifier #required
+    if check_required_string_field(item, "identifier", 1, dataset_name, errs):
+        check_duplicate_identifier(item["identifier"], dataset_name, errs, seen_identifiers)
+
+    # keyword # required
+    if isinstance(item.get("keyword"), (str, unicode)):
+        if not is_redacted(item.get("keyword")):
+            add_error(errs, 5, "Update Your File!",
+                      "The keyword field used to be a string but now it must be an array.", dataset_name)
+    elif check_required_field(item, "keyword", list, dataset_name, errs):
+        for kw in item["keyword"]:
+            if not isinstance(kw, (str, unicode)):
+                add_error(errs, 5, "Invalid Required Field Value",
+                          "Each keyword in the keyword array must be a string", dataset_name)
+            elif len(kw.strip()) == 0:
+                add_error(errs, 5, "Invalid Required Field Value",
+                          "A keyword in the keyword array was an empty string.", dataset_name)
+
+    # modified # required
+    if check_required_string_field(item, "modified", 1, dataset_name, errs):
+        if not is_redacted(item['modified']) and not is_modified_date(item['modified']):
+            add_error(errs, 5, "Invalid Required Field Value",
+                      "The field \"modified\" is not in valid format: \"%s\"" % item['modified'], dataset_name)
+
+    # programCode # required
+    if not is_redacted(item.get('programCode')):
+        if check_required_field(item, "programCode", list, dataset_name, errs):
+            for pc in item["programCode"]:
+                if not isinstance(pc, (str, unicode)):
+                    add_error(errs, 5, "Invalid Required Field Value",
+                              "Each programCode in the programCode array must be a string", dataset_name)
+                elif not PROGRAM_CODE_REGEX.match(pc):
                     add_error(errs, 50, "Invalid Field Value (Optional Fields)",
-                              "The field 'temporal' has an invalid start or end date.", dataset_name)
+                              "One of programCodes is not in valid format (ex. 018:001): \"%s\"" % pc,
+                              dataset_name)
 
-                # Expanded Fields
+    # publisher # required
+    if check_required_field(item, "publisher", dict, dataset_name, errs):
+        # publisher - name # required
+        check_required_string_field(item["publisher"], "name", 1, dataset_name, errs)
 
-                # accrualPeriodicity # optional
-                if item.get("accrualPeriodicity") not in ACCRUAL_PERIODICITY_VALUES \
-                        and not is_redacted(item.get("accrualPeriodicity")):
-                    add_error(errs, 50, "Invalid Field Value (Optional Fields)",
-                              "The field 'accrualPeriodicity' had an invalid value.", dataset_name)
+    # Required-If-Applicable
 
-                # conformsTo # optional
-                check_url_field(False, item, "conformsTo", dataset_name, errs, allow_redacted=True)
+    # dataQuality # Required-If-Applicable
+    if item.get("dataQuality") is None or is_redacted(item.get("dataQuality")):
+        pass  # not required or REDACTED
+    elif not isinstance(item["dataQuality"], bool):
+        add_error(errs, 50, "Invalid Field Value (Optional Fields)",
+                  "The field 'dataQuality' must be true or false, "
+                  "as a JSON boolean literal (not the string \"true\" or \"false\").",
+                  dataset_name)
 
-                # describedBy # optional
-                check_url_field(False, item, "describedBy", dataset_name, errs, allow_redacted=True)
+    # distribution # Required-If-Applicable
+    if item.get("distribution") is None:
+        pass  # not required
+    elif not isinstance(item["distribution"], list):
+        if isinstance(item["distribution"], (str, unicode)) and is_redacted(item.get("distribution")):
+            pass
+        else:
+            add_error(errs, 50, "Invalid Field Value (Optional Fields)",
+                      "The field 'distribution' must be an array, if present.", dataset_name)
+    else:
+        for j, dt in enumerate(item["distribution"]):
+            if isinstance(dt, (str, unicode)):
+                if is_redacted(dt):
+                    continue
+            distribution_name = dataset_name + (" distribution %d" % (j + 1))
+            # distribution - downloadURL # Required-If-Applicable
+            check_url_field(False, dt, "downloadURL", distribution_name, errs, allow_redacted=True)
+
+            # distribution - mediaType # Required-If-Applicable
+            if 'downloadURL' in dt:
+                if check_required_string_field(dt, "mediaType", 1, distribution_name, errs):
+                    if not IANA_MIME_REGEX.match(dt["mediaType"]) \
+                            and not is_redacted(dt["mediaType"]):
+                        add_error(errs, 5, "Invalid Field Value",
+                                  "The distribution mediaType \"%s\" is invalid. "
+                                  "It must be in IANA MIME format." % dt["mediaType"],
+                                  distribution_name)
+
+            # distribution - accessURL # optional
+            check_url_field(False, dt, "accessURL", distribution_name, errs, allow_redacted=True)
+
+            # distribution - conformsTo # optional
+            check_url_field(False, dt, "conformsTo", distribution_name, errs, allow_redacted=True)
+
+            # distribution - describedBy # optional
+            check_url_field(False, dt, "describedBy", distribution_name, errs, allow_redacted=True)
+
+            # distribution - describedByType # optional
+            if dt.get("describedByType") is None or is_redacted(dt.get("describedByType")):
+                pass  # not required or REDACTED
+            elif not IANA_MIME_REGEX.match(dt["describedByType"]):
+                add_error(errs, 5, "Invalid Field Value",
+                          "The describedByType \"%s\" is invalid. "
+                          "It must be in IANA MIME format." % dt["describedByType"],
+                          distribution_name)
+
+            # distribution - description # optional
+            if dt.get("description") is not None:
+                check_required_string_field(dt, "description", 1, distribution_name, errs)
+
+            # distribution - format # optional
+            if dt.get("format") is not None:
+                check_required_string_field(dt, "format", 1, distribution_name, errs)
+
+            # distribution - title # optional
+            if dt.get("title") is not None:
+                check_required_string_field(dt, "title", 1, distribution_name, errs)
+
+    # license # Required-If-Applicable
+    check_url_field(False, item, "license", dataset_name, errs, allow_redacted=True)
+
+    # rights # Required-If-Applicable
+    # TODO move to warnings
+    # if item.get("accessLevel") != "public":
+    # check_string_field(item, "rights", 1, dataset_name, errs)
+
+    # spatial # Required-If-Applicable
+    # TODO: There are more requirements than it be a string.
+    if item.get("spatial") is not None and not isinstance(item.get("spatial"), (str, unicode)):
+        add_error(errs, 50, "Invalid Field Value (Optional Fields)",
+                  "The field 'spatial' must be a string value if specified.", dataset_name)
+
+    # temporal # Required-If-Applicable
+    if item.get("temporal") is None or is_redacted(item.get("temporal")):
+        pass  # not required or REDACTED
+    elif not isinstance(item["temporal"], (str, unicode)):
+        add_error(errs, 10, "Invalid Field Value (Optional Fields)",
+                  "The field 'temporal' must be a string value if specified.", dataset_name)
+    elif "/" not in item["temporal"]:
+        add_error(errs, 10, "Invalid Field Value (Optional Fields)",
+                  "The field 'temporal' must be two dates separated by a forward slash.", dataset_name)
+    elif not is_temporal(item['temporal']):
+        add_error(errs, 50, "Invalid Field Value (Optional Fields)",
+                  "The field 'temporal' has an invalid start or end date.", dataset_name)
+
+    # Expanded Fields
+
+    # accrualPeriodicity # optional
+    if item.get("accrualPeriodicity") not in ACCRUAL_PERIODICITY_VALUES \
+            and not is_redacted(item.get("accrualPeriodicity")):
+        add_error(errs, 50, "Invalid Field Value (Optional Fields)",
+                  "The field 'accrualPeriodicity' had an invalid value.", dataset_name)
+
+    # conformsTo # optional
+    check_url_field(False, item, "conformsTo", dataset_name, errs, allow_redacted=True)
+
+    # describedBy # optional
+    check_url_field(False, item, "describedBy", dataset_name, errs, allow_redacted=True)
+
+    # describedByType # optional
+    if item.get("describedByType") is None or is_redacted(item.get("describedByType")):
+        pass  # not required or REDACTED
+    elif not IANA_MIME_REGEX.match(item["describedByType"]):
+        add_error(errs, 5, "Invalid Field Value",
+                  "The describedByType \"%s\" is invalid. "
+                  "It must be in IANA MIME format." % item["describedByType"],
+                  dataset_name)
 
-                # describedByType # optional
-                if item.get("describedByType") is None or is_redacted(item.get("describedByType")):
-                    pass  # not required or REDACTED
-                elif not IANA_MIME_REGEX.match(item["describedByType"]):
-                    add_error(errs, 5, "Invalid Field Value",
-                              "The describedByType \"%s\" is invalid. "
-                              "It must be in IANA MIME format." % item["describedByType"],
-                              dataset_name)
+    # isPartOf # optional
+    if item.get("isPartOf"):
+        check_required_string_field(item, "isPartOf", 1, dataset_name, errs)
+
+    # issued # optional
+    if item.get("issued") is not None and not is_redacted(item.get("issued")):
+        if not is_issued_date(item['issued']):
+            add_error(errs, 50, "Invalid Field Value (Optional Fields)",
+                      "The field 'issued' is not in a valid format.", dataset_name)
+
+    # landingPage # optional
+    check_url_field(False, item, "landingPage", dataset_name, errs, allow_redacted=True)
+
+    # language # optional
+    if item.get("language") is None or is_redacted(item.get("language")):
+        pass  # not required or REDACTED
+    elif not isinstance(item["language"], list):
+        add_error(errs, 50, "Invalid Field Value (Optional Fields)",
+                  "The field 'language' must be an array, if present.", dataset_name)
+    else:
+        for s in item["language"]:
+            if not LANGUAGE_REGEX.match(s) and not is_redacted(s):
+                add_error(errs, 50, "Invalid Field Value (Optional Fields)",
+                          "The field 'language' had an invalid language: \"%s\"" % s, dataset_name)
+
+    # PrimaryITInvestmentUII # optional
+    if item.get("PrimaryITInvestmentUII") is None or is_redacted(item.get("PrimaryITInvestmentUII")):
+        pass  # not required or REDACTED
+    elif not PRIMARY_IT_INVESTMENT_UII_REGEX.match(item["PrimaryITInvestmentUII"]):
+        add_error(errs, 50, "Invalid Field Value (Optional Fields)",
+                  "The field 'PrimaryITInvestmentUII' must be a string "
+                  "in 023-000000001 format, if present.", dataset_name)
+
+    # references # optional
+    if item.get("references") is None:
+        pass  # not required or REDACTED
+    elif not isinstance(item["references"], list):
+        if isinstance(item["references"], (str, unicode)) and is_redacted(item.get("references")):
+            pass
+        else:
+            add_error(errs, 50, "Invalid Field Value (Optional Fields)",
+                      "The field 'references' must be an array, if present.", dataset_name)
+    else:
+        for s in item["references"]:
+            if not is_url(s) and not is_redacted(s):
+                add_error(errs, 50, "Invalid Field Value (Optional Fields)",
+                          "The field 'references' had an invalid rfc3987 URL: \"%s\"" % s, dataset_name)
+
+    # systemOfRecords # optional
+    check_url_field(False, item, "systemOfRecords", dataset_name, errs, allow_redacted=True)
+
+    # theme #optional
+    if item.get("theme") is None or is_redacted(item.get("theme")):
+        pass  # not required or REDACTED
+    elif not isinstance(item["theme"], list):
+        add_error(errs, 50, "Invalid Field Value (Optional Fields)", "The field 'theme' must be an array.",
+                  dataset_name)
+    else:
+        for s in item["theme"]:
+            if not isinstance(s, (str, unicode)):
+                add_error(errs, 50, "Invalid Field Value (Optional Fields)",
+                          "Each value in the theme array must be a string", dataset_name)
+            elif len(s.strip()) == 0:
+                add_error(errs, 50, "Invalid Field Value (Optional Fields)",
+                          "A value in the theme array was an empty string.", dataset_name)
+
+    return dataset_name
+
+
+def validate_dataset_text(text, dataset_name):
+    """
+    Checks one dataset from its JSON text, on its own: duplicate identifiers
+    are left to add_duplicate_identifier_error, so that datasets can be
+    checked in any order (or in other processes)
+    :param dataset_name: name of the dataset in the errors if it has no title
+    :return: (name of the dataset in the errors, errors of the dataset (see
+        add_error), identifier of the dataset or None if it is not valid)
+    :raises ValueError: if text is not valid JSON
+    """
+    item = json.loads(text)
+    errs = {}
+    # receives the identifier if it is valid
+    identifiers = set()
+    if isinstance(item, dict):
+        dataset_name = validate_dataset(item, dataset_name, errs, identifiers)
+    else:
+        add_error(errs, 5, "Invalid Required Field Value", "Each dataset must be a JSON object.", dataset_name)
+    return dataset_name, errs, next(iter(identifiers), None)
 
-                # isPartOf # optional
-                if item.get("isPartOf"):
-                    check_required_string_field(item, "isPartOf", 1, dataset_name, errs)
 
-                # issued # optional
-                if item.get("issued") is not None and not is_redacted(item.get("issued")):
-                    if not ISSUED_REGEX.match(item['issued']):
-                        add_error(errs, 50, "Invalid Field Value (Optional Fields)",
-                                  "The field 'issued' is not in a valid format.", dataset_name)
+def merge_errors(errs, other):
+    """
+    Adds the errors of other to errs (see add_error)
+    """
+    for err_type, descriptions in (other or {}).iteritems():
+        for description, contexts in descriptions.iteritems():
+            errs.setdefault(err_type, {}).setdefault(description, set()).update(contexts)
 
-                # landingPage # optional
-                check_url_field(False, item, "landingPage", dataset_name, errs, allow_redacted=True)
 
-                # language # optional
-                if item.get("language") is None or is_redacted(item.get("language")):
-                    pass  # not required or REDACTED
-                elif not isinstance(item["language"], list):
-                    add_error(errs, 50, "Invalid Field Value (Optional Fields)",
-                              "The field 'language' must be an array, if present.", dataset_name)
-                else:
-                    for s in item["language"]:
-                        if not LANGUAGE_REGEX.match(s) and not is_redacted(s):
-                            add_error(errs, 50, "Invalid Field Value (Optional Fields)",
-                                      "The field 'language' had an invalid language: \"%s\"" % s, dataset_name)
-
-                # PrimaryITInvestmentUII # optional
-                if item.get("PrimaryITInvestmentUII") is None or is_redacted(item.get("PrimaryITInvestmentUII")):
-                    pass  # not required or REDACTED
-                elif not PRIMARY_IT_INVESTMENT_UII_REGEX.match(item["PrimaryITInvestmentUII"]):
-                    add_error(errs, 50, "Invalid Field Value (Optional Fields)",
-                              "The field 'PrimaryITInvestmentUII' must be a string "
-                              "in 023-000000001 format, if present.", dataset_name)
-
-                # references # optional
-                if item.get("references") is None:
-                    pass  # not required or REDACTED
-                elif not isinstance(item["references"], list):
-                    if isinstance(item["references"], (str, unicode)) and is_redacted(item.get("references")):
-                        pass
-                    else:
-                        add_error(errs, 50, "Invalid Field Value (Optional Fields)",
-                                  "The field 'references' must be an array, if present.", dataset_name)
-                else:
-                    for s in item["references"]:
-                        if not rfc3987_url.match(s) and not is_redacted(s):
-                            add_error(errs, 50, "Invalid Field Value (Optional Fields)",
-                                      "The field 'references' had an invalid rfc3987 URL: \"%s\"" % s, dataset_name)
-
-                # systemOfRecords # optional
-                check_url_field(False, item, "systemOfRecords", dataset_name, errs, allow_redacted=True)
-
-                # theme #optional
-                if item.get("theme") is None or is_redacted(item.get("theme")):
-                    pass  # not required or REDACTED
-                elif not isinstance(item["theme"], list):
-                    add_error(errs, 50, "Invalid Field Value (Optional Fields)", "The field 'theme' must be an array.",
-                              dataset_name)
-                else:
-                    for s in item["theme"]:
-                        if not isinstance(s, (str, unicode)):
-                            add_error(errs, 50, "Invalid Field Value (Optional Fields)",
-                                      "Each value in the theme array must be a string", dataset_name)
-                        elif len(s.strip()) == 0:
-                            add_error(errs, 50, "Invalid Field Value (Optional Fields)",
-                                      "A value in the theme array was an empty string.", dataset_name)
-
-    # Form the output data.
+def format_errors(errs, errors_array):
+    """
+    Appends the errors of errs to errors_array, as (heading, [descriptions])
+    """
     for err_type in sorted(errs):
         errors_array.append((
             err_type[1],  # heading
@@ -461,7 +656,7 @@ def check_url_field(required, obj, field_name, dataset_name, errs, allow_redacte
     if not check_required_field(obj, field_name, (str, unicode), dataset_name,
                                 errs): return False  # just checking data type
     if allow_redacted and is_redacted(obj[field_name]): return True
-    if not rfc3987_url.match(obj[field_name]):
+    if not is_url(obj[field_name]):
         add_error(errs, 5, "Invalid Required Field Value",
                   "The '%s' field has an invalid rfc3987 URL: \"%s\"." % (field_name, obj[field_name]), dataset_name)
         return False
@@ -15,18 +15,23 @@ from ckanext.harvest.harvesters.base import HarvesterBase
 
 import uuid, datetime, hashlib, urllib2, json, json, os
 
-from jsonschema.validators import Draft4Validator
-from jsonschema import FormatChecker
-
+from sqlalchemy import and_
 from sqlalchemy.exc import IntegrityError
 
 from ckanext.datajson.helpers import reverse_accrual_periodicity_dict, \
                                      get_data_processor_json, \
                                      publisher_to_org
+from ckanext.datajson.schema_validator import get_schema_validator
 
 import logging
 log = logging.getLogger(__name__)
 
+# extras of the packages already harvested needed by gather_stage
+EXISTING_PACKAGE_EXTRAS = ('identifier', 'collection_metadata', 'source_hash')
+
+# key of the harvest object extra that keeps the state of the remote catalog, see get_remote_state
+REMOTE_STATE_KEY = 'datajson_remote'
+
 VALIDATION_SCHEMA = [
                         ('', 'Project Open Data (Federal)'),
                         ('non-federal', 'Project Open Data (Non-Federal)'),
@@ -50,6 +55,14 @@ def clean_tags(tags):
     return ret
 
 
+class RemoteCatalogNotModified(Exception):
+    """
+    Raised by load_remote_catalog when the server answers that the catalog has
+    not been modified since the last harvest
+    """
+    pass
+
+
 def validate_schema(schema):
     if schema not in [s[0] for s in VALIDATION_SCHEMA]:
         raise Invalid('Unknown validation schema: {0}'.format(schema))
@@ -61,6 +74,12 @@ class DatasetHarvesterBase(HarvesterBase):
     '''
     _user_name = None
 
+    # state of the remote catalog of the last harvest, if the current one can
+    # start from it (see get_remote_state), and of the current one, set by
+    # load_remote_catalog: {"etag", "last_modified", "body_hash"}
+    previous_remote_state = {}
+    remote_state = None
+
     # SUBCLASSES MUST IMPLEMENT
     #HARVESTER_VERSION = "1.0"
     #def info(self):
@@ -116,8 +135,67 @@ class DatasetHarvesterBase(HarvesterBase):
         # Loads a remote data catalog. This function must return a JSON-able
         # list of dicts, each dict a dataset containing an 'identifier' field
         # with a locally unique identifier string and a 'title' field.
+        # It may make a conditional request with the validators in
+        # self.previous_remote_state, raise RemoteCatalogNotModified on a 304,
+        # and set self.remote_state to be saved with the harvest objects.
         raise Exception("Not implemented")
 
+    def get_remote_state(self, harvest_job):
+        """
+        State of the remote catalog saved by the last harvest of the source
+        (see save_remote_state), if nothing has to be harvested again as long as
+        the catalog is the same: the objects of that harvest were all imported,
+        no collection run is pending and neither the source config nor the
+        harvester changed since
+        :return: dict, empty if the catalog must be harvested in full
+        """
+        source_config = json.loads(harvest_job.source.config or '{}')
+        if source_config.get('datajson_collection'):
+            return {}
+        extra = model.Session.query(HarvestObjectExtra.value) \
+            .join(HarvestObject, HarvestObject.id == HarvestObjectExtra.harvest_object_id) \
+            .join(HarvestJob, HarvestJob.id == HarvestObject.harvest_job_id) \
+            .filter(HarvestJob.source_id == harvest_job.source.id) \
+            .filter(HarvestObjectExtra.key == REMOTE_STATE_KEY) \
+            .order_by(HarvestJob.created.desc()) \
+            .first()
+        if not extra:
+            return {}
+        state = json.loads(extra.value)
+        if state.get('harvester_version') != self.HARVESTER_VERSION \
+                or state.get('config_hash') != self._source_config_hash(source_config):
+            return {}
+        unfinished = model.Session.query(HarvestObject.id) \
+            .filter(HarvestObject.harvest_job_id == state.get('job_id')) \
+            .filter(HarvestObject.state != 'COMPLETE') \
+            .count()
+        if unfinished:
+            return {}
+        return state
+
+    def save_remote_state(self, harvest_job, state, object_ids):
+        """
+        Saves state (see get_remote_state) as an extra of the first object
+        gathered by harvest_job, the source config is left as it is
+        :param object_ids: ids of the objects gathered by harvest_job, nothing
+            is saved if it is empty
+        """
+        if not object_ids:
+            return
+        source_config = json.loads(harvest_job.source.config or '{}')
+        HarvestObjectExtra(
+            harvest_object_id=object_ids[0], key=REMOTE_STATE_KEY,
+            value=json.dumps(dict(state, job_id=harvest_job.id,
+                                  harvester_version=self.HARVESTER_VERSION,
+                                  config_hash=self._source_config_hash(source_config)))).save()
+
+    @staticmethod
+    def _source_config_hash(source_config):
+        # the key updated by the harvests themselves is left out
+        return hashlib.sha1(json.dumps(dict(
+            (k, v) for k, v in source_config.iteritems() if k != 'datajson_collection'),
+            sort_keys=True)).hexdigest()
+
     def extra_schema(self):
         return {
             'validator_schema': [ignore_empty, unicode, validate_schema],
@@ -130,21 +208,49 @@ class DatasetHarvesterBase(HarvesterBase):
         log.debug('In %s gather_stage (%s)' % (repr(self), harvest_job.source.url))
 
         # Start gathering.
+        # source_datasets may be a list or a catalog streamed from the remote
+        # server (see DataJsonHarvester), parsed as it is iterated over: the
+        # first loop below reads the whole catalog (and fills catalog_values),
+        # the second one reads it again from a local copy.
+        parent_identifiers = set()
+        child_identifiers = set()
+        self.previous_remote_state = self.get_remote_state(harvest_job)
+        self.remote_state = None
         try:
             source_datasets, catalog_values = self.load_remote_catalog(harvest_job)
+
+            dataset_count = 0
+            for dataset in source_datasets:
+                dataset_count += 1
+                # collections only exist in catalogs, not in dataset arrays as in schema 1.0
+                parent_identifier = dataset.get('isPartOf') if isinstance(catalog_values, dict) else None
+                if parent_identifier:
+                    parent_identifiers.add(parent_identifier)
+                    child_identifiers.add(dataset.get('identifier'))
+        except RemoteCatalogNotModified:
+            log.info('Catalog at %s not modified since the last harvest', harvest_job.source.url)
+            return []
         except ValueError as e:
             self._save_gather_error("Error loading json content: %s." % (e), harvest_job)
             return []
+        log.info('Catalog read from %s: %d datasets found', harvest_job.source.url, dataset_count)
+
+        if self.remote_state is not None:
+            # the hash of a streamed catalog is known once it has been read
+            if getattr(source_datasets, 'body_hash', None):
+                self.remote_state['body_hash'] = source_datasets.body_hash
+            if self.remote_state.get('body_hash') \
+                    and self.remote_state['body_hash'] == self.previous_remote_state.get('body_hash'):
+                log.info('Catalog at %s identical to the last harvest', harvest_job.source.url)
+                return []
 
-        if len(source_datasets) == 0: return []
+        if dataset_count == 0: return []
 
         DATAJSON_SCHEMA = {
             "https://project-open-data.cio.gov/v1.1/schema": '1.1',
             }
 
         schema_version = '1.1'
-        parent_identifiers = set()
-        child_identifiers = set()
         catalog_extras = {}
         if isinstance(catalog_values, dict):
             schema_value = catalog_values.get('conformsTo', '')
@@ -155,12 +261,6 @@ class DatasetHarvesterBase(HarvesterBase):
                 return []
             schema_version = DATAJSON_SCHEMA.get(schema_value, '1.1')
 
-            for dataset in source_datasets:
-                parent_identifier = dataset.get('isPartOf')
-                if parent_identifier:
-                    parent_identifiers.add(parent_identifier)
-                    child_identifiers.add(dataset.get('identifier'))
-
             # get a list of needed catalog values and put into hobj
             catalog_fields = ['@context', '@id', 'conformsTo', 'describedBy']
             catalog_extras = dict(('catalog_'+k, v)
@@ -175,14 +275,9 @@ class DatasetHarvesterBase(HarvesterBase):
         existing_datasets = { }
         existing_parents = { }
         log.info('Reading previously harvested packages from this source')
-        for hobj in model.Session.query(HarvestObject).filter_by(source=harvest_job.source, current=True):
-            try:
-                pkg = get_action('package_show')(self.context(), { "id": hobj.package_id })
-            except:
-                # reference is broken
-                continue
-            sid = self.find_extra(pkg, "identifier")
-            is_parent = self.find_extra(pkg, "collection_metadata")
+        for pkg in self._existing_packages(harvest_job.source):
+            sid = pkg["identifier"]
+            is_parent = pkg["collection_metadata"]
             if sid:
                 log.info('Identifier: {} (ID:{})'.format(sid, pkg['id']))
                 existing_datasets[sid] = pkg
@@ -308,7 +403,7 @@ class DatasetHarvesterBase(HarvesterBase):
                 if pkg.get("state") == "active" \
                     and dataset['identifier'] not in existing_parents_demoted \
                     and dataset['identifier'] not in existing_datasets_promoted \
-                    and self.find_extra(pkg, "source_hash") == self.make_upstream_content_hash(dataset, harvest_job.source, catalog_extras, schema_version):
+                    and pkg["source_hash"] == self.make_upstream_content_hash(dataset, harvest_job.source, catalog_extras, schema_version):
                     log.info('Package {} don\'t need update. Leave'.format(pkg['id']))
                     continue
             else:
@@ -342,6 +437,7 @@ class DatasetHarvesterBase(HarvesterBase):
         for upstreamid, pkg in existing_datasets.items():
             if upstreamid in seen_datasets: continue # was just updated
             if pkg.get("state") == "deleted": continue # already deleted
+            pkg = get_action('package_show')(self.context(), { "id": pkg["id"] })
             pkg["state"] = "deleted"
             log.warn('deleting package %s (%s) because it is no longer in %s' % (pkg["name"], pkg["id"], harvest_job.source.url))
             get_action('package_update')(self.context(), pkg)
@@ -352,9 +448,39 @@ class DatasetHarvesterBase(HarvesterBase):
                 ) 
             obj.save()
             object_ids.append(obj.id)
-            
+
+        if self.remote_state is not None:
+            self.save_remote_state(harvest_job, self.remote_state, object_ids)
+
         return object_ids
 
+    @staticmethod
+    def _existing_packages(harvest_source):
+        """
+        Packages of the current harvest objects of the source, read with their
+        extras in one query instead of a package_show each
+        :return: list of dicts with the id, name and state of the packages and
+            the value of their EXISTING_PACKAGE_EXTRAS (None if not set)
+        """
+        rows = model.Session.query(Package.id, Package.name, Package.state,
+                                   model.PackageExtra.key, model.PackageExtra.value) \
+            .join(HarvestObject, HarvestObject.package_id == Package.id) \
+            .outerjoin(model.PackageExtra, and_(model.PackageExtra.package_id == Package.id,
+                                                model.PackageExtra.key.in_(EXISTING_PACKAGE_EXTRAS),
+                                                model.PackageExtra.state == 'active')) \
+            .filter(HarvestObject.harvest_source_id == harvest_source.id) \
+            .filter(HarvestObject.current == True)
+
+        packages = {}
+        for package_id, name, state, key, value in rows:
+            pkg = packages.get(package_id)
+            if pkg is None:
+                pkg = packages[package_id] = dict({"id": package_id, "name": name, "state": state},
+                                                  **dict.fromkeys(EXISTING_PACKAGE_EXTRAS))
+            if key:
+                pkg[key] = value
+        return packages.values()
+
     def fetch_stage(self, harvest_object):
         # Nothing to do in this stage because we captured complete
         # dataset metadata from the first request to the remote catalog file.
@@ -367,25 +493,21 @@ class DatasetHarvesterBase(HarvesterBase):
         raise Exception("Not implemented.")
 
     # validate dataset against POD schema
-    # use a local copy.
+    # use a local copy, compiled once per process.
     def _validate_dataset(self, validator_schema, schema_version, dataset):
         if validator_schema == 'non-federal':
             if schema_version == '1.1':
-                file_path = 'pod_schema/non-federal-v1.1/dataset-non-federal.json'
+                file_path = 'non-federal-v1.1/dataset-non-federal.json'
             else:
-                file_path = 'pod_schema/non-federal/single_entry.json'
+                file_path = 'non-federal/single_entry.json'
         else:
             if schema_version == '1.1':
-                file_path = 'pod_schema/federal-v1.1/dataset.json'
+                file_path = 'federal-v1.1/dataset.json'
             else:
-                file_path = 'pod_schema/single_entry.json'
-
-        with open(os.path.join(
-            os.path.dirname(__file__), file_path)) as json_file:
-            schema = json.load(json_file)
+                file_path = 'single_entry.json'
 
         msg = ";"
-        errors = Draft4Validator(schema, format_checker=FormatChecker()).iter_errors(dataset)
+        errors = get_schema_validator(file_path).iter_errors(dataset)
         count = 0
         for error in errors:
             count += 1
@@ -470,12 +592,13 @@ class DatasetHarvesterBase(HarvesterBase):
         # for clients with different data schemas we can define different "mapping_fields"
         mapping_fields_file = config.get('mapping_fields', None)
         
-        if mapping_fields_file is not None:
-            mapping_update = get_data_processor_json(filename=mapping_fields_file)
-            mapping_config['mapping_fields'].update(mapping_update)
-            
         # relation between previos fields
         mapping = mapping_config['mapping_fields']
+
+        if mapping_fields_file is not None:
+            # the loaded config is shared (and read-only), merge into a copy
+            mapping = dict(mapping)
+            mapping.update(get_data_processor_json(filename=mapping_fields_file))
         
         validator_schema = config.get('validator_schema')
         if schema_version == '1.0' and validator_schema != 'non-federal':
@@ -13,6 +13,8 @@ from ckan.lib.munge import munge_title_to_name
 import re
 import simplejson as json
 
+from registry import FrozenOrderedDict, json_files
+
 REDACTED_REGEX = re.compile(
     r'^(\[\[REDACTED).*?(\]\])$'
 )
@@ -112,9 +114,9 @@ def strip_if_string(val):
 
 def get_export_map_json(map_filename):
     """
-    Reading json export map from file
+    Reading json export map from file, parsed once per process (see registry.py)
     :param map_filename: str
-    :return: obj
+    :return: read-only obj
     """
     import os
 
@@ -124,17 +126,38 @@ def get_export_map_json(map_filename):
         log.warn("Could not find %s ! Please create it. Use samples from same folder", map_path)
         map_path = os.path.join(os.path.dirname(__file__), 'export_map', 'export.catalog.map.sample.json')
 
-    with open(map_path, 'r') as export_map_json:
-        json_export_map = json.load(export_map_json, object_pairs_hook=OrderedDict)
+    return json_files.get(map_path)
+
+
+# (export map, fingerprint) of the last export map fingerprinted
+_export_map_fingerprint = (None, None)
+
+
+def get_export_map_fingerprint(json_export_map):
+    """
+    Stable hash of an export map, changes whenever the map does. Computed once
+    per version of the export maps parsed by the registry (they can't change)
+    :param json_export_map: obj
+    :return: str
+    """
+    import hashlib
+    global _export_map_fingerprint
+
+    fingerprinted, fingerprint = _export_map_fingerprint
+    if fingerprinted is json_export_map:
+        return fingerprint
 
-    return json_export_map
+    fingerprint = hashlib.sha1(json.dumps(json_export_map, sort_keys=True)).hexdigest()
+    if isinstance(json_export_map, FrozenOrderedDict):
+        _export_map_fingerprint = (json_export_map, fingerprint)
+    return fingerprint
 
 
 def get_data_processor_json(filename):
     """
-    Reading json data processor from file
+    Reading json data processor from file, parsed once per process (see registry.py)
     :param filename: str
-    :return: obj
+    :return: read-only obj
     """
     import os
 
@@ -144,10 +167,7 @@ def get_data_processor_json(filename):
         log.warn("Could not find %s ! Please create it. Use samples from same folder", path)
         path = os.path.join(os.path.dirname(__file__), 'export_map', 'export.catalog.map.sample.json')
 
-    with open(path, 'r') as data:
-        data_json = json.load(data, object_pairs_hook=OrderedDict)
-
-    return data_json
+    return json_files.get(path)
 
 def detect_publisher(extras):
     """
@@ -180,15 +200,12 @@ def get_validator(schema_type="federal-v1.1"):
     """
     Get POD json validator object
     :param schema_type: str
-    :return: obj
+    :return: SchemaValidator, shared by the whole process
     """
     import os
-    from jsonschema import Draft4Validator, FormatChecker
+    from schema_validator import get_schema_validator
 
-    schema_path = os.path.join(os.path.dirname(__file__), 'pod_schema', schema_type, 'dataset.json')
-    with open(schema_path, 'r') as schema:
-        schema = json.loads(schema.read())
-        return Draft4Validator(schema, format_checker=FormatChecker())
+    return get_schema_validator(os.path.join(schema_type, 'dataset.json'))
 
 
 def uglify(key):
@@ -205,8 +222,10 @@ def uglify(key):
 def get_extra(package, key, default=None):
     """
     Retrieves the value of an extras field.
+    Builds the extras index of package on every call, use build_extras_index
+    to look up several keys of the same package.
     """
-    return packageExtraCache.get(package, key, default)
+    return strip_if_string(build_extras_index(package).get(uglify(key), default))
 
 
 def publisher_to_org(publisher_name, context):
@@ -228,47 +247,36 @@ def publisher_to_org(publisher_name, context):
     return org
 
 
-class PackageExtraCache:
-    def __init__(self):
-        self.pid = None
-        self.extras = {}
-        pass
+def build_extras_index(package):
+    """
+    Extras of package (extras_rollup included) by uglified key, with the
+    string values stripped. Build it once per package and look keys up with
+    uglify(key).
+    :param package: dict
+    :return: dict
+    """
+    import sys, os
 
-    def store(self, package):
-        import sys, os
-
-        try:
-            self.pid = package.get('id')
-
-            current_extras = package.get('extras', [])
-            new_extras = {}
-            for extra in current_extras:
-                if 'extras_rollup' == extra.get('key'):
-                    rolledup_extras = json.loads(extra.get('value'))
-                    for k, value in rolledup_extras.iteritems():
-                        if isinstance(value, (list, tuple)):
-                            value = ", ".join(map(unicode, value))
-                        new_extras[uglify(k)] = value
-                else:
-                    value = extra.get('value')
+    try:
+        extras = {}
+        for extra in package.get('extras', []):
+            if 'extras_rollup' == extra.get('key'):
+                rolledup_extras = json.loads(extra.get('value'))
+                for k, value in rolledup_extras.iteritems():
                     if isinstance(value, (list, tuple)):
                         value = ", ".join(map(unicode, value))
-                    new_extras[uglify(extra['key'])] = value
-
-            self.extras = new_extras
-        except Exception as e:
-            exc_type, exc_obj, exc_tb = sys.exc_info()
-            filename = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-            log.error("%s : %s : %s : %s", exc_type, filename, exc_tb.tb_lineno, unicode(e))
-            raise e
-
-    def get(self, package, key, default=None):
-        if self.pid != package.get('id'):
-            self.store(package)
-        return strip_if_string(self.extras.get(uglify(key), default))
-
-
-packageExtraCache = PackageExtraCache()
+                    extras[uglify(k)] = strip_if_string(value)
+            else:
+                value = extra.get('value')
+                if isinstance(value, (list, tuple)):
+                    value = ", ".join(map(unicode, value))
+                extras[uglify(extra['key'])] = strip_if_string(value)
+        return extras
+    except Exception as e:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        filename = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+        log.error("%s : %s : %s : %s", exc_type, filename, exc_tb.tb_lineno, unicode(e))
+        raise e
 
 # used by get_accrual_periodicity
 accrual_periodicity_dict = {
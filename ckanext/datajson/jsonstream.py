@@ -0,0 +1,373 @@
+import codecs
+import hashlib
+import json
+import re
+import tempfile
+import time
+
+# bytes read from the stream at a time
+CHUNK_SIZE = 64 * 1024
+# size up to which SpooledCatalog keeps a catalog in memory before going to disk
+SPOOL_SIZE = 16 * 1024 * 1024
+# charsets tried, in order, for the catalogs that are not valid utf-8
+FALLBACK_ENCODINGS = ('cp1252', 'iso-8859-1')
+
+WHITESPACE_REGEX = re.compile(r'[ \t\n\r]*')
+# next character that opens or closes a container or a string
+STRUCTURE_REGEX = re.compile(r'["{}\[\]]')
+# rest of a string, after its opening quote
+STRING_REST_REGEX = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+SCALAR_REGEX = re.compile(r'[^,:\[\]{}" \t\n\r]+')
+
+
+class JSONStreamError(ValueError):
+    pass
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+class BudgetReader(object):
+    """
+    File-like wrapper that raises BudgetExceeded once more than max_bytes
+    have been read or max_seconds have passed since it was created
+    """
+
+    def __init__(self, fileobj, max_bytes=None, max_seconds=None):
+        self._file = fileobj
+        self.max_bytes = max_bytes
+        self.bytes_read = 0
+        self.deadline = time.time() + max_seconds if max_seconds else None
+
+    def read(self, size=-1):
+        self.check_time()
+        data = self._file.read(size)
+        self.bytes_read += len(data)
+        if self.max_bytes and self.bytes_read > self.max_bytes:
+            raise BudgetExceeded('The file is larger than %d bytes.' % self.max_bytes)
+        return data
+
+    def check_time(self):
+        if self.deadline and time.time() > self.deadline:
+            raise BudgetExceeded('The file could not be read and validated within the time limit.')
+
+
+class JsonStream(object):
+    """
+    Incremental reader of the values of a JSON document. Only the value being
+    read is kept in memory, e.g. one dataset of a catalog at a time.
+    """
+
+    def __init__(self, fileobj, chunk_size=CHUNK_SIZE, encoding='utf-8-sig'):
+        self._file = fileobj
+        self._chunk_size = chunk_size
+        self._decoder = codecs.getincrementaldecoder(encoding)()
+        self._buf = u''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        """
+        Appends the next chunk to the buffer
+        :return: False at the end of the stream
+        """
+        if self._eof:
+            return False
+        data = self._file.read(self._chunk_size)
+        if data:
+            self._buf += self._decoder.decode(data)
+        else:
+            self._eof = True
+            self._buf += self._decoder.decode('', final=True)
+        return True
+
+    def _compact(self):
+        # drops what has been read already
+        if self._pos:
+            self._buf = self._buf[self._pos:]
+            self._pos = 0
+
+    def peek(self):
+        """
+        :return: next non-whitespace character, '' at the end of the document
+        """
+        while True:
+            self._pos = WHITESPACE_REGEX.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            self._compact()
+            if not self._fill():
+                return ''
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise JSONStreamError('Expecting %r, found %r' % (char, found or 'end of file'))
+        self._pos += 1
+
+    def read_value(self):
+        """
+        Parses the next value
+        """
+        text = self.read_text()
+        try:
+            return json.loads(text)
+        except ValueError as e:
+            raise JSONStreamError(unicode(e))
+
+    def read_text(self):
+        """
+        Moves past the next value, without parsing it. Its brackets and quotes
+        are matched, but it may still be invalid JSON.
+        :return: its JSON text
+        """
+        self._compact()
+        return self._scan_value()
+
+    def iter_array(self, raw=False):
+        """
+        Parses the next value, an array, one item at a time
+        :param raw: yield the JSON text of the items (see read_text) instead
+        """
+        read = self.read_text if raw else self.read_value
+        self.expect('[')
+        if self.peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield read()
+            char = self.peek()
+            if char == ',':
+                self._pos += 1
+            elif char == ']':
+                self._pos += 1
+                return
+            else:
+                raise JSONStreamError("Expecting ',' or ']' in array, found %r" % (char or 'end of file'))
+
+    def iter_object(self):
+        """
+        Parses the next value, an object, one member at a time
+        :return: iterator of (key, stream), the caller must read the value of
+            each member from stream (e.g. with read_value or iter_array)
+            before going on
+        """
+        self.expect('{')
+        if self.peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            if self.peek() != '"':
+                raise JSONStreamError('Expecting property name, found %r' % (self.peek() or 'end of file'))
+            key = self.read_value()
+            self.expect(':')
+            yield key, self
+            char = self.peek()
+            if char == ',':
+                self._pos += 1
+            elif char == '}':
+                self._pos += 1
+                return
+            else:
+                raise JSONStreamError("Expecting ',' or '}' in object, found %r" % (char or 'end of file'))
+
+    def expect_end(self):
+        if self.peek() != '':
+            raise JSONStreamError('Extra data after the end of the document')
+
+    def _scan_value(self):
+        """
+        Moves past the next value
+        :return: its JSON text
+        """
+        char = self.peek()
+        start = self._pos
+        if char == '':
+            raise JSONStreamError('Unexpected end of file')
+        elif char == '"':
+            end = self._scan_string(start + 1)
+        elif char in '{[':
+            end = self._scan_container(start + 1)
+        else:
+            end = self._scan_scalar(start)
+        self._pos = end
+        return self._buf[start:end]
+
+    def _scan_string(self, i):
+        while True:
+            match = STRING_REST_REGEX.match(self._buf, i)
+            if match:
+                return match.end()
+            if not self._fill():
+                raise JSONStreamError('Unterminated string')
+
+    def _scan_container(self, i):
+        depth = 1
+        while depth:
+            match = STRUCTURE_REGEX.search(self._buf, i)
+            if match is None:
+                i = len(self._buf)
+                if not self._fill():
+                    raise JSONStreamError('Unexpected end of file')
+                continue
+            char = match.group()
+            i = match.end()
+            if char == '"':
+                i = self._scan_string(i)
+            elif char in '{[':
+                depth += 1
+            else:
+                depth -= 1
+        return i
+
+    def _scan_scalar(self, i):
+        while True:
+            match = SCALAR_REGEX.match(self._buf, i)
+            end = match.end() if match else i
+            if end < len(self._buf) or not self._fill():
+                if end == i:
+                    raise JSONStreamError('Unexpected %r' % self._buf[i:i + 1])
+                return end
+
+
+def iter_catalog_datasets(fileobj, headers=None, chunk_size=CHUNK_SIZE, raw=False):
+    """
+    Parses a data.json catalog incrementally, keeping one dataset at a time in
+    memory
+    :param fileobj: file-like object with the catalog
+    :param headers: dict, receives the other members of the catalog
+    :param raw: yield the JSON text of the datasets instead, for the caller to
+        parse (see JsonStream.read_text)
+    :return: iterator of the items of the catalog's "dataset" array
+    :raises JSONStreamError: if the document is not a JSON object or is not
+        valid JSON (from where the error is, earlier datasets are yielded)
+    """
+    return _iter_stream_datasets(JsonStream(fileobj, chunk_size), headers, raw)
+
+
+def _iter_stream_datasets(stream, headers=None, raw=False):
+    if stream.peek() != '{':
+        raise JSONStreamError('The catalog must be a JSON object')
+    for key, value in stream.iter_object():
+        if key == 'dataset' and value.peek() == '[':
+            for dataset in value.iter_array(raw):
+                yield dataset
+        else:
+            member = value.read_value()
+            if headers is not None:
+                headers[key] = member
+    stream.expect_end()
+
+
+class SpooledCatalog(object):
+    """
+    data.json catalog read once from a file-like object (e.g. a response from
+    the remote server) and parsed one dataset at a time, as it is read.
+    The body is copied to a temporary file on the way, kept in memory while
+    small, so the datasets can be iterated over again without reading the
+    file-like object again.
+    Catalogs that are not valid utf-8 are decoded with the FALLBACK_ENCODINGS
+    instead.
+    """
+
+    def __init__(self, fileobj, spool_size=SPOOL_SIZE):
+        self._file = fileobj
+        self._spool = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        # whether the whole body has been copied to the spool
+        self._complete = False
+        self._sha1 = hashlib.sha1()
+        self.encoding = 'utf-8-sig'
+        # the stream of the first iteration, that reads from fileobj
+        self._stream = JsonStream(TeeReader(fileobj, self._write))
+        try:
+            first = self._stream.peek()
+        except UnicodeDecodeError:
+            self._fall_back()
+            first = self._stream.peek()
+        # members of the catalog other than "dataset", filled as the catalog is
+        # read; None if the catalog is an array of datasets (schema 1.0)
+        self.headers = None if first == '[' else {}
+
+    def __iter__(self):
+        """
+        :return: iterator of the datasets
+        :raises ValueError: if the catalog is not valid JSON or cannot be decoded
+        """
+        yielded = 0
+        while True:
+            stream, self._stream = self._stream or self._replay(), None
+            try:
+                # after a fall back to another charset, the datasets that were
+                # yielded already are skipped
+                for i, dataset in enumerate(self._iter_stream(stream)):
+                    if i >= yielded:
+                        yielded += 1
+                        yield dataset
+                self._complete = True
+                return
+            except UnicodeDecodeError:
+                self._fall_back()
+
+    @property
+    def body_hash(self):
+        """
+        sha1 of the body, None until it has been read entirely
+        """
+        return self._sha1.hexdigest() if self._complete else None
+
+    def _write(self, data):
+        self._sha1.update(data)
+        self._spool.write(data)
+
+    def _iter_stream(self, stream):
+        if self.headers is None:
+            for dataset in stream.iter_array():
+                yield dataset
+            stream.expect_end()
+        else:
+            for dataset in _iter_stream_datasets(stream, self.headers):
+                yield dataset
+
+    def _fall_back(self):
+        # switches to the next charset, and to the spool
+        if self.encoding in FALLBACK_ENCODINGS:
+            index = FALLBACK_ENCODINGS.index(self.encoding) + 1
+        else:
+            index = 0
+        if index == len(FALLBACK_ENCODINGS):
+            raise ValueError('Unable to decode the catalog. Charsets: utf8, %s' % ', '.join(FALLBACK_ENCODINGS))
+        self.encoding = FALLBACK_ENCODINGS[index]
+        self._stream = self._replay()
+
+    def _replay(self):
+        """
+        :return: JsonStream over the whole body, from the spool
+        """
+        if not self._complete:
+            self._spool.seek(0, 2)
+            for chunk in iter(lambda: self._file.read(CHUNK_SIZE), ''):
+                self._write(chunk)
+            self._complete = True
+        self._spool.seek(0)
+        if self.encoding != 'utf-8-sig' and self._spool.read(len(codecs.BOM_UTF8)) != codecs.BOM_UTF8:
+            self._spool.seek(0)
+        return JsonStream(self._spool, encoding=self.encoding)
+
+    def close(self):
+        self._spool.close()
+
+
+class TeeReader(object):
+    """
+    File-like object that passes what it reads from fileobj to write
+    """
+
+    def __init__(self, fileobj, write):
+        self._file = fileobj
+        self._write = write
+
+    def read(self, size=-1):
+        data = self._file.read(size)
+        self._write(data)
+        return data
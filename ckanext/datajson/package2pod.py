@@ -3,18 +3,26 @@ try:
 except ImportError:
     from sqlalchemy.util import OrderedDict
 
+import threading
 from logging import getLogger
 
 from helpers import *
 
 log = getLogger(__name__)
 
+# number of export maps Package2Pod.compile_export_map keeps plans for
+COMPILED_PLANS_SIZE = 8
+
+# extras keys looked up for every package, uglified (see build_extras_index)
+PUBLIC_ACCESS_LEVEL_KEY = uglify('public_access_level')
+REDACTED_TAG_STRING_KEY = uglify('redacted_tag_string')
+
 
 class Package2Pod:
     def __init__(self):
         pass
 
-    seen_identifiers = None
+    _compiled_plans = {}
 
     @staticmethod
     def wrap_json_catalog(dataset_dict, json_export_map):
@@ -24,6 +32,53 @@ class Package2Pod:
         )
         return catalog
 
+    @staticmethod
+    def serialize_dataset(dataset, indent=2, ensure_ascii=True):
+        """
+        Serializes a POD dataset the way it is nested inside the catalog's
+        'dataset' array, see iter_json_catalog
+        :param dataset: dict
+        :param indent: int, None for compact output
+        :param ensure_ascii: bool
+        :return: str
+        """
+        serialized = json.dumps(dataset, indent=indent, ensure_ascii=ensure_ascii)
+        if indent is None:
+            return serialized
+        return serialized.replace('\n', '\n' + ' ' * (2 * indent))
+
+    @staticmethod
+    def iter_json_catalog(fragments, json_export_map, indent=2, ensure_ascii=True):
+        """
+        Streaming counterpart of wrap_json_catalog + json.dumps: yields the catalog
+        headers first, then every dataset as soon as it is consumed from fragments
+        :param fragments: iterable of datasets serialized by serialize_dataset
+        :param json_export_map: obj
+        :param indent: int, None for compact output
+        :param ensure_ascii: bool
+        :return: generator of str
+        """
+        empty_catalog = json.dumps(Package2Pod.wrap_json_catalog([], json_export_map), indent=indent,
+                                   ensure_ascii=ensure_ascii)
+        # 'dataset' is always the last key of the catalog
+        head, tail = empty_catalog.rsplit('[]', 1)
+        yield head + '['
+
+        if indent is None:
+            separator, item_separator = '', ', '
+        else:
+            separator, item_separator = '\n' + ' ' * (2 * indent), ','
+        first = True
+        for fragment in fragments:
+            yield ('' if first else item_separator) + separator + fragment
+            first = False
+
+        if not first and indent is not None:
+            tail = '\n' + ' ' * indent + ']' + tail
+        else:
+            tail = ']' + tail
+        yield tail
+
     @staticmethod
     def filter(content):
         if not isinstance(content, (str, unicode)):
@@ -53,15 +108,20 @@ class Package2Pod:
         return content
 
     @staticmethod
-    def convert_package(package, json_export_map, redaction_enabled=False):
+    def convert_package(package, json_export_map, redaction_enabled=False, seen_identifiers=None):
+        """
+        :param seen_identifiers: SeenIdentifiers shared by the packages of one
+            export, for the duplicate identifiers check of the validator
+        """
         import sys, os
 
         try:
-            dataset = Package2Pod.export_map_fields(package, json_export_map, redaction_enabled)
+            context = ConversionContext(package, json_export_map, redaction_enabled, seen_identifiers)
+            dataset = Package2Pod.export_map_fields(package, json_export_map, redaction_enabled, context)
 
             # skip validation if we export whole /data.json catalog
             if json_export_map.get('validation_enabled'):
-                return Package2Pod.validate(package, dataset)
+                return Package2Pod.validate(package, dataset, context)
             else:
                 return dataset
         except Exception as e:
@@ -71,82 +131,51 @@ class Package2Pod:
             raise e
 
     @staticmethod
-    def export_map_fields(package, json_export_map, redaction_enabled=False):
-        import string
-        import sys, os
+    def compile_export_map(json_export_map):
+        """
+        Compiles the dataset_fields_map of an export map into a list of
+        (POD key, step) pairs, see _compile_field. Plans are kept for the
+        export map objects seen last, so a map is compiled once per export.
+        :param json_export_map: obj
+        :return: list
+        """
+        compiled = Package2Pod._compiled_plans.get(id(json_export_map))
+        # the map is kept along with its plan, so its id can't be reused meanwhile
+        if compiled and compiled[0] is json_export_map:
+            return compiled[1]
+
+        plan = [(key, _compile_field(key, field_map))
+                for key, field_map in json_export_map.get('dataset_fields_map').iteritems()]
+
+        if len(Package2Pod._compiled_plans) >= COMPILED_PLANS_SIZE:
+            Package2Pod._compiled_plans.clear()
+        Package2Pod._compiled_plans[id(json_export_map)] = (json_export_map, plan)
+        return plan
 
-        public_access_level = get_extra(package, 'public_access_level')
-        if not public_access_level or public_access_level not in ['non-public', 'restricted public']:
-            redaction_enabled = False
+    @staticmethod
+    def export_map_fields(package, json_export_map, redaction_enabled=False, context=None):
+        import sys, os
 
-        Wrappers.redaction_enabled = redaction_enabled
+        if context is None:
+            context = ConversionContext(package, json_export_map, redaction_enabled)
 
-        json_fields = json_export_map.get('dataset_fields_map')
+        public_access_level = context.extra(PUBLIC_ACCESS_LEVEL_KEY)
+        if not public_access_level or public_access_level not in ['non-public', 'restricted public']:
+            context.redaction_enabled = False
 
         try:
+            plan = Package2Pod.compile_export_map(json_export_map)
+
             dataset = OrderedDict([("@type", "dcat:Dataset")])
 
-            Wrappers.pkg = package
-            Wrappers.full_field_map = json_fields
-
-            for key, field_map in json_fields.iteritems():
-                # log.debug('%s => %s', key, field_map)
-
-                field_type = field_map.get('type', 'direct')
-                is_extra = field_map.get('extra')
-                array_key = field_map.get('array_key')
-                field = field_map.get('field')
-                split = field_map.get('split')
-                wrapper = field_map.get('wrapper')
-                default = field_map.get('default')
-
-                if redaction_enabled and field and 'publisher' != field and 'direct' != field_type:
-                    redaction_reason = get_extra(package, 'redacted_' + field, False)
-                    # keywords(tags) have some UI-related issues with this, so we'll check both versions here
-                    if not redaction_reason and 'tags' == field:
-                        redaction_reason = get_extra(package, 'redacted_tag_string', False)
-                    if redaction_reason:
-                        dataset[key] = '[[REDACTED-EX ' + redaction_reason + ']]'
-                        continue
-
-                if 'direct' == field_type and field:
-                    if is_extra:
-                        # log.debug('field: %s', field)
-                        # log.debug('value: %s', get_extra(package, field))
-                        dataset[key] = strip_if_string(get_extra(package, field, default))
-                    else:
-                        dataset[key] = strip_if_string(package.get(field, default))
-                    if redaction_enabled and 'publisher' != field:
-                        redaction_reason = get_extra(package, 'redacted_' + field, False)
-                        # keywords(tags) have some UI-related issues with this, so we'll check both versions here
-                        if redaction_reason:
-                            dataset[key] = Package2Pod.mask_redacted(dataset[key], redaction_reason)
-                            continue
-                    else:
-                        dataset[key] = Package2Pod.filter(dataset[key])
-
-                elif 'array' == field_type:
-                    if is_extra:
-                        found_element = strip_if_string(get_extra(package, field))
-                        if found_element:
-                            if is_redacted(found_element):
-                                dataset[key] = found_element
-                            elif split:
-                                dataset[key] = [Package2Pod.filter(x) for x in string.split(found_element, split)]
-
-                    else:
-                        if array_key:
-                            dataset[key] = [Package2Pod.filter(t[array_key]) for t in package.get(field, {})]
-                if wrapper:
-                    # log.debug('wrapper: %s', wrapper)
-                    method = getattr(Wrappers, wrapper)
-                    if method:
-                        Wrappers.current_field_map = field_map
-                        dataset[key] = method(dataset.get(key))
-
-            # CKAN doesn't like empty values on harvest, let's get rid of them
-            # Remove entries where value is None, "", or empty list []
-            dataset = OrderedDict([(x, y) for x, y in dataset.iteritems() if y is not None and y != "" and y != []])
+            for key, step in plan:
+                value = step(context, dataset)
+                # CKAN doesn't like empty values on harvest, let's get rid of them
+                # Remove entries where value is None, "", or empty list []
+                if value is not None and value != "" and value != []:
+                    dataset[key] = value
+                elif key in dataset:
+                    del dataset[key]
 
             return dataset
         except Exception as e:
@@ -156,10 +185,12 @@ class Package2Pod:
             raise e
 
     @staticmethod
-    def validate(pkg, dataset_dict):
+    def validate(pkg, dataset_dict, context=None):
         import sys, os
 
-        global currentPackageOrg
+        seen_identifiers = context.seen_identifiers if context else None
+        if seen_identifiers is None:
+            seen_identifiers = SeenIdentifiers()
 
         try:
             # When saved from UI DataQuality value is stored as "on" instead of True.
@@ -176,23 +207,20 @@ class Package2Pod:
             errors = []
             try:
                 from datajsonvalidator import do_validation
-                do_validation([dict(dataset_dict)], errors, Package2Pod.seen_identifiers)
+                do_validation([dict(dataset_dict)], errors, seen_identifiers)
             except Exception as e:
                 errors.append(("Internal Error", ["Something bad happened: " + unicode(e)]))
             if len(errors) > 0:
                 for error in errors:
                     log.warn(error)
 
-                try:
-                    currentPackageOrg
-                except NameError:
-                    currentPackageOrg = 'unknown'
+                current_package_org = context.current_package_org if context else None
 
                 errors_dict = OrderedDict([
                     ('id', pkg.get('id')),
                     ('name', Package2Pod.filter(pkg.get('name'))),
                     ('title', Package2Pod.filter(pkg.get('title'))),
-                    ('organization', Package2Pod.filter(currentPackageOrg)),
+                    ('organization', Package2Pod.filter(current_package_org or 'unknown')),
                     ('errors', errors),
                 ])
 
@@ -206,38 +234,95 @@ class Package2Pod:
             raise e
 
 
+class ConversionContext(object):
+    """
+    State of the conversion of one package, handed to the export steps and the
+    Wrappers, so that packages can be converted concurrently
+    """
+
+    def __init__(self, package, json_export_map, redaction_enabled=False, seen_identifiers=None):
+        self.pkg = package
+        self.full_field_map = json_export_map.get('dataset_fields_map')
+        self.redaction_enabled = redaction_enabled
+        # field map of the field being exported, for the wrappers
+        self.current_field_map = None
+        # publisher found by inventory_publisher, reported along with validation errors
+        self.current_package_org = None
+        self.seen_identifiers = seen_identifiers
+        # built once per package, looked up with uglified keys
+        self.extras = build_extras_index(package)
+
+    def extra(self, ugly_key, default=None):
+        """
+        Value of an extras field
+        :param ugly_key: uglify()ed key, see _compile_field
+        """
+        value = self.extras.get(ugly_key, _UNSET)
+        if value is _UNSET:
+            return strip_if_string(default)
+        return value
+
+    def get_extra(self, key, default=None):
+        return self.extra(_ugly_key(key), default)
+
+
+class SeenIdentifiers(object):
+    """
+    Thread-safe set of the dataset identifiers validated so far in an export
+    """
+
+    def __init__(self):
+        self._identifiers = set()
+        self._lock = threading.Lock()
+
+    def add_if_new(self, identifier):
+        """
+        :return: False if identifier was already there
+        """
+        with self._lock:
+            if identifier in self._identifiers:
+                return False
+            self._identifiers.add(identifier)
+            return True
+
+    def __contains__(self, identifier):
+        return identifier in self._identifiers
+
+    def add(self, identifier):
+        self.add_if_new(identifier)
+
+
 class Wrappers:
+    """
+    Value wrappers named by the export maps, called as wrapper(value, context)
+    with the ConversionContext of the package being converted
+    """
+
     def __init__(self):
         pass
 
-    redaction_enabled = False
-    pkg = None
-    current_field_map = None
-    full_field_map = None
     bureau_code_list = None
     resource_formats = None
 
     @staticmethod
-    def catalog_publisher(value):
+    def catalog_publisher(value, context):
         publisher = None
         if value:
             publisher = get_responsible_party(value)
-        if not publisher and 'organization' in Wrappers.pkg and 'title' in Wrappers.pkg.get('organization'):
-            publisher = Wrappers.pkg.get('organization').get('title')
+        if not publisher and 'organization' in context.pkg and 'title' in context.pkg.get('organization'):
+            publisher = context.pkg.get('organization').get('title')
         return OrderedDict([
             ("@type", "org:Organization"),
             ("name", publisher)
         ])
 
     @staticmethod
-    def inventory_publisher(value):
-        global currentPackageOrg
-
-        publisher = strip_if_string(get_extra(Wrappers.pkg, Wrappers.current_field_map.get('field')))
+    def inventory_publisher(value, context):
+        publisher = context.get_extra(context.current_field_map.get('field'))
         if publisher is None:
             return None
 
-        currentPackageOrg = publisher
+        context.current_package_org = publisher
 
         organization_list = list()
         organization_list.append([
@@ -247,15 +332,15 @@ class Wrappers:
 
         for i in range(1, 6):
             pub_key = 'publisher_' + str(i)  # e.g. publisher_1
-            if get_extra(Wrappers.pkg, pub_key):  # e.g. package.extras.publisher_1
+            if context.get_extra(pub_key):  # e.g. package.extras.publisher_1
                 organization_list.append([
                     ('@type', 'org:Organization'),  # optional
-                    ('name', Package2Pod.filter(get_extra(Wrappers.pkg, pub_key))),  # required
+                    ('name', Package2Pod.filter(context.get_extra(pub_key))),  # required
                 ])
-                currentPackageOrg = Package2Pod.filter(get_extra(Wrappers.pkg, pub_key))  # e.g. GSA
+                context.current_package_org = Package2Pod.filter(context.get_extra(pub_key))  # e.g. GSA
 
-        if Wrappers.redaction_enabled:
-            redaction_mask = get_extra(Wrappers.pkg, 'redacted_' + Wrappers.current_field_map.get('field'), False)
+        if context.redaction_enabled:
+            redaction_mask = context.get_extra('redacted_' + context.current_field_map.get('field'), False)
             if redaction_mask:
                 return OrderedDict(
                     [
@@ -279,41 +364,41 @@ class Wrappers:
         return OrderedDict(tree)
 
     @staticmethod
-    def fix_accrual_periodicity(frequency):
+    def fix_accrual_periodicity(frequency, context):
         return accrual_periodicity_dict.get(str(frequency).lower().strip(), frequency)
 
     @staticmethod
-    def build_contact_point(someValue):
+    def build_contact_point(someValue, context):
         import sys, os
 
         try:
-            contact_point_map = Wrappers.full_field_map.get('contactPoint').get('map')
+            contact_point_map = context.full_field_map.get('contactPoint').get('map')
             if not contact_point_map:
                 return None
 
-            package = Wrappers.pkg
+            package = context.pkg
 
             if contact_point_map.get('fn').get('extra'):
-                fn = get_extra(package, contact_point_map.get('fn').get('field'),
-                               get_extra(package, "Contact Name",
-                                         package.get('maintainer')))
+                fn = context.get_extra(contact_point_map.get('fn').get('field'),
+                                       context.get_extra("Contact Name",
+                                                         package.get('maintainer')))
             else:
                 fn = package.get(contact_point_map.get('fn').get('field'),
-                                 get_extra(package, "Contact Name",
-                                           package.get('maintainer')))
+                                 context.get_extra("Contact Name",
+                                                   package.get('maintainer')))
 
             fn = get_responsible_party(fn)
 
-            if Wrappers.redaction_enabled:
-                redaction_reason = get_extra(package, 'redacted_' + contact_point_map.get('fn').get('field'), False)
+            if context.redaction_enabled:
+                redaction_reason = context.get_extra('redacted_' + contact_point_map.get('fn').get('field'), False)
                 if redaction_reason:
                     fn = Package2Pod.mask_redacted(fn, redaction_reason)
             else:
                 fn = Package2Pod.filter(fn)
 
             if contact_point_map.get('hasEmail').get('extra'):
-                email = get_extra(package, contact_point_map.get('hasEmail').get('field'),
-                                  package.get('maintainer_email'))
+                email = context.get_extra(contact_point_map.get('hasEmail').get('field'),
+                                          package.get('maintainer_email'))
             else:
                 email = package.get(contact_point_map.get('hasEmail').get('field'),
                                     package.get('maintainer_email'))
@@ -321,9 +406,9 @@ class Wrappers:
             if email and not is_redacted(email) and '@' in email:
                 email = 'mailto:' + email
 
-            if Wrappers.redaction_enabled:
-                redaction_reason = get_extra(package, 'redacted_' + contact_point_map.get('hasEmail').get('field'),
-                                             False)
+            if context.redaction_enabled:
+                redaction_reason = context.get_extra('redacted_' + contact_point_map.get('hasEmail').get('field'),
+                                                     False)
                 if redaction_reason:
                     email = Package2Pod.mask_redacted(email, redaction_reason)
             else:
@@ -343,7 +428,7 @@ class Wrappers:
             raise e
 
     @staticmethod
-    def inventory_parent_uid(parent_dataset_id):
+    def inventory_parent_uid(parent_dataset_id, context):
         if parent_dataset_id:
             import ckan.model as model
 
@@ -354,40 +439,41 @@ class Wrappers:
         return parent_dataset_id
 
     @staticmethod
-    def generate_distribution(someValue):
+    def generate_distribution(someValue, context, resource_plan=None):
 
         arr = []
-        package = Wrappers.pkg
-
-        distribution_map = Wrappers.full_field_map.get('distribution').get('map')
-        if not distribution_map or 'resources' not in package:
+        package = context.pkg
+
+        if resource_plan is None:
+            distribution_map = context.full_field_map.get('distribution').get('map')
+            if not distribution_map:
+                return arr
+            resource_plan = _compile_distribution_map(distribution_map)
+        if 'resources' not in package:
             return arr
 
         for r in package["resources"]:
             resource = OrderedDict([('@type', "dcat:Distribution")])
 
-            for pod_key, json_map in distribution_map.iteritems():
-                value = strip_if_string(r.get(json_map.get('field'), json_map.get('default')))
+            for pod_key, field, redacted_field, default, method in resource_plan:
+                value = strip_if_string(r.get(field, default))
 
-                if Wrappers.redaction_enabled:
-                    if 'redacted_' + json_map.get('field') in r and r.get('redacted_' + json_map.get('field')):
-                        value = Package2Pod.mask_redacted(value, r.get('redacted_' + json_map.get('field')))
+                if context.redaction_enabled:
+                    if redacted_field in r and r.get(redacted_field):
+                        value = Package2Pod.mask_redacted(value, r.get(redacted_field))
                 else:
                     value = Package2Pod.filter(value)
 
                 # filtering/wrapping if defined by export_map
-                wrapper = json_map.get('wrapper')
-                if wrapper:
-                    method = getattr(Wrappers, wrapper)
-                    if method:
-                        value = method(value)
+                if method:
+                    value = method(value, context)
 
                 if value:
                     resource[pod_key] = value
 
             # inventory rules
             res_url = strip_if_string(r.get('url'))
-            if Wrappers.redaction_enabled:
+            if context.redaction_enabled:
                 if 'redacted_url' in r and r.get('redacted_url'):
                     res_url = '[[REDACTED-EX ' + r.get('redacted_url') + ']]'
             else:
@@ -418,13 +504,13 @@ class Wrappers:
         return arr
 
     @staticmethod
-    def bureau_code(value):
+    def bureau_code(value, context):
         if value:
             return value
 
-        if not 'organization' not in Wrappers.pkg or 'title' not in Wrappers.pkg.get('organization'):
+        if not 'organization' not in context.pkg or 'title' not in context.pkg.get('organization'):
             return None
-        org_title = Wrappers.pkg.get('organization').get('title')
+        org_title = context.pkg.get('organization').get('title')
         log.debug("org title: %s", org_title)
 
         code_list = Wrappers._get_bureau_code_list()
@@ -449,13 +535,15 @@ class Wrappers:
             "r"
         )
         code_list = json.load(bc_file)
-        Wrappers.bureau_code_list = {}
+        # built aside, other threads may be reading the list meanwhile
+        bureau_code_list = {}
         for bureau in code_list:
-            Wrappers.bureau_code_list[bureau['Agency']] = bureau
-        return Wrappers.bureau_code_list
+            bureau_code_list[bureau['Agency']] = bureau
+        Wrappers.bureau_code_list = bureau_code_list
+        return bureau_code_list
 
     @staticmethod
-    def mime_type_it(value):
+    def mime_type_it(value, context):
         if not value:
             return value
         formats = h.resource_formats()
@@ -467,3 +555,125 @@ class Wrappers:
         msg = value + ' ... BECOMES ... ' + mime_type
         log.debug(msg)
         return mime_type
+
+
+def _compile_field(key, field_map):
+    """
+    Builds the step exporting one POD field. Everything that only depends on
+    field_map (field type, extras or package field, redaction keys, wrapper) is
+    resolved here once, the step itself only reads the package.
+    A step is called as step(context, dataset) with the ConversionContext of the
+    package and returns the value of the field, None if it has none.
+    :param key: str, POD key
+    :param field_map: dict, entry of dataset_fields_map
+    :return: function
+    """
+    field_type = field_map.get('type', 'direct')
+    is_extra = field_map.get('extra')
+    array_key = field_map.get('array_key')
+    field = field_map.get('field')
+    split = field_map.get('split')
+    wrapper = field_map.get('wrapper')
+    default = field_map.get('default')
+
+    redacted_field = 'redacted_' + field if field else None
+    # extras are looked up by uglified key
+    field_key = uglify(field)
+    redacted_key = uglify(redacted_field)
+    # redacted fields are masked as a whole, except the direct ones (see below)
+    redact_field = bool(field) and 'publisher' != field and 'direct' != field_type
+    # keywords(tags) have some UI-related issues with this, so we'll check both versions here
+    redacted_tags = 'tags' == field
+
+    if 'direct' == field_type and field:
+        mask_direct = 'publisher' != field
+        if is_extra:
+            def read(context):
+                return context.extra(field_key, default)
+        else:
+            def read(context):
+                return strip_if_string(context.pkg.get(field, default))
+
+        def extract(context):
+            value = read(context)
+            if context.redaction_enabled and mask_direct:
+                redaction_reason = context.extra(redacted_key, False)
+                if redaction_reason:
+                    # masked values are not passed to the wrapper
+                    return Package2Pod.mask_redacted(value, redaction_reason), True
+                return value, False
+            return Package2Pod.filter(value), False
+
+    elif 'array' == field_type and is_extra:
+        def extract(context):
+            found_element = context.extra(field_key)
+            if found_element:
+                if is_redacted(found_element):
+                    return found_element, False
+                elif split:
+                    return [Package2Pod.filter(x) for x in found_element.split(split)], False
+            return _UNSET, False
+
+    elif 'array' == field_type and array_key:
+        def extract(context):
+            return [Package2Pod.filter(t[array_key]) for t in context.pkg.get(field, {})], False
+
+    else:
+        def extract(context):
+            return _UNSET, False
+
+    method = getattr(Wrappers, wrapper) if wrapper else None
+    # generate_distribution always reads the map of the 'distribution' field
+    if 'generate_distribution' == wrapper and 'distribution' == key and field_map.get('map'):
+        resource_plan = _compile_distribution_map(field_map.get('map'))
+
+        def method(value, context):
+            return Wrappers.generate_distribution(value, context, resource_plan)
+
+    def step(context, dataset):
+        if context.redaction_enabled and redact_field:
+            redaction_reason = context.extra(redacted_key, False)
+            if not redaction_reason and redacted_tags:
+                redaction_reason = context.extra(REDACTED_TAG_STRING_KEY, False)
+            if redaction_reason:
+                return '[[REDACTED-EX ' + redaction_reason + ']]'
+
+        value, final = extract(context)
+        if value is _UNSET:
+            value = dataset.get(key)
+        if method and not final:
+            context.current_field_map = field_map
+            value = method(value, context)
+        return value
+
+    return step
+
+
+def _compile_distribution_map(distribution_map):
+    """
+    Resolves the resource fields, redaction keys and wrappers of the
+    distribution map for Wrappers.generate_distribution
+    :param distribution_map: dict
+    :return: list of (POD key, field, redaction field, default, wrapper) tuples
+    """
+    resource_plan = []
+    for pod_key, json_map in distribution_map.iteritems():
+        field = json_map.get('field')
+        wrapper = json_map.get('wrapper')
+        resource_plan.append((pod_key, field, 'redacted_' + field, json_map.get('default'),
+                              getattr(Wrappers, wrapper) if wrapper else None))
+    return resource_plan
+
+
+# marks the fields a step did not set
+_UNSET = object()
+# uglified keys of the lookups made by the wrappers, the keys come from the
+# export maps so this stays small
+_ugly_keys = {}
+
+
+def _ugly_key(key):
+    ugly_key = _ugly_keys.get(key)
+    if ugly_key is None:
+        ugly_key = _ugly_keys[key] = uglify(key)
+    return ugly_key
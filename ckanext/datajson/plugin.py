@@ -1,9 +1,18 @@
+import Queue
 import StringIO
+import array
+import collections
+import datetime
+import hashlib
+import heapq
+import itertools
 import json
 import logging
 import sys
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
 
-import ckan.lib.dictization.model_dictize as model_dictize
 import ckan.model as model
 import ckan.plugins as p
 import os
@@ -11,13 +20,30 @@ import re
 from ckan.lib.base import BaseController, render, c
 from jsonschema.exceptions import best_match
 from pylons import request, response
+from sqlalchemy import func
 from logging import getLogger
-from helpers import get_export_map_json, detect_publisher, get_validator
-from package2pod import Package2Pod
+from helpers import get_export_map_json, get_export_map_fingerprint, detect_publisher, get_validator
+from bulk_dictize import package_list_dictize
+from cache import LRUCache
+from package2pod import Package2Pod, SeenIdentifiers
+from snapshot import CatalogSnapshot, iter_file
 from ckanext.harvest.log import DBLogHandler
 
 logger = logging.getLogger(__name__)
-draft4validator = get_validator()
+pod_validator = get_validator()
+
+# size up to which zipped inventories are kept in memory before going to disk
+ZIP_SPOOL_SIZE = 16 * 1024 * 1024
+
+# default limits of a /pod/validate run
+VALIDATOR_MAX_BYTES = 100 * 1024 * 1024
+VALIDATOR_MAX_SECONDS = 120
+# /pod/validate results kept by hash of the catalog (and the last version of as many URLs),
+# and errors kept by hash of the dataset
+VALIDATION_RESULTS_CACHE_SIZE = 100
+VALIDATED_DATASETS_CACHE_SIZE = 50000
+# flag in the info of a session whose changes make the data.json snapshots stale
+CATALOG_CHANGED = 'datajson_catalog_changed'
 
 try:
     from collections import OrderedDict  # 2.7
@@ -29,6 +55,9 @@ class DataJsonPlugin(p.SingletonPlugin):
     p.implements(p.interfaces.IConfigurer)
     p.implements(p.ITemplateHelpers)
     p.implements(p.interfaces.IRoutes, inherit=True)
+    p.implements(p.IPackageController, inherit=True)
+    p.implements(p.IOrganizationController, inherit=True)
+    p.implements(p.ISession, inherit=True)
 
     def configure(self, config):
 
@@ -56,6 +85,21 @@ class DataJsonPlugin(p.SingletonPlugin):
 
         DataJsonPlugin.inventory_links_enabled = config.get("ckanext.datajson.inventory_links_enabled",
                                                             "False") == 'True'
+        DataJsonPlugin.streaming_enabled = config.get("ckanext.datajson.streaming", "False") == 'True'
+        DataJsonPlugin.search_rows = p.toolkit.asint(config.get("ckanext.datajson.search_rows", 500))
+        DataJsonPlugin.export_threads = p.toolkit.asint(config.get("ckanext.datajson.export_threads", 1))
+        DataJsonPlugin.validator_max_bytes = p.toolkit.asint(config.get("ckanext.datajson.validator_max_bytes",
+                                                                        VALIDATOR_MAX_BYTES))
+        DataJsonPlugin.validator_max_seconds = p.toolkit.asint(config.get("ckanext.datajson.validator_max_seconds",
+                                                                          VALIDATOR_MAX_SECONDS))
+        snapshot_dir = config.get("ckanext.datajson.snapshot_dir")
+        DataJsonPlugin.snapshot = CatalogSnapshot(snapshot_dir) if snapshot_dir else None
+        fragment_cache_size = p.toolkit.asint(config.get("ckanext.datajson.fragment_cache_size", 0))
+        DataJsonPlugin.fragment_cache = LRUCache(fragment_cache_size) if fragment_cache_size > 0 else None
+        DataJsonPlugin.validation_results = LRUCache(VALIDATION_RESULTS_CACHE_SIZE)
+        DataJsonPlugin.validated_catalogs = LRUCache(VALIDATION_RESULTS_CACHE_SIZE)
+        DataJsonPlugin.validated_datasets = LRUCache(p.toolkit.asint(
+            config.get("ckanext.datajson.validator_cache_size", VALIDATED_DATASETS_CACHE_SIZE)))
 
         # Adds our local templates directory. It's smart. It knows it's
         # relative to the path of *this* file. Wow.
@@ -73,6 +117,54 @@ class DataJsonPlugin(p.SingletonPlugin):
     def before_map(self, m):
         return m
 
+    # IPackageController: any change to a dataset makes the data.json snapshots stale
+
+    def after_create(self, context, pkg_dict):
+        self._invalidate_snapshot(pkg_dict)
+
+    def after_update(self, context, pkg_dict):
+        self._invalidate_snapshot(pkg_dict)
+
+    def after_delete(self, context, pkg_dict):
+        self._invalidate_snapshot(pkg_dict)
+
+    @staticmethod
+    def _invalidate_snapshot(pkg_dict):
+        if not DataJsonPlugin.snapshot:
+            return
+        if pkg_dict.get('type', 'dataset') != 'dataset':
+            # harvest sources and other types are not exported
+            return
+        _catalog_changed()
+
+    # IOrganizationController: organizations are part of the exported datasets (publisher, bureau code)
+
+    def create(self, entity):
+        self._invalidate_organization(entity)
+
+    def edit(self, entity):
+        self._invalidate_organization(entity)
+
+    def delete(self, entity):
+        self._invalidate_organization(entity)
+
+    @staticmethod
+    def _invalidate_organization(entity):
+        # IPackageController has hooks of the same names, packages are handled by after_create & co
+        if DataJsonPlugin.snapshot and isinstance(entity, model.Group):
+            _catalog_changed()
+
+    # ISession: the hooks above run before the change is committed and indexed,
+    # the snapshots are dropped only once it is, so a build that starts in
+    # between can't publish a catalog without the change
+
+    def after_commit(self, session):
+        if session.info.pop(CATALOG_CHANGED, False) and DataJsonPlugin.snapshot:
+            DataJsonPlugin.snapshot.invalidate()
+
+    def after_rollback(self, session):
+        session.info.pop(CATALOG_CHANGED, None)
+
     def after_map(self, m):
         if DataJsonPlugin.route_enabled:
             # /data.json and /data.jsonld (or other path as configured by user)
@@ -210,9 +302,54 @@ class DataJsonController(BaseController):
         del response.headers["Cache-Control"]
         del response.headers["Pragma"]
 
+        json_export_map = get_export_map_json(DataJsonPlugin.map_filename) if fmt == 'json' else None
+        snapshot = DataJsonPlugin.snapshot if json_export_map else None
+        snapshot_file = None
+        snapshot_gzipped = False
+        # read before the version, a change committed from now on makes the build stale
+        generation = snapshot.current_generation() if snapshot else None
+        etag = _catalog_version(org_id, json_export_map) if json_export_map else None
+
+        if snapshot:
+            response.headers['Vary'] = 'Accept-Encoding'
+            # the snapshots hold the version they were built for, a snapshot of
+            # an older version (e.g. before a change indexed but not committed
+            # yet) is never served under the current ETag
+            snapshot_key = 'org-' + org_id if org_id else 'catalog'
+            snapshot_version = etag.strip('"')
+            if _accepts_gzip():
+                snapshot_file = snapshot.open(snapshot_key, snapshot_version, gzipped=True)
+                snapshot_gzipped = bool(snapshot_file)
+            if not snapshot_file:
+                snapshot_file = snapshot.open(snapshot_key, snapshot_version)
+
+        if etag:
+            # the gzipped snapshot is a representation of its own
+            response.headers['ETag'] = _gzip_etag(etag) if snapshot_gzipped else etag
+            if _not_modified(etag):
+                # the client's copy is current, no need to export anything
+                if snapshot_file:
+                    snapshot_file.close()
+                response.status_int = 304
+                return ''
+
+        if snapshot_file:
+            if snapshot_gzipped:
+                # compressed once when the snapshot was built, sent as is
+                response.headers['Content-Encoding'] = 'gzip'
+            response.content_length = os.fstat(snapshot_file.fileno()).st_size
+            return iter_file(snapshot_file)
+
+        if DataJsonPlugin.streaming_enabled and fmt == 'json':
+            # chunked response, datasets are written as soon as they are converted
+            chunks = self.stream_json(owner_org=org_id)
+            if snapshot:
+                chunks = snapshot.tee(snapshot_key, snapshot_version, chunks, generation)
+            return chunks
+
         # TODO special processing for enterprise
         # output
-        data = self.make_json(export_type='datajson', owner_org=org_id)
+        body = self.make_json(export_type='datajson', owner_org=org_id)
 
         # if fmt == 'json-ld':
         #     # Convert this to JSON-LD.
@@ -230,7 +367,45 @@ class DataJsonController(BaseController):
         #         ("foaf:homepage", DataJsonPlugin.site_url),
         #         ("dcat:dataset", [dataset_to_jsonld(d) for d in data.get('dataset')]),
         #     ])
-        return p.toolkit.literal(json.dumps(data, indent=2))
+        if not body:
+            # no export map or the export failed, logged by make_json
+            return p.toolkit.literal(json.dumps(''))
+        if snapshot:
+            snapshot.save(snapshot_key, snapshot_version, body, generation)
+        return p.toolkit.literal(body)
+
+    def stream_json(self, owner_org=None):
+        """
+        Generates the public data.json catalog chunk by chunk, keeping at most
+        one page of search results in memory.
+        """
+        try:
+            json_export_map = get_export_map_json(DataJsonPlugin.map_filename)
+            if not json_export_map:
+                # same body as generate_output gives without streaming
+                yield json.dumps('')
+                return
+
+            packages = DataJsonController._iter_ckan_datasets(org=owner_org)
+            if owner_org:
+                packages = _peek(packages)
+                if packages is None:
+                    # we didn't check ownership for this type of export, so never load private datasets here
+                    packages = self.get_packages(owner_org=owner_org, with_private=False)
+
+            fragments = self._iter_datajson_fragments(packages, json_export_map)
+            for chunk in Package2Pod.iter_json_catalog(fragments, json_export_map):
+                yield chunk
+        except Exception as e:
+            # headers are already sent, all we can do is to abort the response so
+            # that the client (and the snapshot, if any) sees it as incomplete
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+            filename = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+            logger.error("%s : %s : %s : %s", exc_type, filename, exc_tb.tb_lineno, unicode(e))
+            raise
+        finally:
+            # the response body is produced after the controller has returned
+            model.Session.remove()
 
     def make_json(self, export_type='datajson', owner_org=None):
         # Error handler for creating error log
@@ -242,17 +417,15 @@ class DataJsonController(BaseController):
         logger.addHandler(eh)
 
         data = ''
-        output = []
         errors_json = []
-        Package2Pod.seen_identifiers = set()
 
         try:
             # Build the data.json file.
             if owner_org:
                 if 'datajson' == export_type:
                     # we didn't check ownership for this type of export, so never load private datasets here
-                    packages = DataJsonController._get_ckan_datasets(org=owner_org)
-                    if not packages:
+                    packages = _peek(DataJsonController._iter_ckan_datasets(org=owner_org))
+                    if packages is None:
                         packages = self.get_packages(owner_org=owner_org, with_private=False)
                 else:
                     packages = self.get_packages(owner_org=owner_org, with_private=True)
@@ -260,69 +433,21 @@ class DataJsonController(BaseController):
                 # TODO: load data by pages
                 # packages = p.toolkit.get_action("current_package_list_with_resources")(
                 # None, {'limit': 50, 'page': 300})
-                packages = DataJsonController._get_ckan_datasets()
+                packages = DataJsonController._iter_ckan_datasets()
                 # packages = p.toolkit.get_action("current_package_list_with_resources")(None, {})
 
             json_export_map = get_export_map_json(DataJsonPlugin.map_filename)
 
             if json_export_map:
-                for pkg in packages:
-                    if json_export_map.get('debug'):
-                        output.append(pkg)
-                    # logger.error('package: %s', json.dumps(pkg))
-                    # logger.debug("processing %s" % (pkg.get('title')))
-                    extras = dict([(x['key'], x['value']) for x in pkg.get('extras', {})])
-
-                    # unredacted = all non-draft datasets (public + private)
-                    # redacted = public-only, non-draft datasets
-                    if export_type in ['unredacted', 'redacted']:
-                        if 'Draft' == extras.get('publishing_status'):
-                            # publisher = detect_publisher(extras)
-                            # logger.warn("Dataset id=[%s], title=[%s], organization=[%s] omitted (%s)\n",
-                            #             pkg.get('id'), pkg.get('title'), publisher,
-                            #             'publishing_status: Draft')
-                            # self._errors_json.append(OrderedDict([
-                            #     ('id', pkg.get('id')),
-                            #     ('name', pkg.get('name')),
-                            #     ('title', pkg.get('title')),
-                            #     ('errors', [(
-                            #         'publishing_status: Draft',
-                            #         [
-                            #             'publishing_status: Draft'
-                            #         ]
-                            #     )])
-                            # ]))
-
-                            continue
-                            # if 'redacted' == export_type and re.match(r'[Nn]on-public', extras.get('public_access_level')):
-                            #     continue
-                    # draft = all draft-only datasets
-                    elif 'draft' == export_type:
-                        if 'publishing_status' not in extras.keys() or extras.get('publishing_status') != 'Draft':
-                            continue
-
-                    redaction_enabled = ('redacted' == export_type)
-                    datajson_entry = Package2Pod.convert_package(pkg, json_export_map, redaction_enabled)
-                    errors = None
-                    if 'errors' in datajson_entry.keys():
-                        errors_json.append(datajson_entry)
-                        errors = datajson_entry.get('errors')
-                        datajson_entry = None
-
-                    if datajson_entry and \
-                            (not json_export_map.get('validation_enabled') or self.is_valid(datajson_entry)):
-                        # logger.debug("writing to json: %s" % (pkg.get('title')))
-                        output.append(datajson_entry)
-                    else:
-                        publisher = detect_publisher(extras)
-                        if errors:
-                            logger.warn("Dataset id=[%s], title=[%s], organization=[%s] omitted, reason below:\n\t%s\n",
-                                        pkg.get('id', None), pkg.get('title', None), publisher, errors)
-                        else:
-                            logger.warn("Dataset id=[%s], title=[%s], organization=[%s] omitted, reason above.\n",
-                                        pkg.get('id', None), pkg.get('title', None), publisher)
-
-                data = Package2Pod.wrap_json_catalog(output, json_export_map)
+                if 'datajson' == export_type:
+                    # the public catalog is assembled from serialized (and possibly cached) datasets
+                    fragments = self._iter_datajson_fragments(packages, json_export_map)
+                    data = ''.join(Package2Pod.iter_json_catalog(fragments, json_export_map))
+                else:
+                    # inventories are written to disk entry by entry and zipped from there
+                    entries = self._iter_datajson_entries(packages, json_export_map, export_type, errors_json,
+                                                          SeenIdentifiers())
+                    data = self._write_json_catalog(entries, json_export_map)
         except Exception as e:
             exc_type, exc_obj, exc_tb = sys.exc_info()
             filename = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
@@ -340,53 +465,216 @@ class DataJsonController(BaseController):
 
         return self.write_zip(data, error, errors_json, zip_name=export_type)
 
+    def _iter_datajson_fragments(self, packages, json_export_map):
+        """
+        Serialized public data.json entries, see Package2Pod.serialize_dataset.
+        Entries of packages that did not change since they were last exported are
+        taken from the fragment cache instead of being converted again. Only the
+        entries that passed validation (if enabled) are cached, along with their
+        identifier for the duplicate identifiers check.
+        """
+        for fragment, identifier in self._iter_identified_fragments(packages, json_export_map):
+            yield fragment
+
+    def _iter_identified_fragments(self, packages, json_export_map):
+        """
+        Same as _iter_datajson_fragments, along with the identifier of each entry
+        :return: generator of (serialized entry, identifier)
+        """
+        cache = DataJsonPlugin.fragment_cache
+        if json_export_map.get('debug'):
+            # debug output is the whole package
+            cache = None
+        fingerprint = get_export_map_fingerprint(json_export_map) if cache is not None else None
+        seen_identifiers = SeenIdentifiers()
+
+        for pkg in packages:
+            if cache is None:
+                for datajson_entry in self._iter_datajson_entries([pkg], json_export_map,
+                                                                  seen_identifiers=seen_identifiers):
+                    yield Package2Pod.serialize_dataset(datajson_entry), datajson_entry.get('identifier')
+                continue
+
+            # organizations are indexed along with their datasets and can change on their own
+            organization = pkg.get('organization') or {}
+            key = (pkg.get('id'), pkg.get('metadata_modified'), organization.get('revision_id'),
+                   organization.get('name'), organization.get('title'), fingerprint)
+            cached = cache.get(key)
+            if cached is None:
+                for datajson_entry in self._iter_datajson_entries([pkg], json_export_map,
+                                                                  seen_identifiers=seen_identifiers):
+                    cached = (Package2Pod.serialize_dataset(datajson_entry), datajson_entry.get('identifier'))
+                    cache.set(key, cached)
+            elif json_export_map.get('validation_enabled') and not seen_identifiers.add_if_new(cached[1]):
+                # valid on its own, but another dataset of this export has the same identifier
+                logger.warn("Dataset id=[%s], title=[%s], organization=[%s] omitted, reason below:\n\t%s\n",
+                            pkg.get('id', None), pkg.get('title', None),
+                            detect_publisher(dict([(x['key'], x['value']) for x in pkg.get('extras', {})])),
+                            'The dataset identifier "%s" is used more than once.' % cached[1])
+                continue
+            if cached is not None:
+                yield cached
+
+    def _iter_datajson_entries(self, packages, json_export_map, export_type='datajson', errors_json=None,
+                               seen_identifiers=None):
+        """
+        Converts CKAN packages to data.json entries one at a time, skipping the ones
+        that do not belong to export_type or fail conversion/validation.
+        Conversion errors are collected into errors_json.
+        :param seen_identifiers: SeenIdentifiers of the whole export, for the
+            duplicate identifiers check of the validator
+        """
+        if errors_json is None:
+            errors_json = []
+        if seen_identifiers is None:
+            seen_identifiers = SeenIdentifiers()
+
+        for pkg in packages:
+            if json_export_map.get('debug'):
+                yield pkg
+            # logger.error('package: %s', json.dumps(pkg))
+            # logger.debug("processing %s" % (pkg.get('title')))
+            extras = dict([(x['key'], x['value']) for x in pkg.get('extras', {})])
+
+            # unredacted = all non-draft datasets (public + private)
+            # redacted = public-only, non-draft datasets
+            if export_type in ['unredacted', 'redacted']:
+                if 'Draft' == extras.get('publishing_status'):
+                    # publisher = detect_publisher(extras)
+                    # logger.warn("Dataset id=[%s], title=[%s], organization=[%s] omitted (%s)\n",
+                    #             pkg.get('id'), pkg.get('title'), publisher,
+                    #             'publishing_status: Draft')
+                    # self._errors_json.append(OrderedDict([
+                    #     ('id', pkg.get('id')),
+                    #     ('name', pkg.get('name')),
+                    #     ('title', pkg.get('title')),
+                    #     ('errors', [(
+                    #         'publishing_status: Draft',
+                    #         [
+                    #             'publishing_status: Draft'
+                    #         ]
+                    #     )])
+                    # ]))
+
+                    continue
+                    # if 'redacted' == export_type and re.match(r'[Nn]on-public', extras.get('public_access_level')):
+                    #     continue
+            # draft = all draft-only datasets
+            elif 'draft' == export_type:
+                if 'publishing_status' not in extras.keys() or extras.get('publishing_status') != 'Draft':
+                    continue
+
+            redaction_enabled = ('redacted' == export_type)
+            datajson_entry = Package2Pod.convert_package(pkg, json_export_map, redaction_enabled,
+                                                         seen_identifiers)
+            errors = None
+            if 'errors' in datajson_entry.keys():
+                errors_json.append(datajson_entry)
+                errors = datajson_entry.get('errors')
+                datajson_entry = None
+
+            if datajson_entry and \
+                    (not json_export_map.get('validation_enabled') or self.is_valid(datajson_entry)):
+                # logger.debug("writing to json: %s" % (pkg.get('title')))
+                yield datajson_entry
+            else:
+                publisher = detect_publisher(extras)
+                if errors:
+                    logger.warn("Dataset id=[%s], title=[%s], organization=[%s] omitted, reason below:\n\t%s\n",
+                                pkg.get('id', None), pkg.get('title', None), publisher, errors)
+                else:
+                    logger.warn("Dataset id=[%s], title=[%s], organization=[%s] omitted, reason above.\n",
+                                pkg.get('id', None), pkg.get('title', None), publisher)
+
     def get_packages(self, owner_org, with_private=True):
-        # Build the data.json file.
-        packages = self.get_all_group_packages(group_id=owner_org, with_private=with_private)
-        # get packages for sub-agencies.
-        sub_agency = model.Group.get(owner_org)
-        if 'sub-agencies' in sub_agency.extras.col.target \
-                and sub_agency.extras.col.target['sub-agencies'].state == 'active':
-            sub_agencies = sub_agency.extras.col.target['sub-agencies'].value
-            sub_agencies_list = sub_agencies.split(",")
-            for sub in sub_agencies_list:
-                sub_packages = self.get_all_group_packages(group_id=sub, with_private=with_private)
-                for sub_package in sub_packages:
-                    packages.append(sub_package)
-
-        return packages
+        """
+        Yields the packages of owner_org, then the ones of its sub-agencies,
+        each package once. With export_threads > 1 the organizations are
+        loaded side by side, in order.
+        """
+        group_ids = _organization_group_ids(owner_org)
+
+        threads = min(DataJsonPlugin.export_threads, len(group_ids))
+        if threads > 1:
+            pool = ThreadPool(threads)
+            results = _imap_ahead(pool, self._get_all_group_packages_in_thread,
+                                  [(group_id, with_private) for group_id in group_ids], threads)
+        else:
+            pool = None
+            results = (self.get_all_group_packages(group_id=group_id, with_private=with_private)
+                       for group_id in group_ids)
+
+        seen_ids = set()
+        try:
+            for packages in results:
+                for pkg in packages:
+                    # sub-agencies can share datasets with their parent
+                    if pkg['id'] in seen_ids:
+                        continue
+                    seen_ids.add(pkg['id'])
+                    yield pkg
+        finally:
+            if pool:
+                pool.terminate()
+
+    def _get_all_group_packages_in_thread(self, args):
+        group_id, with_private = args
+        try:
+            return self.get_all_group_packages(group_id=group_id, with_private=with_private)
+        finally:
+            # every thread gets its own session from the scoped session registry
+            model.Session.remove()
 
     def get_all_group_packages(self, group_id, with_private=True):
         """
         Gets all of the group packages, public or private, returning them as a list of CKAN's dictized packages.
         """
-        result = []
-
-        for pkg_rev in model.Group.get(group_id).packages(with_private=with_private, context={'user_is_admin': True}):
-            result.append(model_dictize.package_dictize(pkg_rev, {'model': model}))
-
-        return result
+        packages = _group_packages_query(group_id, with_private).all()
+        # related tables are loaded for many packages at once, not package by package
+        return package_list_dictize(packages, {'model': model})
 
     def is_valid(self, instance):
         """
         Validates a data.json entry against the project open data's JSON schema.
         Log a warning message on validation error
         """
-        error = best_match(draft4validator.iter_errors(instance))
+        if pod_validator.is_valid(instance):
+            return True
+        error = best_match(pod_validator.iter_errors(instance))
         if error:
             logger.warn("Validation failed, best guess of error = %s", error)
             return False
         return True
 
+    @staticmethod
+    def _write_json_catalog(entries, json_export_map):
+        """
+        Writes the catalog of entries to a temporary file, one entry at a time
+        :return: NamedTemporaryFile, deleted when closed
+        """
+        data = tempfile.NamedTemporaryFile(prefix='datajson-', suffix='.json')
+        try:
+            fragments = (Package2Pod.serialize_dataset(entry, indent=None, ensure_ascii=False) for entry in entries)
+            for chunk in Package2Pod.iter_json_catalog(fragments, json_export_map, indent=None, ensure_ascii=False):
+                if isinstance(chunk, unicode):
+                    chunk = chunk.encode('utf8')
+                data.write(chunk)
+            data.flush()
+        except Exception:
+            data.close()
+            raise
+        return data
+
     def write_zip(self, data, error=None, errors_json=None, zip_name='data'):
         """
-        Data: a python object to write to the data.json
+        Data: file holding the serialized data.json catalog (see _write_json_catalog), closed here
         Error: unicode string representing the content of the error log.
         zip_name: the name to use for the zip file
         """
         import zipfile
 
-        o = StringIO.StringIO()
+        # kept in memory while small, moved to disk past ZIP_SPOOL_SIZE
+        o = tempfile.SpooledTemporaryFile(max_size=ZIP_SPOOL_SIZE)
         zf = zipfile.ZipFile(o, mode='w')
 
         data_file_name = 'data.json'
@@ -395,7 +683,9 @@ class DataJsonController(BaseController):
 
         # Write the data file
         if data:
-            zf.writestr(data_file_name, json.dumps(data, ensure_ascii=False).encode('utf8'))
+            # copied into the archive chunk by chunk
+            zf.write(data.name, data_file_name)
+            data.close()
 
         # Write empty.json if nothing to return
         else:
@@ -419,15 +709,13 @@ class DataJsonController(BaseController):
             zf.writestr('errorlog.txt', error.encode('utf8'))
 
         zf.close()
-        o.seek(0)
-
-        binary = o.read()
-        o.close()
 
         response.content_type = 'application/octet-stream'
         response.content_disposition = 'attachment; filename="%s.zip"' % zip_name
+        response.content_length = o.tell()
 
-        return binary
+        o.seek(0)
+        return iter_file(o)
 
     def get_versions(self):
         from ckanext.datajson.harvester_datajson import DataJsonHarvester
@@ -441,61 +729,575 @@ class DataJsonController(BaseController):
     def validator(self):
         # Validates that a URL is a good data.json file.
         if request.method == "POST" and "url" in request.POST and request.POST["url"].strip() != "":
+            from datajsonvalidator import format_errors, merge_errors
+
+            if request.POST.get("format") == "ndjson":
+                # one line per dataset with errors, sent as soon as the dataset is checked
+                response.content_type = 'application/x-ndjson'
+                response.charset = 'utf-8'
+                return self._iter_validation_lines(request.POST["url"])
+
             c.source_url = request.POST["url"]
             c.errors = []
 
-            import urllib
-            import json
-            from datajsonvalidator import do_validation
-
-            body = None
-            try:
-                body = json.load(urllib.urlopen(c.source_url))
-            except IOError as e:
-                c.errors.append(("Error Loading File", ["The address could not be loaded: " + unicode(e)]))
-            except ValueError as e:
-                c.errors.append(("Invalid JSON", ["The file does not meet basic JSON syntax requirements: " + unicode(
-                    e) + ". Try using JSONLint.com."]))
-            except Exception as e:
-                c.errors.append((
-                    "Internal Error",
-                    ["Something bad happened while trying to load and parse the file: " + unicode(e)]))
-
-            if body:
-                try:
-                    do_validation([dict(body)], c.errors, set())
-                except Exception as e:
-                    c.errors.append(("Internal Error", ["Something bad happened: " + unicode(e)]))
-                if len(c.errors) == 0:
-                    c.errors.append(("No Errors", ["Great job!"]))
+            errs = {}
+            count = 0
+            for count, dataset_name, dataset_errs, load_error in _iter_url_validation(c.source_url):
+                if load_error:
+                    c.errors.append(load_error)
+                merge_errors(errs, dataset_errs)
+            format_errors(errs, c.errors)
+            if len(c.errors) == 0:
+                c.errors.append(("No Errors", ["Great job!"]))
 
         return render('datajsonvalidator.html')
 
     @staticmethod
-    def _get_ckan_datasets(org=None, with_private=False):
-        n = 500
-        page = 1
-        dataset_list = []
-
-        q = '+capacity:public' if not with_private else '*:*'
-
-        fq = 'dataset_type:dataset'
-        if org:
-            fq += " AND organization:" + org
+    def _iter_validation_lines(url):
+        """
+        Validation results of the catalog at url as JSON lines: one
+        {"dataset", "name", "errors"} line per dataset with errors, then a
+        {"datasets", "errors"} line with the number of datasets checked and the
+        errors of the catalog itself
+        """
+        from datajsonvalidator import format_errors
+
+        errors = []
+        count = 0
+        for count, dataset_name, dataset_errs, load_error in _iter_url_validation(url):
+            if load_error:
+                errors.append(load_error)
+            if dataset_errs:
+                dataset_errors = []
+                format_errors(dataset_errs, dataset_errors)
+                yield json.dumps(OrderedDict([('dataset', count), ('name', dataset_name),
+                                              ('errors', dataset_errors)])) + '\n'
+        yield json.dumps(OrderedDict([('datasets', count), ('errors', errors)])) + '\n'
 
+    @staticmethod
+    def _iter_ckan_datasets(org=None, with_private=False):
+        """
+        Yields the datasets matching org, page by page, the most recently
+        modified first.
+        """
+        rows = DataJsonPlugin.search_rows
+        q, fq = _search_query(org, with_private)
+
+        # Keyset paging: every page starts right after the last (metadata_modified, id)
+        # returned so far, instead of making Solr skip over all the previous pages.
+        # A dataset modified during the crawl moves before the pages returned
+        # already, so the crawl covers the datasets modified before it started,
+        # then the ones modified during the crawl, and so on until there is no
+        # new one. The ids exported so far are kept (hashed, 8 bytes per
+        # dataset), so that a dataset modified after it was exported is not
+        # exported again.
+        exported = array.array('l')
+        lower = '*'
         while True:
-            search_data_dict = {
-                'q': q,
-                'fq': fq,
-                'sort': 'metadata_modified desc',
-                'rows': n,
-                'start': n * (page - 1),
-            }
-
-            query = p.toolkit.get_action('package_search')({}, search_data_dict)
-            if len(query['results']):
-                dataset_list.extend(query['results'])
-                page += 1
-            else:
+            upper = _solr_datetime(datetime.datetime.utcnow().isoformat())
+            # bounds included, a dataset can be modified within the millisecond the crawl starts
+            window_fq = '%s AND metadata_modified:[%s TO "%s"]' % (fq, lower, upper)
+            catching_up = lower != '*'
+            new = False
+            for page in _iter_search_pages(q, window_fq, rows, DataJsonPlugin.export_threads):
+                skipped = _exported_ids(exported, page) if catching_up else ()
+                for pkg in page:
+                    if pkg['id'] in skipped:
+                        continue
+                    new = True
+                    exported.append(hash(pkg['id']))
+                    yield pkg
+            if not new:
+                break
+            lower = '"%s"' % upper
+
+
+def _catalog_changed():
+    """
+    Marks the current session as changing the exported catalog, see
+    DataJsonPlugin.after_commit
+    """
+    model.Session().info[CATALOG_CHANGED] = True
+
+
+def _search_query(org=None, with_private=False):
+    """
+    :return: (q, fq) matching the exported datasets of org
+    """
+    q = '+capacity:public' if not with_private else '*:*'
+
+    fq = 'dataset_type:dataset'
+    if org:
+        fq += " AND organization:" + org
+    return q, fq
+
+
+def _indexed_organizations():
+    """
+    :return: names of the organizations of the exported datasets, as they are
+        indexed (organizations deleted since included)
+    """
+    q, fq = _search_query()
+    query = p.toolkit.get_action('package_search')({}, {
+        'q': q,
+        'fq': fq,
+        'rows': 0,
+        'facet.field': ['organization'],
+        'facet.limit': -1,
+    })
+    return [item['name'] for item in query['search_facets'].get('organization', {}).get('items', [])]
+
+
+def _organization_group_ids(owner_org):
+    """
+    :return: owner_org and the ids of its sub-agencies, whose packages make up
+        its inventory (see DataJsonController.get_packages)
+    """
+    group_ids = [owner_org]
+    # get packages for sub-agencies.
+    sub_agency = model.Group.get(owner_org)
+    if sub_agency and 'sub-agencies' in sub_agency.extras.col.target \
+            and sub_agency.extras.col.target['sub-agencies'].state == 'active':
+        sub_agencies = sub_agency.extras.col.target['sub-agencies'].value
+        group_ids.extend(sub_agencies.split(","))
+    return group_ids
+
+
+def _group_packages_query(group_id, with_private=True):
+    """
+    :return: query of the packages of a group, see
+        DataJsonController.get_all_group_packages
+    """
+    return model.Group.get(group_id).packages(with_private=with_private, return_query=True,
+                                              context={'user_is_admin': True})
+
+
+def _catalog_version(org, json_export_map):
+    """
+    Identifies the current state of the public catalog of org (or of the whole
+    site) without exporting it: any dataset created, modified or deleted
+    changes either the number of datasets or the newest metadata_modified, and
+    any change to an organization changes its revision.
+    The datasets are counted the way the export selects them: from the search
+    index, or for an organization that has none there (e.g. given by id), from
+    the database along with its sub-agencies.
+    There is no Last-Modified to go with it, a deleted dataset or a new export
+    map changes the catalog without making it any newer.
+    :return: ETag
+    """
+    q, fq = _search_query(org)
+    query = p.toolkit.get_action('package_search')({}, {
+        'q': q,
+        'fq': fq,
+        'sort': 'metadata_modified desc',
+        'rows': 1,
+        'fl': 'metadata_modified',
+    })
+
+    if query['count'] or not org:
+        count = query['count']
+        newest = query['results'][0]['metadata_modified'] if query['results'] else ''
+        group_ids = [org] if org else None
+    else:
+        group_ids = _organization_group_ids(org)
+        count, newest = _group_packages_version(group_ids)
+
+    version = '%s|%s|%s|%s|%s' % (org or '', count, newest, _organizations_revision(group_ids),
+                                  get_export_map_fingerprint(json_export_map))
+    return '"%s"' % hashlib.sha1(version).hexdigest()
+
+
+def _group_packages_version(group_ids, with_private=False):
+    """
+    :return: (number of packages, newest metadata_modified) of the packages of
+        group_ids, a package of several groups is counted once per group
+    """
+    count = 0
+    newest = ''
+    for group_id in group_ids:
+        if not model.Group.get(group_id):
+            continue
+        group_count, group_newest = _group_packages_query(group_id, with_private).with_entities(
+            func.count(model.Package.id), func.max(model.Package.metadata_modified)).one()
+        count += group_count
+        if group_newest:
+            newest = max(newest, group_newest.isoformat())
+    return count, newest
+
+
+def _organizations_revision(group_ids=None):
+    """
+    :return: str, changes whenever one of the organizations of group_ids (or
+        any organization if None) is created, modified or deleted
+    """
+    if group_ids is None:
+        revisions = model.Session.query(model.Group.id, model.Group.revision_id) \
+            .filter(model.Group.is_organization == True) \
+            .order_by(model.Group.id).all()
+    else:
+        groups = [model.Group.get(group_id) for group_id in group_ids]
+        revisions = [(group.id, group.revision_id) for group in groups if group]
+    return hashlib.sha1(json.dumps(revisions)).hexdigest()
+
+
+def _not_modified(etag):
+    """
+    Checks the If-None-Match header of the current request against the
+    catalog version
+    """
+    if_none_match = request.headers.get('If-None-Match')
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    # weak comparison is fine for GET, and both encodings have the same content
+    tags = [tag.strip().replace('W/', '', 1) for tag in if_none_match.split(',')]
+    return etag in tags or _gzip_etag(etag) in tags
+
+
+def _gzip_etag(etag):
+    """
+    ETag of the gzipped variant of the representation tagged etag
+    """
+    return etag[:-1] + '-gzip"'
+
+
+def _accepts_gzip():
+    """
+    Whether the current request accepts a gzip encoded response
+    """
+    for coding in request.headers.get('Accept-Encoding', '').split(','):
+        params = [param.strip() for param in coding.split(';')]
+        if params[0].lower() not in ('gzip', 'x-gzip'):
+            continue
+        for param in params[1:]:
+            if param.replace(' ', '').startswith('q='):
+                try:
+                    return float(param.replace(' ', '')[2:]) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def _search_page(q, fq, rows, after=None):
+    """
+    Fetches the page of datasets sorted right after the dataset after
+    :return: (list of datasets, number of datasets matching fq)
+    """
+    if after:
+        fq += " AND " + _keyset_filter(after['metadata_modified'], after['id'])
+
+    search_data_dict = {
+        'q': q,
+        'fq': fq,
+        'sort': 'metadata_modified desc, id desc',
+        'rows': rows,
+    }
+
+    # No 'fl' to trim the results to the fields the export map reads: package_search
+    # already asks Solr for 'id validated_data_dict' only, and any other fl returns
+    # the flattened index fields instead, which lack most resource fields (mimetype,
+    # conformsTo, describedBy, ...) and the organization title the export needs.
+    query = p.toolkit.get_action('package_search')({}, search_data_dict)
+    return query['results'], query['count']
+
+
+def _iter_search_pages(q, fq, rows, threads=1):
+    """
+    Pages of the datasets matching fq, see _iter_pages
+    """
+    first_page, count = _search_page(q, fq, rows)
+    if first_page:
+        yield first_page
+    if len(first_page) == rows and count > rows:
+        # more pages to come: with several threads, the rest of the crawl is
+        # split in id ranges fetched side by side
+        for page in _iter_pages(q, fq, rows, first_page[-1], min(threads, count // rows)):
+            yield page
+
+
+def _exported_ids(exported, page):
+    """
+    :param exported: array of the hashes of the ids exported so far
+    :return: set of the ids of the datasets of page that are in exported
+    """
+    ids = dict((hash(pkg['id']), pkg['id']) for pkg in page)
+    return set(ids[id_hash] for id_hash in exported if id_hash in ids)
+
+
+def _iter_keyset_pages(q, fq, rows, after=None):
+    while True:
+        page, count = _search_page(q, fq, rows, after)
+        if page:
+            yield page
+        if len(page) < rows:
+            break
+        after = page[-1]
+
+
+def _iter_pages(q, fq, rows, after, threads):
+    """
+    Pages of datasets sorted after the dataset after. With more than one thread
+    every thread crawls its own range of ids, the pages are merged back in
+    (metadata_modified desc, id desc) order as they arrive.
+    """
+    if threads <= 1:
+        for page in _iter_keyset_pages(q, fq, rows, after):
+            yield page
+        return
+
+    boundaries = [None] + ['%02x' % (256 * i // threads) for i in range(1, threads)] + [None]
+    stop = threading.Event()
+    shards = []
+    for lower, upper in zip(boundaries, boundaries[1:]):
+        shard_fq = '%s AND id:[%s TO %s}' % (fq, '"%s"' % lower if lower else '*', '"%s"' % upper if upper else '*')
+        pages = Queue.Queue(maxsize=2)
+        thread = threading.Thread(target=_fill_queue, name='datajson-search-%s' % (lower or '00'),
+                                  args=(pages, stop, _iter_keyset_pages, (q, shard_fq, rows, after)))
+        thread.daemon = True
+        thread.start()
+        shards.append(_iter_queue(pages))
+
+    def sort_key(shard):
+        for page in shard:
+            for pkg in page:
+                yield _Descending((_solr_datetime(pkg['metadata_modified']), pkg['id'])), pkg
+
+    try:
+        page = []
+        for key, pkg in heapq.merge(*[sort_key(shard) for shard in shards]):
+            page.append(pkg)
+            if len(page) == rows:
+                yield page
+                page = []
+        if page:
+            yield page
+    finally:
+        # let the threads go if the consumer gave up early
+        stop.set()
+
+
+class _Descending(object):
+    """
+    Sort key ordering the values it wraps the other way round
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return self.value > other.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def _imap_ahead(pool, func, iterable, ahead):
+    """
+    pool.imap that keeps at most ahead results loaded (including the one being
+    consumed), instead of running through all of iterable
+    """
+    pending = collections.deque()
+    for args in iterable:
+        pending.append(pool.apply_async(func, (args,)))
+        if len(pending) >= ahead:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def _fill_queue(queue, stop, producer, args):
+    """
+    Thread body: puts everything producer yields into queue, followed by a
+    StopIteration (or the exception that stopped producer)
+    """
+    try:
+        try:
+            for item in producer(*args):
+                while not stop.is_set():
+                    try:
+                        queue.put(item, timeout=1)
+                        break
+                    except Queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+            item = StopIteration()
+        except Exception as e:
+            item = e
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=1)
                 break
-        return dataset_list
+            except Queue.Full:
+                pass
+    finally:
+        # every thread gets its own session from the scoped session registry
+        model.Session.remove()
+
+
+def _iter_queue(queue):
+    while True:
+        item = queue.get()
+        if isinstance(item, StopIteration):
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+def _iter_url_validation(url):
+    """
+    Validates the catalog at url one dataset at a time, as it is downloaded,
+    within the size and time budget of the validator.
+    The errors of each dataset are kept by hash of the dataset, so only the
+    datasets that changed since an earlier submission are validated again, and
+    the results of the whole catalog by hash of the catalog, replayed without
+    downloading it again when its server answers 304 Not Modified.
+    :return: iterator of (number of datasets checked, dataset name, errors of
+        the dataset (see datajsonvalidator.add_error), error of the catalog as
+        (heading, [descriptions]) or None)
+    """
+    import urllib2
+    import urlparse
+    from jsonstream import CHUNK_SIZE, BudgetExceeded, BudgetReader, TeeReader
+
+    count = 0
+    try:
+        if urlparse.urlparse(url).scheme not in ('http', 'https'):
+            raise IOError('only http and https addresses are supported')
+
+        req = urllib2.Request(url)
+        # (ETag, Last-Modified, hash of the body) of the last complete download of url
+        known = DataJsonPlugin.validated_catalogs.get(url)
+        results = DataJsonPlugin.validation_results.get(known[2]) if known else None
+        if results is not None:
+            if known[0]:
+                req.add_header('If-None-Match', known[0])
+            if known[1]:
+                req.add_header('If-Modified-Since', known[1])
+        try:
+            remote = urllib2.urlopen(req, timeout=DataJsonPlugin.validator_max_seconds)
+        except urllib2.HTTPError as e:
+            if e.code != 304 or results is None:
+                raise
+            for result in results:
+                yield result
+            return
+
+        # only the datasets with errors are kept, the last result gives the number of datasets
+        results = []
+        body_hash = hashlib.sha1()
+        try:
+            reader = BudgetReader(TeeReader(remote, body_hash.update), DataJsonPlugin.validator_max_bytes,
+                                  DataJsonPlugin.validator_max_seconds)
+            for result in _iter_body_validation(reader):
+                count = result[0]
+                if result[2] or result[3]:
+                    results.append(result)
+                yield result
+            try:
+                # the hash is of the whole body, e.g. the rest of an invalid catalog
+                for _ in iter(lambda: reader.read(CHUNK_SIZE), ''):
+                    pass
+            except BudgetExceeded:
+                # the errors are reported already, they can't be kept without the hash
+                return
+        finally:
+            remote.close()
+        results.append((count, None, None, None))
+        DataJsonPlugin.validation_results.set(body_hash.hexdigest(), results)
+        DataJsonPlugin.validated_catalogs.set(url, (remote.info().getheader('ETag'),
+                                                    remote.info().getheader('Last-Modified'),
+                                                    body_hash.hexdigest()))
+    except BudgetExceeded as e:
+        yield count, None, None, ("Validation Stopped", [unicode(e) + " Only the first %d datasets were checked." % count])
+    except IOError as e:
+        yield count, None, None, ("Error Loading File", ["The address could not be loaded: " + unicode(e)])
+    except Exception as e:
+        yield count, None, None, ("Internal Error", ["Something bad happened while trying to load and parse the file: " +
+                                                     unicode(e)])
+
+
+def _iter_body_validation(reader):
+    """
+    Validates a catalog one dataset at a time, as it is read, see
+    _iter_url_validation
+    :param reader: BudgetReader of the catalog
+    :raises BudgetExceeded: once the datasets read within the budget have been
+        validated
+    """
+    from jsonstream import iter_catalog_datasets
+
+    count = 0
+    seen_identifiers = set()
+    try:
+        for text in iter_catalog_datasets(reader, raw=True):
+            count += 1
+            reader.check_time()
+            dataset_name, errs = _validate_dataset_text(text, "dataset %d" % count, seen_identifiers)
+            yield count, dataset_name, errs, None
+    except ValueError as e:
+        yield count, None, None, ("Invalid JSON", ["The file does not meet basic JSON syntax requirements: " +
+                                                   unicode(e) + ". Try using JSONLint.com."])
+        return
+    if count == 0:
+        yield count, None, None, ("Catalog Is Empty", ["There are no entries in your file."])
+
+
+def _validate_dataset_text(text, dataset_name, seen_identifiers):
+    """
+    Validates one dataset of a catalog from its JSON text. The errors of a
+    dataset are kept by hash of the text, only the check for duplicate
+    identifiers (that depends on the other datasets of the catalog) runs again
+    when the same dataset is validated later.
+    :param dataset_name: name of the dataset in the errors if it has no title
+    :return: (name of the dataset in the errors, errors of the dataset)
+    """
+    from datajsonvalidator import add_duplicate_identifier_error, validate_dataset_text
+
+    key = hashlib.sha1(text.encode('utf-8')).hexdigest()
+    cached = DataJsonPlugin.validated_datasets.get(key)
+    if cached is None:
+        cached = validate_dataset_text(text, dataset_name)
+        # without a title the dataset is named after its position in the catalog
+        if cached[0] != dataset_name:
+            DataJsonPlugin.validated_datasets.set(key, cached)
+    dataset_name, errs, identifier = cached
+    return dataset_name, add_duplicate_identifier_error(errs, identifier, dataset_name, seen_identifiers)
+
+
+def _solr_datetime(value):
+    """
+    Formats a CKAN timestamp (microseconds, no timezone) the way Solr stores it
+    :param value: str e.g. 2019-05-01T10:20:30.123456
+    :return: str e.g. 2019-05-01T10:20:30.123Z
+    """
+    value = value.rstrip('Z')
+    seconds, _, fraction = value.partition('.')
+    # Solr keeps millisecond precision, always written out so that the values sort as strings
+    return '%s.%sZ' % (seconds, (fraction + '000')[:3])
+
+
+def _keyset_filter(metadata_modified, package_id):
+    """
+    Solr filter matching the datasets sorted after (metadata_modified, id),
+    both descending
+    """
+    metadata_modified = _solr_datetime(metadata_modified)
+    return '(metadata_modified:[* TO "%s"} OR (metadata_modified:"%s" AND id:[* TO "%s"}))' % (
+        metadata_modified, metadata_modified, package_id)
+
+
+def _peek(iterable):
+    """
+    Returns an iterator equivalent to iterable, or None if iterable is empty
+    """
+    iterator = iter(iterable)
+    try:
+        first = next(iterator)
+    except StopIteration:
+        return None
+    return itertools.chain([first], iterator)
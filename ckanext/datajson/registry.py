@@ -0,0 +1,105 @@
+import os
+import threading
+
+import simplejson as json
+
+try:
+    from collections import OrderedDict  # 2.7
+except ImportError:
+    from sqlalchemy.util import OrderedDict
+
+
+class FrozenOrderedDict(OrderedDict):
+    """
+    OrderedDict that can't be modified once built. Copy it (e.g. with
+    OrderedDict(frozen)) to get a mutable version.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._frozen = False
+        OrderedDict.__init__(self, *args, **kwargs)
+        self._frozen = True
+
+    def _check_frozen(self):
+        if getattr(self, '_frozen', False):
+            raise TypeError('%s is read-only' % self.__class__.__name__)
+
+    def __setitem__(self, key, value, *args, **kwargs):
+        self._check_frozen()
+        OrderedDict.__setitem__(self, key, value, *args, **kwargs)
+
+    def __delitem__(self, key, *args, **kwargs):
+        self._check_frozen()
+        OrderedDict.__delitem__(self, key, *args, **kwargs)
+
+    def clear(self):
+        self._check_frozen()
+        OrderedDict.clear(self)
+
+    def pop(self, *args, **kwargs):
+        self._check_frozen()
+        return OrderedDict.pop(self, *args, **kwargs)
+
+    def popitem(self, *args, **kwargs):
+        self._check_frozen()
+        return OrderedDict.popitem(self, *args, **kwargs)
+
+    def setdefault(self, key, default=None):
+        self._check_frozen()
+        return OrderedDict.setdefault(self, key, default)
+
+    def update(self, *args, **kwargs):
+        self._check_frozen()
+        OrderedDict.update(self, *args, **kwargs)
+
+
+def freeze(obj):
+    """
+    Read-only deep copy of parsed JSON: objects become FrozenOrderedDicts and
+    arrays become tuples
+    """
+    if isinstance(obj, dict):
+        return FrozenOrderedDict((k, freeze(v)) for k, v in obj.iteritems())
+    if isinstance(obj, list):
+        return tuple(freeze(v) for v in obj)
+    return obj
+
+
+class JsonFileRegistry(object):
+    """
+    Process-wide cache of JSON config files (export maps, data processors).
+    Each file is parsed once and parsed again only when its mtime or size
+    changes. The parsed content is shared, so it is handed out frozen.
+    """
+
+    def __init__(self):
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """
+        Parsed content of the JSON file at path
+        :param path: str
+        :return: FrozenOrderedDict
+        """
+        stat = os.stat(path)
+        version = (stat.st_mtime, stat.st_size)
+
+        with self._lock:
+            cached = self._files.get(path)
+        if cached and cached[0] == version:
+            return cached[1]
+
+        with open(path, 'r') as json_file:
+            content = freeze(json.load(json_file, object_pairs_hook=OrderedDict))
+
+        with self._lock:
+            self._files[path] = (version, content)
+        return content
+
+    def clear(self):
+        with self._lock:
+            self._files.clear()
+
+
+json_files = JsonFileRegistry()
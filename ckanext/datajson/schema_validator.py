@@ -0,0 +1,393 @@
+import numbers
+import os
+import re
+import threading
+from logging import getLogger
+from urlparse import urldefrag, urljoin
+
+import simplejson as json
+from jsonschema import FormatChecker, _utils
+from jsonschema.validators import Draft4Validator, RefResolver
+
+log = getLogger(__name__)
+
+SCHEMA_DIR = os.path.join(os.path.dirname(__file__), 'pod_schema')
+
+# same as the Draft4Validator default types
+TYPES = {
+    'array': list,
+    'boolean': bool,
+    'integer': (int, long),
+    'null': type(None),
+    'number': numbers.Number,
+    'object': dict,
+    'string': (str, unicode),
+}
+
+FLOAT_TOLERANCE = 10 ** -15
+
+
+class UnsupportedSchema(Exception):
+    pass
+
+
+class SchemaValidator(object):
+    """
+    Validates instances against a Draft 4 JSON schema (the POD schemas).
+    The schema is compiled once into plain Python checks, that only answer
+    whether an instance is valid. The jsonschema Draft4Validator only runs for
+    the instances that fail, to report their errors.
+    Schemas the compiler does not support are validated by the Draft4Validator
+    only.
+    The subschemas with their own id (e.g. organization.json in the POD
+    schemas) are resolved locally, instead of being downloaded by jsonschema.
+    """
+
+    def __init__(self, schema, format_checker=None):
+        self.schema = schema
+        self.format_checker = format_checker
+        compiler = _SchemaCompiler(schema, format_checker)
+        resolver = RefResolver.from_schema(schema, store=compiler.documents)
+        self.draft4validator = Draft4Validator(schema, resolver=resolver, format_checker=format_checker)
+        try:
+            self._check = compiler.compile()
+        except UnsupportedSchema as e:
+            log.warn('Schema %s is not compiled: %s', schema.get('id'), e)
+            self._check = None
+
+    def is_valid(self, instance):
+        """
+        :return: bool
+        """
+        if self._check is None:
+            return self.draft4validator.is_valid(instance)
+        return self._check(instance)
+
+    def iter_errors(self, instance):
+        """
+        Same errors as Draft4Validator.iter_errors, for valid instances nothing
+        is computed
+        """
+        if self._check is not None and self._check(instance):
+            return iter(())
+        return self.draft4validator.iter_errors(instance)
+
+
+_validators = {}
+_validators_lock = threading.Lock()
+
+
+def get_schema_validator(schema_path):
+    """
+    SchemaValidator of the schema file at schema_path (with a FormatChecker),
+    compiled once per process
+    :param schema_path: path of the schema, relative to pod_schema/ or absolute
+    :return: SchemaValidator
+    """
+    schema_path = os.path.join(SCHEMA_DIR, schema_path)
+    with _validators_lock:
+        validator = _validators.get(schema_path)
+        if validator is None:
+            with open(schema_path, 'r') as schema_file:
+                schema = json.load(schema_file)
+            validator = _validators[schema_path] = SchemaValidator(schema, format_checker=FormatChecker())
+    return validator
+
+
+class _SchemaCompiler(object):
+    """
+    Turns a schema into a function instance -> bool, following the semantics
+    of jsonschema's Draft4Validator.
+    $refs are resolved within the schema, including the subschemas that have
+    their own id.
+    """
+
+    def __init__(self, schema, format_checker=None):
+        self.schema = schema
+        self.format_checker = format_checker
+        self.base_uri = schema.get('id', '')
+        # documents by URI: the schema and its subschemas with an id
+        self.documents = {urldefrag(self.base_uri)[0]: schema}
+        self._index_ids(schema, self.base_uri)
+        # compiled $refs by resolved URI, filled as they are compiled (they may be recursive)
+        self.refs = {}
+
+    def _index_ids(self, schema, scope):
+        if isinstance(schema, dict):
+            if isinstance(schema.get('id'), basestring):
+                scope = urljoin(scope, schema['id'])
+                self.documents.setdefault(urldefrag(scope)[0], schema)
+            for value in schema.itervalues():
+                self._index_ids(value, scope)
+        elif isinstance(schema, list):
+            for value in schema:
+                self._index_ids(value, scope)
+
+    def compile(self):
+        return self._compile(self.schema, self.base_uri)
+
+    def _compile(self, schema, scope):
+        if not isinstance(schema, dict):
+            raise UnsupportedSchema('%r is not a schema' % (schema,))
+
+        scope = urljoin(scope, schema.get('id', ''))
+        if '$ref' in schema:
+            # other keywords next to $ref are ignored
+            return self._compile_ref(schema['$ref'], scope)
+
+        checks = []
+        for keyword, value in schema.iteritems():
+            compile_keyword = getattr(self, '_compile_' + keyword, None)
+            if compile_keyword is None:
+                if keyword in Draft4Validator.VALIDATORS:
+                    raise UnsupportedSchema('keyword %s' % keyword)
+                continue
+            check = compile_keyword(value, schema, scope)
+            if check is not None:
+                checks.append(check)
+
+        if not checks:
+            return _valid
+        if len(checks) == 1:
+            return checks[0]
+        checks = tuple(checks)
+
+        def check_all(instance):
+            for check in checks:
+                if not check(instance):
+                    return False
+            return True
+        return check_all
+
+    def _compile_ref(self, ref, scope):
+        uri = urljoin(scope, ref)
+        compiled = self.refs.get(uri)
+        if compiled is None:
+            url, fragment = urldefrag(uri)
+            document = self.documents.get(url)
+            if document is None:
+                raise UnsupportedSchema('$ref %s' % uri)
+            target = _resolve_pointer(document, fragment)
+
+            # a recursive $ref calls the compiled schema through holder
+            holder = []
+
+            def compiled(instance):
+                return holder[0](instance)
+            self.refs[uri] = compiled
+            holder.append(self._compile(target, url))
+        return compiled
+
+    def _compile_type(self, types, schema, scope):
+        types = _utils.ensure_list(types)
+        for type_name in types:
+            if type_name not in TYPES:
+                raise UnsupportedSchema('type %s' % type_name)
+        return lambda instance: any(_is_type(instance, type_name) for type_name in types)
+
+    def _compile_enum(self, enums, schema, scope):
+        return lambda instance: instance in enums
+
+    def _compile_properties(self, properties, schema, scope):
+        checks = [(name, self._compile(subschema, scope)) for name, subschema in properties.iteritems()]
+
+        def check(instance):
+            if not isinstance(instance, dict):
+                return True
+            for name, check_property in checks:
+                if name in instance and not check_property(instance[name]):
+                    return False
+            return True
+        return check
+
+    def _compile_patternProperties(self, pattern_properties, schema, scope):
+        checks = [(re.compile(pattern).search, self._compile(subschema, scope))
+                  for pattern, subschema in pattern_properties.iteritems()]
+
+        def check(instance):
+            if not isinstance(instance, dict):
+                return True
+            for search, check_property in checks:
+                for name, value in instance.iteritems():
+                    if search(name) and not check_property(value):
+                        return False
+            return True
+        return check
+
+    def _compile_additionalProperties(self, additional_properties, schema, scope):
+        properties = schema.get('properties', {})
+        searches = [re.compile(pattern).search for pattern in schema.get('patternProperties', {})]
+
+        def extras(instance):
+            return [name for name in instance
+                    if name not in properties and not any(search(name) for search in searches)]
+
+        if isinstance(additional_properties, dict):
+            check_extra = self._compile(additional_properties, scope)
+
+            def check(instance):
+                if not isinstance(instance, dict):
+                    return True
+                return all(check_extra(instance[name]) for name in extras(instance))
+            return check
+        elif not additional_properties:
+            return lambda instance: not isinstance(instance, dict) or not extras(instance)
+        return None
+
+    def _compile_required(self, required, schema, scope):
+        def check(instance):
+            if not isinstance(instance, dict):
+                return True
+            for name in required:
+                if name not in instance:
+                    return False
+            return True
+        return check
+
+    def _compile_dependencies(self, dependencies, schema, scope):
+        checks = []
+        for name, dependency in dependencies.iteritems():
+            if isinstance(dependency, dict):
+                checks.append((name, self._compile(dependency, scope)))
+            else:
+                names = _utils.ensure_list(dependency)
+                checks.append((name, lambda instance, names=names: all(n in instance for n in names)))
+
+        def check(instance):
+            if not isinstance(instance, dict):
+                return True
+            for name, check_dependency in checks:
+                if name in instance and not check_dependency(instance):
+                    return False
+            return True
+        return check
+
+    def _compile_minProperties(self, min_properties, schema, scope):
+        return lambda instance: not isinstance(instance, dict) or len(instance) >= min_properties
+
+    def _compile_maxProperties(self, max_properties, schema, scope):
+        return lambda instance: not isinstance(instance, dict) or len(instance) <= max_properties
+
+    def _compile_items(self, items, schema, scope):
+        if isinstance(items, dict):
+            check_item = self._compile(items, scope)
+
+            def check(instance):
+                if not isinstance(instance, list):
+                    return True
+                for item in instance:
+                    if not check_item(item):
+                        return False
+                return True
+            return check
+
+        item_checks = [self._compile(subschema, scope) for subschema in items]
+
+        def check_tuple(instance):
+            if not isinstance(instance, list):
+                return True
+            return all(check_item(item) for check_item, item in zip(item_checks, instance))
+        return check_tuple
+
+    def _compile_additionalItems(self, additional_items, schema, scope):
+        items = schema.get('items', {})
+        if isinstance(items, dict):
+            return None
+        count = len(items)
+
+        if isinstance(additional_items, dict):
+            check_item = self._compile(additional_items, scope)
+            return lambda instance: not isinstance(instance, list) or all(check_item(i) for i in instance[count:])
+        elif not additional_items:
+            return lambda instance: not isinstance(instance, list) or len(instance) <= count
+        return None
+
+    def _compile_minItems(self, min_items, schema, scope):
+        return lambda instance: not isinstance(instance, list) or len(instance) >= min_items
+
+    def _compile_maxItems(self, max_items, schema, scope):
+        return lambda instance: not isinstance(instance, list) or len(instance) <= max_items
+
+    def _compile_uniqueItems(self, unique_items, schema, scope):
+        if not unique_items:
+            return None
+        return lambda instance: not isinstance(instance, list) or _utils.uniq(instance)
+
+    def _compile_pattern(self, pattern, schema, scope):
+        search = re.compile(pattern).search
+        return lambda instance: not isinstance(instance, basestring) or search(instance) is not None
+
+    def _compile_format(self, format_name, schema, scope):
+        if self.format_checker is None:
+            return None
+        conforms = self.format_checker.conforms
+        return lambda instance: conforms(instance, format_name)
+
+    def _compile_minLength(self, min_length, schema, scope):
+        return lambda instance: not isinstance(instance, basestring) or len(instance) >= min_length
+
+    def _compile_maxLength(self, max_length, schema, scope):
+        return lambda instance: not isinstance(instance, basestring) or len(instance) <= max_length
+
+    def _compile_minimum(self, minimum, schema, scope):
+        if schema.get('exclusiveMinimum', False):
+            return lambda instance: not _is_type(instance, 'number') or float(instance) > minimum
+        return lambda instance: not _is_type(instance, 'number') or float(instance) >= minimum
+
+    def _compile_maximum(self, maximum, schema, scope):
+        if schema.get('exclusiveMaximum', False):
+            return lambda instance: not _is_type(instance, 'number') or instance < maximum
+        return lambda instance: not _is_type(instance, 'number') or instance <= maximum
+
+    def _compile_multipleOf(self, multiple_of, schema, scope):
+        def check(instance):
+            if not _is_type(instance, 'number'):
+                return True
+            if isinstance(multiple_of, float):
+                mod = instance % multiple_of
+                return not ((mod > FLOAT_TOLERANCE) and (multiple_of - mod) > FLOAT_TOLERANCE)
+            return not instance % multiple_of
+        return check
+
+    def _compile_allOf(self, all_of, schema, scope):
+        checks = [self._compile(subschema, scope) for subschema in all_of]
+        return lambda instance: all(check(instance) for check in checks)
+
+    def _compile_anyOf(self, any_of, schema, scope):
+        checks = [self._compile(subschema, scope) for subschema in any_of]
+        return lambda instance: any(check(instance) for check in checks)
+
+    def _compile_oneOf(self, one_of, schema, scope):
+        checks = [self._compile(subschema, scope) for subschema in one_of]
+        return lambda instance: sum(1 for check in checks if check(instance)) == 1
+
+    def _compile_not(self, not_schema, schema, scope):
+        check_not = self._compile(not_schema, scope)
+        return lambda instance: not check_not(instance)
+
+
+def _valid(instance):
+    return True
+
+
+def _is_type(instance, type_name):
+    # bool is an int, but not a JSON number
+    if isinstance(instance, bool):
+        return 'boolean' == type_name
+    return isinstance(instance, TYPES[type_name])
+
+
+def _resolve_pointer(document, fragment):
+    fragment = fragment.lstrip('/')
+    parts = [part.replace('~1', '/').replace('~0', '~') for part in fragment.split('/')] if fragment else []
+    for part in parts:
+        if isinstance(document, list):
+            try:
+                part = int(part)
+            except ValueError:
+                raise UnsupportedSchema('$ref fragment %s' % fragment)
+        try:
+            document = document[part]
+        except (TypeError, LookupError):
+            raise UnsupportedSchema('$ref fragment %s' % fragment)
+    return document
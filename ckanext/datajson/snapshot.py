@@ -0,0 +1,171 @@
+import gzip
+import logging
+import os
+import re
+import tempfile
+import uuid
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+GZIP_LEVEL = 6
+
+
+class CatalogSnapshot(object):
+    """
+    Prebuilt data.json catalogs kept on disk.
+
+    A snapshot is written while the catalog is being served and published with
+    an atomic rename once it is complete, along with a gzipped copy. Snapshots
+    are named after the version of the catalog they were built for and the
+    generation of the store, so a snapshot is only found for the version it
+    holds, and invalidate() (a new generation) hides every snapshot published
+    before it, including the ones of builds that were running meanwhile.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, key, version, generation, gzipped=False):
+        name = '%s.%s.%s' % (_safe_name(key), _safe_name(version), generation or '0')
+        return os.path.join(self.directory, name + ('.json.gz' if gzipped else '.json'))
+
+    def open(self, key, version, gzipped=False):
+        """
+        Opens the published snapshot for key
+        :param key: str
+        :param version: str, version of the catalog the snapshot must hold
+        :param gzipped: bool, open the gzipped copy
+        :return: file|None
+        """
+        try:
+            return open(self.path(key, version, self.current_generation(), gzipped), 'rb')
+        except IOError:
+            return None
+
+    def save(self, key, version, body, generation):
+        """
+        Publishes an already built catalog
+        :param key: str
+        :param version: str, version of the catalog body was built for
+        :param body: str
+        :param generation: current_generation() from before the build started
+        """
+        for _ in self.tee(key, version, [body], generation):
+            pass
+
+    def tee(self, key, version, chunks, generation=None):
+        """
+        Yields chunks unchanged while writing them to the snapshot for key.
+        The snapshot is published only if chunks is exhausted without errors
+        and is not empty. It is published for generation: if the store was
+        invalidated since, it is never opened.
+        :param key: str
+        :param version: str, version of the catalog chunks are built for
+        :param chunks: iterable of str
+        :param generation: current_generation() from before the build started,
+            by default read when the first chunk is asked for
+        :return: generator of str
+        """
+        if generation is None:
+            generation = self.current_generation()
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        gz_fd, tmp_gz_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        published = False
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as tmp, os.fdopen(gz_fd, 'wb') as tmp_gz:
+                gz = gzip.GzipFile(filename='', mode='wb', compresslevel=GZIP_LEVEL, fileobj=tmp_gz)
+                for chunk in chunks:
+                    if isinstance(chunk, unicode):
+                        chunk = chunk.encode('utf8')
+                    tmp.write(chunk)
+                    gz.write(chunk)
+                    size += len(chunk)
+                    yield chunk
+                gz.close()
+            if not size:
+                log.info('data.json snapshot %s discarded, the catalog is empty', key)
+            else:
+                # each copy is published on its own, generate_output serves the one asked for if it is there
+                os.rename(tmp_gz_path, self.path(key, version, generation, gzipped=True))
+                os.rename(tmp_path, self.path(key, version, generation))
+                published = True
+                if generation == self.current_generation():
+                    log.info('data.json snapshot %s published', key)
+                    self._remove(lambda name: name.startswith(_safe_name(key) + '.') and
+                                 not self._is_current(name, key, version, generation))
+                else:
+                    log.info('data.json snapshot %s discarded, packages changed while it was built', key)
+                    self._remove(lambda name: self._is_current(name, key, version, generation))
+        finally:
+            if not published:
+                for path in (tmp_path, tmp_gz_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+
+    def invalidate(self):
+        """
+        Drops all the snapshots and marks the builds in progress as stale
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        generation = uuid.uuid4().hex
+        with os.fdopen(fd, 'w') as tmp:
+            tmp.write(generation)
+        os.rename(tmp_path, self._generation_path())
+
+        # snapshots of the new generation are already current
+        suffixes = ('.%s.json' % generation, '.%s.json.gz' % generation)
+        self._remove(lambda name: not name.endswith(suffixes))
+
+    def _is_current(self, name, key, version, generation):
+        return name in (os.path.basename(self.path(key, version, generation)),
+                        os.path.basename(self.path(key, version, generation, gzipped=True)))
+
+    def _remove(self, match):
+        """
+        Removes the published snapshots whose file name matches
+        """
+        for filename in os.listdir(self.directory):
+            if (filename.endswith('.json') or filename.endswith('.json.gz')) and match(filename):
+                try:
+                    os.remove(os.path.join(self.directory, filename))
+                except OSError:
+                    # already removed by another process
+                    pass
+
+    def _generation_path(self):
+        return os.path.join(self.directory, '.generation')
+
+    def current_generation(self):
+        """
+        Changes on every invalidate(), pass it to save() or tee() to publish a
+        catalog only if nothing changed while it was built
+        :return: str
+        """
+        try:
+            with open(self._generation_path(), 'r') as generation:
+                return generation.read()
+        except IOError:
+            # never invalidated
+            return ''
+
+
+def _safe_name(name):
+    return re.sub(r'[^\w\-]', '_', name)
+
+
+def iter_file(f, chunk_size=CHUNK_SIZE):
+    """
+    Yields the content of an open file in chunks and closes it
+    """
+    try:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        f.close()
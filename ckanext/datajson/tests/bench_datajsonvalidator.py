@@ -0,0 +1,39 @@
+"""
+Datasets checked per second by datajsonvalidator.do_validation on the sample
+catalogs, repeated to look like a large catalog.
+
+    python ckanext/datajson/tests/bench_datajsonvalidator.py [number of datasets]
+"""
+import codecs
+import json
+import os
+import sys
+import time
+
+from ckanext.datajson.datajsonvalidator import do_validation
+
+SAMPLES_DIR = os.path.join(os.path.dirname(__file__), 'datajson-samples')
+SAMPLES = ('arm.data.json', 'www.defense.gov.data.json', 'www2.ed.gov.data.json')
+
+
+def load_datasets(count):
+    samples = []
+    for filename in SAMPLES:
+        with codecs.open(os.path.join(SAMPLES_DIR, filename), encoding='utf-8-sig', errors='replace') as f:
+            samples.extend(json.load(f)['dataset'])
+
+    datasets = []
+    while len(datasets) < count:
+        for dataset in samples[:count - len(datasets)]:
+            # identifiers stay unique, the duplicates check is not what is measured
+            datasets.append(dict(dataset, identifier='%s-%d' % (dataset.get('identifier'), len(datasets))))
+    return datasets
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    datasets = load_datasets(count)
+
+    start = time.time()
+    do_validation([{'dataset': datasets}], [], set())
+    print '%-20s %8.0f datasets/s' % ('do_validation', len(datasets) / (time.time() - start))
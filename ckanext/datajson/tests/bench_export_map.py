@@ -0,0 +1,85 @@
+"""
+Conversions per second of Package2Pod.convert_package with the sample export maps.
+
+    python ckanext/datajson/tests/bench_export_map.py [number of packages]
+"""
+import gettext
+import json
+import os
+import sys
+import time
+
+try:
+    from collections import OrderedDict  # 2.7
+except ImportError:
+    from sqlalchemy.util import OrderedDict
+
+import pylons
+
+from ckanext.datajson.package2pod import Package2Pod
+
+EXPORT_MAP_DIR = os.path.join(os.path.dirname(__file__), '..', 'export_map')
+
+
+def load_export_map(filename):
+    with open(os.path.join(EXPORT_MAP_DIR, filename)) as f:
+        export_map = json.load(f, object_pairs_hook=OrderedDict)
+    # the plain catalog export is benchmarked, not the validator
+    export_map['validation_enabled'] = False
+    return export_map
+
+
+def make_package(i):
+    return {
+        'id': 'package-%d' % i,
+        'name': 'package-%d' % i,
+        'title': 'Package %d [[REDACTED-EX B3]]secret[[/REDACTED]]' % i,
+        'notes': 'Description of package %d' % i,
+        'metadata_modified': '2019-01-01T00:00:00.%06d' % i,
+        'maintainer': 'Someone',
+        'maintainer_email': 'someone@example.com',
+        'organization': {'title': 'General Services Administration'},
+        'extras': [
+            {'key': 'access_level', 'value': 'public'},
+            {'key': 'public_access_level', 'value': 'restricted public'},
+            {'key': 'publisher', 'value': 'General Services Administration'},
+            {'key': 'contact_email', 'value': 'someone@example.com'},
+            {'key': 'responsible_party', 'value': 'Someone'},
+            {'key': 'accrual_periodicity', 'value': 'annual'},
+            {'key': 'bureau_code', 'value': '023:00'},
+            {'key': 'program_code', 'value': '023:000, 023:001'},
+            {'key': 'tags', 'value': 'one, two, three'},
+            {'key': 'spatial', 'value': 'United States'},
+            {'key': 'temporal', 'value': '2000-01-15/2010-01-15'},
+            {'key': 'language', 'value': 'en-us'},
+            {'key': 'redacted_spatial', 'value': 'B3'},
+        ],
+        'resources': [
+            {'url': 'http://example.com/%d/data.%s' % (i, fmt), 'mimetype': 'text/%s' % fmt,
+             'format': fmt.upper(), 'name': 'Data %s' % fmt, 'description': 'Data in %s' % fmt}
+            for fmt in ('csv', 'xml', 'json')
+        ],
+    }
+
+
+def bench(export_map, packages, redaction_enabled):
+    start = time.time()
+    for package in packages:
+        Package2Pod.convert_package(package, export_map, redaction_enabled)
+    return len(packages) / (time.time() - start)
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    # the wrappers translate role names, there is no request to provide a translator
+    pylons.translator._push_object(gettext.NullTranslations())
+
+    packages = [make_package(i) for i in range(count)]
+    export_map = load_export_map('export.catalog.map.sample.json')
+
+    # warm up
+    bench(export_map, packages[:100], False)
+
+    for redaction_enabled in (False, True):
+        print '%-20s %8.0f conversions/s' % ('redacted' if redaction_enabled else 'datajson',
+                                              bench(export_map, packages, redaction_enabled))
@@ -0,0 +1,53 @@
+"""
+Datasets validated per second against the POD v1.1 schemas, by jsonschema's
+Draft4Validator and by the compiled SchemaValidator.
+
+    python ckanext/datajson/tests/bench_schema_validator.py [number of datasets]
+
+The datasets are taken from the sample catalogs, one in ten is made invalid.
+"""
+import codecs
+import json
+import os
+import sys
+import time
+
+from ckanext.datajson.schema_validator import get_schema_validator
+
+SAMPLES_DIR = os.path.join(os.path.dirname(__file__), 'datajson-samples')
+SAMPLES = ('arm.data.json', 'www.defense.gov.data.json', 'www2.ed.gov.data.json')
+SCHEMAS = ('federal-v1.1/dataset.json', 'non-federal-v1.1/dataset-non-federal.json')
+
+
+def load_datasets(count):
+    samples = []
+    for filename in SAMPLES:
+        with codecs.open(os.path.join(SAMPLES_DIR, filename), encoding='utf-8-sig', errors='replace') as f:
+            samples.extend(json.load(f)['dataset'])
+
+    datasets = []
+    while len(datasets) < count:
+        for dataset in samples[:count - len(datasets)]:
+            if len(datasets) % 10 == 9:
+                dataset = dict(dataset, accessLevel='open')
+            datasets.append(dataset)
+    return datasets
+
+
+def bench(validator, datasets):
+    start = time.time()
+    for dataset in datasets:
+        if not validator.is_valid(dataset):
+            list(validator.iter_errors(dataset))
+    return len(datasets) / (time.time() - start)
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    datasets = load_datasets(count)
+
+    for schema_path in SCHEMAS:
+        validator = get_schema_validator(schema_path)
+        print '%-45s %-10s %8.0f datasets/s' % (schema_path, 'draft4',
+                                                bench(validator.draft4validator, datasets))
+        print '%-45s %-10s %8.0f datasets/s' % (schema_path, 'compiled', bench(validator, datasets))
@@ -0,0 +1,37 @@
+from nose.tools import assert_equal
+
+try:
+    from ckan.tests.helpers import call_action, reset_db
+    from ckan.tests.factories import Dataset, Group, Organization, Resource
+except ImportError:
+    from ckan.new_tests.helpers import call_action, reset_db
+    from ckan.new_tests.factories import Dataset, Group, Organization, Resource
+from ckan import model
+import ckan.lib.dictization.model_dictize as model_dictize
+
+from ckanext.datajson.bulk_dictize import package_list_dictize
+
+
+class TestPackageListDictize(object):
+
+    @classmethod
+    def setup(cls):
+        reset_db()
+
+    def test_same_as_package_dictize(self):
+        organization = Organization()
+        group = Group()
+        for i in range(3):
+            dataset = Dataset(owner_org=organization['id'],
+                              groups=[{'id': group['id']}],
+                              tags=[{'name': 'tag-%d' % i}, {'name': 'shared'}],
+                              extras=[{'key': 'publisher', 'value': 'GSA'},
+                                      {'key': 'public_access_level', 'value': 'public'}])
+            Resource(package_id=dataset['id'], url='http://example.com/%d.csv' % i)
+        # the removed tag stays as a deleted package_tag row
+        call_action('package_patch', id=dataset['id'], tags=[{'name': 'shared'}])
+
+        packages = model.Group.get(organization['id']).packages(context={'user_is_admin': True})
+
+        expected = [model_dictize.package_dictize(pkg, {'model': model}) for pkg in packages]
+        assert_equal(package_list_dictize(packages, {'model': model}), expected)
@@ -0,0 +1,23 @@
+from nose.tools import assert_equal, assert_in, assert_not_in, assert_is_none
+
+from ckanext.datajson.cache import LRUCache
+
+
+class TestLRUCache(object):
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        # touching 'a' makes 'b' the oldest entry
+        assert_equal(cache.get('a'), 1)
+        cache.set('c', 3)
+        assert_in('a', cache)
+        assert_not_in('b', cache)
+        assert_in('c', cache)
+        assert_equal(len(cache), 2)
+
+    def test_disabled_cache_stores_nothing(self):
+        cache = LRUCache(0)
+        cache.set('a', 1)
+        assert_is_none(cache.get('a'))
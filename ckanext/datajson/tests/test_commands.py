@@ -0,0 +1,133 @@
+import json
+import os
+import shutil
+import tempfile
+
+import mock
+from nose.tools import assert_equal, assert_raises
+
+try:
+    from collections import OrderedDict  # 2.7
+except ImportError:
+    from sqlalchemy.util import OrderedDict
+
+from ckanext.datajson.commands import DataJsonCommand, _write_atomic, _write_site_catalog
+from ckanext.datajson.package2pod import Package2Pod
+
+EXPORT_MAP = OrderedDict([
+    ('catalog_headers', OrderedDict([
+        ('conformsTo', 'https://project-open-data.cio.gov/v1.1/schema'),
+        ('@type', 'dcat:Catalog'),
+    ])),
+])
+
+
+class TestWriteSiteCatalog(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def _write_catalog(self, name, datasets):
+        path = os.path.join(self.directory, name, 'data.json')
+        fragments = [Package2Pod.serialize_dataset(d) for d in datasets]
+        _write_atomic(path, Package2Pod.iter_json_catalog(fragments, EXPORT_MAP), self.directory)
+        return path, [(d.get('identifier'), len(fragment.encode('utf8')))
+                      for d, fragment in zip(datasets, fragments)]
+
+    def _site_catalog(self, catalogs, json_export_map=EXPORT_MAP):
+        path = os.path.join(self.directory, 'data.json')
+        _write_site_catalog(path, catalogs, json_export_map, self.directory)
+        with open(path) as f:
+            return f.read()
+
+    def test_concatenates_organization_catalogs(self):
+        first = [OrderedDict([('title', u'Caf\xe9')]), OrderedDict([('title', 'Two')])]
+        second = [OrderedDict([('title', 'Three')])]
+        catalogs = [self._write_catalog('a', first), self._write_catalog('b', []), self._write_catalog('c', second)]
+
+        fragments = [Package2Pod.serialize_dataset(d) for d in first + second]
+        expected = ''.join(Package2Pod.iter_json_catalog(fragments, EXPORT_MAP))
+        assert_equal(self._site_catalog(catalogs), expected.encode('utf8'))
+
+    def test_no_datasets(self):
+        catalogs = [self._write_catalog('a', [])]
+        assert_equal(self._site_catalog(catalogs), ''.join(Package2Pod.iter_json_catalog([], EXPORT_MAP)))
+
+    def test_duplicate_identifiers_across_catalogs(self):
+        first = [OrderedDict([('title', 'One'), ('identifier', 'a')]),
+                 OrderedDict([('title', 'Two'), ('identifier', 'b')])]
+        second = [OrderedDict([('title', 'Three'), ('identifier', 'b')]),
+                  OrderedDict([('title', 'Four'), ('identifier', 'c')])]
+        catalogs = [self._write_catalog('a', first), self._write_catalog('b', second)]
+
+        json_export_map = OrderedDict(EXPORT_MAP, validation_enabled=True)
+        titles = [d['title'] for d in json.loads(self._site_catalog(catalogs, json_export_map))['dataset']]
+        assert_equal(titles, ['One', 'Two', 'Four'])
+
+        # only checked along with the validation, as the web export does
+        titles = [d['title'] for d in json.loads(self._site_catalog(catalogs))['dataset']]
+        assert_equal(titles, ['One', 'Two', 'Three', 'Four'])
+
+
+class TestValidate(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def _validate(self, catalogs, processes=1, batch_size=2):
+        for name, body in catalogs.iteritems():
+            with open(os.path.join(self.directory, name), 'w') as f:
+                f.write(body)
+        report = os.path.join(self.directory, 'report')
+        # the option parser is shared by the instances, an instance is made without it
+        command = DataJsonCommand.__new__(DataJsonCommand)
+        command.options = mock.Mock(processes=processes, report=report)
+        with mock.patch('ckanext.datajson.commands.VALIDATION_BATCH_SIZE', batch_size):
+            try:
+                command.validate([self.directory])
+            except SystemExit:
+                pass
+        with open(report) as f:
+            return dict((catalog['path'][len(self.directory) + 1:], catalog) for catalog in json.load(f))
+
+    def test_duplicate_identifiers_across_batches(self):
+        datasets = [{'title': 'Dataset %d' % i, 'identifier': 'id-%d' % (i % 3)} for i in range(5)]
+        report = self._validate({'a.json': json.dumps({'dataset': datasets}),
+                                 'b.json': json.dumps({'dataset': datasets[:3]})})
+        assert_equal(report['a.json']['datasets'], 5)
+
+        duplicates = [error['datasets'] for error in report['a.json']['errors']
+                      if error['description'].endswith('is used more than once.')]
+        assert_equal(sorted(duplicates), [['"Dataset 3"'], ['"Dataset 4"']])
+        assert not [error for error in report['b.json']['errors']
+                    if error['description'].endswith('is used more than once.')]
+
+    def test_catalog_errors(self):
+        report = self._validate({'a.json': '[]', 'b.json': '{"dataset": []}',
+                                 'c.json': '{"dataset": [{"title": "a"}, {"title": }]}'})
+        assert_equal([e['heading'] for e in report['a.json']['errors']], ['Invalid JSON'])
+        assert_equal([e['heading'] for e in report['b.json']['errors']], ['Catalog Is Empty'])
+        assert_equal(report['c.json']['datasets'], 1)
+        assert_equal(report['c.json']['errors'][0]['heading'], 'Invalid JSON')
+
+    def test_invalid_dataset_stops_the_catalog(self):
+        # read as a dataset, but not valid JSON
+        datasets = [json.dumps({'title': 'Dataset %d' % i}) for i in range(6)]
+        datasets[2] = '{"title": tru}'
+        catalogs = {'a.json': '{"dataset": [%s]}' % ', '.join(datasets)}
+        report = self._validate(catalogs)
+        assert_equal(report['a.json']['datasets'], 2)
+        assert_equal([e['heading'] for e in report['a.json']['errors'] if e['severity'] == 0], ['Invalid JSON'])
+        for batch_size in (1, 3, 200):
+            assert_equal(self._validate(catalogs, batch_size=batch_size), report)
+
+    def test_same_report_in_a_pool(self):
+        datasets = [{'title': 'Dataset %d' % i, 'identifier': 'id-%d' % (i % 3)} for i in range(5)]
+        catalogs = {'a.json': json.dumps({'dataset': datasets})}
+        assert_equal(self._validate(catalogs, processes=2), self._validate(catalogs))
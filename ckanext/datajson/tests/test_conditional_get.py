@@ -0,0 +1,147 @@
+import os
+import shutil
+import tempfile
+
+import mock
+from nose.tools import assert_equal, assert_not_equal
+
+from ckanext.datajson import helpers
+from ckanext.datajson.helpers import get_export_map_fingerprint
+from ckanext.datajson.plugin import _accepts_gzip, _catalog_version, _gzip_etag, _not_modified
+from ckanext.datajson.registry import JsonFileRegistry
+
+EXPORT_MAP = {'catalog_headers': {'conformsTo': 'https://project-open-data.cio.gov/v1.1/schema'}}
+
+
+def _search(count, newest):
+    results = [{'metadata_modified': newest}] if newest else []
+    return mock.Mock(return_value={'count': count, 'results': results})
+
+
+class TestCatalogVersion(object):
+
+    def setup(self):
+        self.patches = [
+            mock.patch('ckanext.datajson.plugin._organizations_revision', return_value='r1'),
+            mock.patch('ckanext.datajson.plugin._organization_group_ids', return_value=['agency', 'bureau']),
+            mock.patch('ckanext.datajson.plugin._group_packages_version', return_value=(3, '2020-01-01T00:00:00')),
+        ]
+        self.organizations_revision, self.organization_group_ids, self.group_packages_version = \
+            [patch.start() for patch in self.patches]
+
+    def teardown(self):
+        for patch in self.patches:
+            patch.stop()
+
+    def _version(self, count=2, newest='2020-01-01T00:00:00.000000', org=None, json_export_map=EXPORT_MAP):
+        with mock.patch('ckanext.datajson.plugin.p.toolkit.get_action', return_value=_search(count, newest)):
+            return _catalog_version(org, json_export_map)
+
+    def test_etag(self):
+        etag = self._version()
+        assert etag.startswith('"') and etag.endswith('"')
+        assert_equal(self._version(), etag)
+
+    def test_changes(self):
+        etag = self._version()
+        # a dataset deleted or modified, another export map, the catalog of an organization
+        assert_not_equal(self._version(count=1), etag)
+        assert_not_equal(self._version(newest='2020-01-01T00:00:00.001000'), etag)
+        assert_not_equal(self._version(json_export_map=dict(EXPORT_MAP, debug=True)), etag)
+        assert_not_equal(self._version(org='gsa'), etag)
+
+    def test_organization_changes(self):
+        for org in (None, 'gsa'):
+            etag = self._version(org=org)
+            self.organizations_revision.return_value = 'r2'
+            assert_not_equal(self._version(org=org), etag)
+            self.organizations_revision.return_value = 'r1'
+        self.organizations_revision.assert_called_with(['gsa'])
+
+    def test_organization_without_indexed_datasets(self):
+        # the export falls back to the packages of the organization and its sub-agencies
+        etag = self._version(count=0, newest=None, org='agency-id')
+        self.group_packages_version.assert_called_with(['agency', 'bureau'])
+        self.organizations_revision.assert_called_with(['agency', 'bureau'])
+
+        self.group_packages_version.return_value = (4, '2020-01-01T00:00:00')
+        assert_not_equal(self._version(count=0, newest=None, org='agency-id'), etag)
+        self.group_packages_version.return_value = (3, '2020-01-02T00:00:00')
+        assert_not_equal(self._version(count=0, newest=None, org='agency-id'), etag)
+
+    def test_empty_catalog(self):
+        assert self._version(count=0, newest=None)
+        assert not self.group_packages_version.called
+
+
+class TestNotModified(object):
+
+    def _not_modified(self, etag, **headers):
+        with mock.patch('ckanext.datajson.plugin.request', headers=headers):
+            return _not_modified(etag)
+
+    def test_etag_comparison(self):
+        assert self._not_modified('"v1"', **{'If-None-Match': '"v1"'})
+        assert not self._not_modified('"v2"', **{'If-None-Match': '"v1"'})
+        assert self._not_modified('"v1"', **{'If-None-Match': '"v0", "v1"'})
+        assert not self._not_modified('"v1"')
+
+    def test_wildcard(self):
+        assert self._not_modified('"v1"', **{'If-None-Match': ' * '})
+
+    def test_weak_etags(self):
+        assert self._not_modified('"v1"', **{'If-None-Match': 'W/"v1"'})
+        assert self._not_modified('"v1"', **{'If-None-Match': 'W/"v0", W/"v1"'})
+
+    def test_gzip_etag(self):
+        assert_equal(_gzip_etag('"v1"'), '"v1-gzip"')
+        assert self._not_modified('"v1"', **{'If-None-Match': '"v1-gzip"'})
+
+    def test_dates_are_ignored(self):
+        assert not self._not_modified('"v1"', **{'If-Modified-Since': 'Fri, 01 Jan 2999 00:00:00 GMT'})
+
+
+class TestAcceptsGzip(object):
+
+    def _accepts_gzip(self, accept_encoding=None):
+        headers = {'Accept-Encoding': accept_encoding} if accept_encoding is not None else {}
+        with mock.patch('ckanext.datajson.plugin.request', headers=headers):
+            return _accepts_gzip()
+
+    def test_accepted(self):
+        assert self._accepts_gzip('gzip')
+        assert self._accepts_gzip('deflate, GZIP')
+        assert self._accepts_gzip('x-gzip')
+        assert self._accepts_gzip('gzip;q=0.5, identity')
+        assert self._accepts_gzip('gzip; q = 1')
+
+    def test_refused(self):
+        assert not self._accepts_gzip()
+        assert not self._accepts_gzip('')
+        assert not self._accepts_gzip('deflate, br')
+        assert not self._accepts_gzip('gzip;q=0')
+        assert not self._accepts_gzip('gzip;q=0.0, deflate')
+        assert not self._accepts_gzip('gzip;q=bad')
+
+
+class TestExportMapFingerprint(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'map.json')
+        with open(self.path, 'w') as f:
+            f.write('{"b": 1, "a": [{"c": 2}]}')
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def test_computed_once_per_registry_version(self):
+        json_export_map = JsonFileRegistry().get(self.path)
+        with mock.patch.object(helpers.json, 'dumps', wraps=helpers.json.dumps) as dumps:
+            fingerprint = get_export_map_fingerprint(json_export_map)
+            assert_equal(get_export_map_fingerprint(json_export_map), fingerprint)
+            assert_equal(dumps.call_count, 1)
+
+            # mutable maps are hashed every time
+            assert_equal(get_export_map_fingerprint({'b': 1, 'a': [{'c': 2}]}), fingerprint)
+            assert_equal(dumps.call_count, 2)
@@ -123,6 +123,40 @@ class TestDataJSONHarvester(object):
             assert_equal(len(dataset.resources), 1)
             break
     
+    def test_unchanged_catalog_not_gathered_again(self):
+        url = 'http://127.0.0.1:%s/arm' % mock_datajson_source.PORT
+        source = HarvestSourceObj(url=url)
+        harvester = DataJsonHarvester()
+        config = source.config
+
+        obj_ids = harvester.gather_stage(HarvestJobObj(source=source))
+        assert obj_ids
+        # the source config, part of the schema 1.0 source_hash, is left as it is
+        assert_equal(harvest_model.HarvestSource.get(source.id).config, config)
+
+        # objects not imported yet: the catalog is gathered in full again
+        assert_equal(len(harvester.gather_stage(HarvestJobObj(source=source))), len(obj_ids))
+
+        for obj in harvest_model.Session.query(harvest_model.HarvestObject):
+            obj.state = 'COMPLETE'
+        harvest_model.Session.commit()
+        assert_equal(harvester.gather_stage(HarvestJobObj(source=source)), [])
+
+    def test_existing_packages(self):
+        url = 'http://127.0.0.1:%s/arm' % mock_datajson_source.PORT
+        harvested = list(self.run_source(url=url, limit=2))
+        assert harvested
+
+        existing = dict((pkg['id'], pkg) for pkg in
+                        DataJsonHarvester._existing_packages(harvested[0][0].source))
+        assert_equal(len(existing), len(harvested))
+        for harvest_object, result, dataset in harvested:
+            pkg = existing[dataset.id]
+            assert_equal(pkg['name'], dataset.name)
+            assert_equal(pkg['state'], 'active')
+            assert_equal(pkg['identifier'], dataset.extras['identifier'])
+            assert_equal(pkg['source_hash'], dataset.extras['source_hash'])
+
     def test_datason_usda(self):
         url = 'http://127.0.0.1:%s/usda' % mock_datajson_source.PORT
 
@@ -0,0 +1,56 @@
+import json
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+
+import rfc3987
+from mock import patch
+from nose.tools import assert_equal
+
+from ckanext.datajson import datajsonvalidator
+
+
+class TestOmbBureauCodes(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        datajsonvalidator._omb_bureau_codes = None
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+        datajsonvalidator._omb_bureau_codes = None
+
+    def test_bundled_codes(self):
+        codes = datajsonvalidator.get_omb_bureau_codes()
+        assert '015:11' in codes
+        assert '015:99' not in codes
+
+    @patch('ckanext.datajson.datajsonvalidator.urllib2.urlopen')
+    def test_update(self, urlopen):
+        urlopen.return_value = StringIO('Agency Name,Bureau Name,Agency Code,Bureau Code\n'
+                                        'Treasury,Departmental Offices,015,05\n'
+                                        'Treasury,Mint,015,25\n')
+        path = os.path.join(self.directory, 'codes.json')
+
+        assert_equal(datajsonvalidator.update_omb_bureau_codes(path=path), 2)
+        with open(path) as codes_file:
+            assert_equal(json.load(codes_file), ['015:05', '015:25'])
+        assert_equal(datajsonvalidator.get_omb_bureau_codes(), frozenset(['015:05', '015:25']))
+
+
+class TestScalarChecks(object):
+
+    def test_is_url_same_as_rfc3987(self):
+        for value in (u'http://example.com/', u'https://example.com:8080/a/b.csv?x=1&y=%2F#top',
+                      u'http://example.com/a b', u'http://example.com/%zz', u'ftp://example.com/file',
+                      u'http://[::1]/', u'http://ex\xe4mple.com/', u'mailto:someone@example.com',
+                      u'not a url', u'', u'http://example.com/{id}', u'relative/path'):
+            assert_equal(datajsonvalidator.is_url(value), rfc3987.match(value) is not None, value)
+
+    def test_results_are_memoized(self):
+        datajsonvalidator.is_temporal.cache.clear()
+        assert datajsonvalidator.is_temporal(u'2000-01-15/2010-01-15')
+        assert not datajsonvalidator.is_temporal(u'2000-01-15')
+        assert u'2000-01-15/2010-01-15' in datajsonvalidator.is_temporal.cache
+        assert u'2000-01-15' in datajsonvalidator.is_temporal.cache
@@ -0,0 +1,69 @@
+import json
+
+import mock
+from nose.tools import assert_equal
+
+from ckanext.datajson.cache import LRUCache
+from ckanext.datajson.plugin import DataJsonController, DataJsonPlugin
+
+
+def _convert(packages, json_export_map, seen_identifiers=None):
+    for pkg in packages:
+        identifier = pkg.get('identifier', pkg['id'])
+        # the duplicate identifiers check of the validator
+        if json_export_map.get('validation_enabled') and not seen_identifiers.add_if_new(identifier):
+            continue
+        yield {'title': pkg['title'], 'publisher': pkg['organization']['title'], 'identifier': identifier}
+
+
+def _package(org_title='Agency', package_id='p1', **kwargs):
+    pkg = {'id': package_id, 'title': 'Dataset', 'metadata_modified': '2020-01-01T00:00:00.000000',
+           'organization': {'name': 'agency', 'title': org_title, 'revision_id': 'r1'}}
+    pkg.update(kwargs)
+    return pkg
+
+
+class TestFragmentCache(object):
+
+    def setup(self):
+        DataJsonPlugin.fragment_cache = LRUCache(10)
+
+    def teardown(self):
+        DataJsonPlugin.fragment_cache = None
+
+    def _export(self, packages, json_export_map):
+        with mock.patch.object(DataJsonController, '_iter_datajson_entries', side_effect=_convert) as convert:
+            fragments = list(DataJsonController()._iter_datajson_fragments(packages, json_export_map))
+        return [json.loads(fragment) for fragment in fragments], convert.call_count
+
+    def test_valid_entries_are_cached(self):
+        json_export_map = {'validation_enabled': True}
+        assert_equal(self._export([_package()], json_export_map)[1], 1)
+        datasets, conversions = self._export([_package()], json_export_map)
+        assert_equal(conversions, 0)
+        assert_equal(datasets, [{'title': 'Dataset', 'publisher': 'Agency', 'identifier': 'p1'}])
+
+    def test_organization_changes_are_exported(self):
+        self._export([_package()], {})
+        datasets, conversions = self._export([_package('Renamed Agency')], {})
+        assert_equal(conversions, 1)
+        assert_equal(datasets, [{'title': 'Dataset', 'publisher': 'Renamed Agency', 'identifier': 'p1'}])
+
+    def test_duplicate_identifiers_of_cached_entries(self):
+        json_export_map = {'validation_enabled': True}
+        packages = [_package(package_id='p1', identifier='shared'), _package(package_id='p2', identifier='shared')]
+        # each one is valid on its own
+        for pkg in packages:
+            assert_equal(len(self._export([pkg], json_export_map)[0]), 1)
+
+        datasets, conversions = self._export(packages, json_export_map)
+        assert_equal(conversions, 0)
+        assert_equal(datasets, [{'title': 'Dataset', 'publisher': 'Agency', 'identifier': 'shared'}])
+
+    def test_duplicate_identifiers_of_converted_entries(self):
+        json_export_map = {'validation_enabled': True}
+        self._export([_package(package_id='p1', identifier='shared')], json_export_map)
+        datasets, conversions = self._export([_package(package_id='p1', identifier='shared'),
+                                              _package(package_id='p2', identifier='shared')], json_export_map)
+        assert_equal(conversions, 1)
+        assert_equal(len(datasets), 1)
@@ -0,0 +1,64 @@
+import time
+
+import mock
+from nose.tools import assert_equal
+
+from ckanext.datajson.plugin import DataJsonController, DataJsonPlugin
+
+GROUP_PACKAGES = {
+    'agency': ['a1', 'shared', 'a2'],
+    'bureau-1': ['b1', 'shared'],
+    'bureau-2': [],
+    'bureau-3': ['c1', 'a1', 'c2'],
+    'bureau-4': ['d1'],
+}
+
+
+def _group(sub_agencies):
+    extras = {'sub-agencies': mock.Mock(state='active', value=sub_agencies)}
+    return mock.Mock(**{'extras.col.target': extras})
+
+
+class TestGetPackages(object):
+
+    def setup(self):
+        self.loaded = []
+        self.patches = [
+            mock.patch('ckanext.datajson.plugin.model.Group.get',
+                       return_value=_group('bureau-1,bureau-2,bureau-3,bureau-4')),
+            mock.patch.object(DataJsonController, 'get_all_group_packages',
+                              side_effect=self._get_all_group_packages),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def teardown(self):
+        for patch in self.patches:
+            patch.stop()
+
+    def _get_all_group_packages(self, group_id, with_private):
+        self.loaded.append(group_id)
+        # later organizations load faster, the order must not depend on it
+        time.sleep(0.05 * (5 - len(self.loaded)))
+        return [{'id': package_id, 'group': group_id} for package_id in GROUP_PACKAGES[group_id]]
+
+    def _get_packages(self, threads):
+        DataJsonPlugin.export_threads = threads
+        return DataJsonController().get_packages('agency')
+
+    def test_order_and_duplicates(self):
+        expected = [('a1', 'agency'), ('shared', 'agency'), ('a2', 'agency'), ('b1', 'bureau-1'),
+                    ('c1', 'bureau-3'), ('c2', 'bureau-3'), ('d1', 'bureau-4')]
+        for threads in (1, 2, 5):
+            self.loaded = []
+            packages = [(pkg['id'], pkg['group']) for pkg in self._get_packages(threads)]
+            assert_equal(packages, expected)
+            assert_equal(sorted(self.loaded), sorted(GROUP_PACKAGES.keys()))
+
+    def test_look_ahead_is_bounded(self):
+        packages = self._get_packages(2)
+        next(packages)
+        time.sleep(0.5)
+        # the organization being consumed and the next one
+        assert_equal(len(self.loaded), 2)
+        packages.close()
@@ -0,0 +1,108 @@
+import codecs
+import hashlib
+import json
+import os
+import StringIO
+
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.datajson.jsonstream import BudgetExceeded, BudgetReader, JSONStreamError, SpooledCatalog, \
+    iter_catalog_datasets
+
+SAMPLES_DIR = os.path.join(os.path.dirname(__file__), 'datajson-samples')
+
+
+def _read(fileobj, **kwargs):
+    headers = {}
+    datasets = list(iter_catalog_datasets(fileobj, headers, **kwargs))
+    return headers, datasets
+
+
+class TestIterCatalogDatasets(object):
+
+    def test_same_as_json_load(self):
+        for filename in ('arm.data.json', 'www2.ed.gov.data.json'):
+            path = os.path.join(SAMPLES_DIR, filename)
+            with codecs.open(path, encoding='utf-8-sig') as f:
+                catalog = json.load(f)
+            with open(path, 'rb') as f:
+                headers, datasets = _read(f)
+            assert_equal(datasets, catalog.pop('dataset'))
+            assert_equal(headers, catalog)
+
+    def test_small_chunks(self):
+        catalog = {u'conformsTo': u'x', u'dataset': [{u'title': u'a "b" \u00e9\\', u'keyword': [1, 2.5, True, None]},
+                                                    {u'nested': {u'k': [[], {}]}}], u'@type': u'dcat:Catalog'}
+        body = json.dumps(catalog, ensure_ascii=False, indent=2).encode('utf-8')
+        headers, datasets = _read(StringIO.StringIO(body), chunk_size=1)
+        assert_equal(datasets, catalog.pop(u'dataset'))
+        assert_equal(headers, catalog)
+
+    def test_invalid_documents(self):
+        for body in ('', '[]', '{"dataset": [{"title": "a"}', '{"dataset": [1 2]}', '{"a": 1} 2', '{a: 1}',
+                     '{"dataset": [nul]}'):
+            assert_raises(JSONStreamError, _read, StringIO.StringIO(body))
+
+    def test_datasets_before_an_error_are_read(self):
+        datasets = iter_catalog_datasets(StringIO.StringIO('{"dataset": [{"title": "a"}, {"title": '))
+        assert_equal(next(datasets), {'title': 'a'})
+        assert_raises(JSONStreamError, next, datasets)
+
+
+class TestBudgetReader(object):
+
+    def test_max_bytes(self):
+        reader = BudgetReader(StringIO.StringIO('{"dataset": [' + '{},' * 100 + '{}]}'), max_bytes=50)
+        assert_raises(BudgetExceeded, _read, reader, chunk_size=8)
+
+    def test_max_seconds(self):
+        reader = BudgetReader(StringIO.StringIO('{}'), max_seconds=1)
+        reader.deadline -= 2
+        assert_raises(BudgetExceeded, reader.check_time)
+
+
+class TestSpooledCatalog(object):
+
+    def _catalog(self, filename, spool_size):
+        with open(os.path.join(SAMPLES_DIR, filename), 'rb') as f:
+            return SpooledCatalog(StringIO.StringIO(f.read()), spool_size=spool_size)
+
+    def test_iterated_again_from_the_spool(self):
+        path = os.path.join(SAMPLES_DIR, 'www2.ed.gov.data.json')
+        with codecs.open(path, encoding='utf-8-sig') as f:
+            expected = json.load(f)
+        datasets = expected.pop('dataset')
+        for spool_size in (1024, 1024 * 1024):
+            catalog = self._catalog('www2.ed.gov.data.json', spool_size)
+            first = iter(catalog)
+            next(first)
+            # the first iteration is left before the end of the catalog
+            assert_equal(list(catalog), datasets)
+            assert_equal(list(catalog), datasets)
+            assert_equal(catalog.headers, expected)
+
+    def test_body_hash(self):
+        with open(os.path.join(SAMPLES_DIR, 'arm.data.json'), 'rb') as f:
+            body = f.read()
+        catalog = self._catalog('arm.data.json', 1024)
+        assert_equal(catalog.body_hash, None)
+        list(catalog)
+        assert_equal(catalog.body_hash, hashlib.sha1(body).hexdigest())
+
+    def test_fallback_encoding(self):
+        path = os.path.join(SAMPLES_DIR, 'www.defense.gov.data.json')
+        with open(path, 'rb') as f:
+            expected = json.loads(f.read().decode('cp1252'))['dataset']
+        catalog = self._catalog('www.defense.gov.data.json', 1024 * 1024)
+        assert_equal(list(catalog), expected)
+        assert_equal(catalog.encoding, 'cp1252')
+
+    def test_dataset_array(self):
+        catalog = SpooledCatalog(StringIO.StringIO('\xef\xbb\xbf[{"title": "a"}, {"title": "\xe9"}]'))
+        assert_equal(catalog.headers, None)
+        assert_equal(list(catalog), [{'title': 'a'}, {'title': u'\xe9'}])
+        assert_equal(catalog.encoding, 'cp1252')
+
+    def test_invalid_catalog(self):
+        catalog = SpooledCatalog(StringIO.StringIO('{"dataset": [{"title": "a"}'))
+        assert_raises(ValueError, list, catalog)
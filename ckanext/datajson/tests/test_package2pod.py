@@ -0,0 +1,136 @@
+import json
+from multiprocessing.pool import ThreadPool
+
+from nose.tools import assert_equal
+
+try:
+    from collections import OrderedDict  # 2.7
+except ImportError:
+    from sqlalchemy.util import OrderedDict
+
+from ckanext.datajson.package2pod import ConversionContext, Package2Pod, SeenIdentifiers
+
+EXPORT_MAP = OrderedDict([
+    ('catalog_headers', OrderedDict([
+        ('conformsTo', 'https://project-open-data.cio.gov/v1.1/schema'),
+        ('@type', 'dcat:Catalog'),
+    ])),
+])
+
+
+class TestIterJsonCatalog(object):
+
+    def _assert_same_catalog(self, datasets):
+        fragments = (Package2Pod.serialize_dataset(d) for d in datasets)
+        streamed = ''.join(Package2Pod.iter_json_catalog(fragments, EXPORT_MAP))
+        expected = json.dumps(Package2Pod.wrap_json_catalog(datasets, EXPORT_MAP), indent=2)
+        assert_equal(json.loads(streamed, object_pairs_hook=OrderedDict),
+                     json.loads(expected, object_pairs_hook=OrderedDict))
+        # layout matches the non-streaming output, not only the content
+        assert_equal([l.rstrip() for l in streamed.splitlines()], [l.rstrip() for l in expected.splitlines()])
+
+    def test_empty_catalog(self):
+        self._assert_same_catalog([])
+
+    def test_compact_catalog(self):
+        datasets = [
+            OrderedDict([('@type', 'dcat:Dataset'), ('title', u'Caf\xe9')]),
+            OrderedDict([('@type', 'dcat:Dataset'), ('keyword', ['a', 'b'])]),
+        ]
+        fragments = (Package2Pod.serialize_dataset(d, indent=None, ensure_ascii=False) for d in datasets)
+        streamed = ''.join(Package2Pod.iter_json_catalog(fragments, EXPORT_MAP, indent=None, ensure_ascii=False))
+        assert_equal(streamed, json.dumps(Package2Pod.wrap_json_catalog(datasets, EXPORT_MAP), ensure_ascii=False))
+
+    def test_datasets(self):
+        self._assert_same_catalog([
+            OrderedDict([('@type', 'dcat:Dataset'), ('title', 'First'), ('keyword', ['a', 'b'])]),
+            OrderedDict([('@type', 'dcat:Dataset'), ('title', 'Line\nbreak'),
+                         ('publisher', OrderedDict([('name', 'GSA')]))]),
+        ])
+
+
+class TestExportMapFields(object):
+
+    export_map = OrderedDict([
+        ('dataset_fields_map', OrderedDict([
+            ('title', {'field': 'title'}),
+            ('accessLevel', {'extra': True, 'field': 'Access Level', 'default': 'public'}),
+            ('keyword', {'extra': True, 'type': 'array', 'field': 'tags', 'split': ','}),
+            ('accrualPeriodicity', {'extra': True, 'field': 'Accrual Periodicity',
+                                    'wrapper': 'fix_accrual_periodicity'}),
+            ('spatial', {'extra': True, 'field': 'Spatial'}),
+        ])),
+    ])
+
+    package = {
+        'id': 'abc',
+        'title': ' Title ',
+        'extras': [
+            {'key': 'public_access_level', 'value': 'restricted public'},
+            {'key': 'tags', 'value': 'one,two'},
+            {'key': 'accrual_periodicity', 'value': 'Annual'},
+            {'key': 'spatial', 'value': 'United States'},
+            {'key': 'redacted_tags', 'value': 'B3'},
+        ],
+    }
+
+    def test_compiled_once_per_export_map(self):
+        assert Package2Pod.compile_export_map(self.export_map) is Package2Pod.compile_export_map(self.export_map)
+
+    def test_export(self):
+        dataset = Package2Pod.export_map_fields(self.package, self.export_map)
+        assert_equal(dataset.items(), [
+            ('@type', 'dcat:Dataset'),
+            ('title', 'Title'),
+            ('accessLevel', 'public'),
+            ('keyword', ['one', 'two']),
+            ('accrualPeriodicity', 'R/P1Y'),
+            ('spatial', 'United States'),
+        ])
+
+    def test_export_redacted(self):
+        dataset = Package2Pod.export_map_fields(self.package, self.export_map, redaction_enabled=True)
+        assert_equal(dataset['keyword'], '[[REDACTED-EX B3]]')
+        assert_equal(dataset['spatial'], 'United States')
+
+    def test_concurrent_conversions(self):
+        packages = []
+        for i in range(20):
+            package = dict(self.package, id='pkg-%d' % i, title='Title %d' % i)
+            package['extras'] = self.package['extras'] + [{'key': 'spatial', 'value': 'Place %d' % i}]
+            packages.append(package)
+        expected = [Package2Pod.export_map_fields(package, self.export_map) for package in packages]
+
+        pool = ThreadPool(4)
+        try:
+            converted = pool.map(lambda package: Package2Pod.export_map_fields(package, self.export_map),
+                                 packages * 5)
+        finally:
+            pool.close()
+        assert_equal(converted, expected * 5)
+
+
+class TestSeenIdentifiers(object):
+
+    def test_add_if_new(self):
+        seen = SeenIdentifiers()
+        assert seen.add_if_new('a')
+        assert not seen.add_if_new('a')
+        assert 'a' in seen
+        assert 'b' not in seen
+
+
+class TestConversionContext(object):
+
+    def test_extras_lookup(self):
+        package = {
+            'id': 'abc',
+            'extras': [
+                {'key': 'Public Access-Level', 'value': ' public '},
+                {'key': 'extras_rollup', 'value': json.dumps({'bureau_code': ['015:11', '015:12']})},
+            ],
+        }
+        context = ConversionContext(package, EXPORT_MAP)
+        assert_equal(context.get_extra('public_access_level'), 'public')
+        assert_equal(context.get_extra('Bureau Code'), '015:11, 015:12')
+        assert_equal(context.get_extra('spatial', ' none '), 'none')
@@ -0,0 +1,42 @@
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.datajson.registry import JsonFileRegistry
+
+
+class TestJsonFileRegistry(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'map.json')
+        self._write('{"b": 1, "a": [{"c": 2}]}')
+        self.registry = JsonFileRegistry()
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def _write(self, content, mtime=None):
+        with open(self.path, 'w') as f:
+            f.write(content)
+        if mtime:
+            os.utime(self.path, (mtime, mtime))
+
+    def test_parsed_once(self):
+        content = self.registry.get(self.path)
+        assert_equal(content.keys(), ['b', 'a'])
+        assert self.registry.get(self.path) is content
+
+    def test_reloaded_when_modified(self):
+        self.registry.get(self.path)
+        self._write('{"b": 2}', mtime=os.stat(self.path).st_mtime + 10)
+        assert_equal(self.registry.get(self.path), {'b': 2})
+
+    def test_read_only(self):
+        content = self.registry.get(self.path)
+        assert_raises(TypeError, content.__setitem__, 'b', 2)
+        assert_raises(TypeError, content.update, {'b': 2})
+        assert_raises(TypeError, content['a'][0].pop, 'c')
+        assert_raises(AttributeError, getattr, content['a'], 'append')
@@ -0,0 +1,73 @@
+import codecs
+import copy
+import json
+import os
+
+from nose.tools import assert_equal
+
+from ckanext.datajson.schema_validator import SchemaValidator, get_schema_validator
+
+SAMPLE = os.path.join(os.path.dirname(__file__), 'datajson-samples', 'www.defense.gov.data.json')
+SCHEMAS = ('federal-v1.1/dataset.json', 'non-federal-v1.1/dataset-non-federal.json')
+
+VALUES = (None, 123, True, '', 'not valid', [], {}, ['a', 'a'], '[[REDACTED-EX B3]]', 'http://example.com/')
+
+
+def _datasets():
+    # the sample is not valid utf-8
+    with codecs.open(SAMPLE, encoding='utf-8-sig', errors='replace') as f:
+        return json.load(f)['dataset'][:20]
+
+
+def _cases():
+    for dataset in _datasets():
+        yield dataset
+        for key in dataset:
+            for value in VALUES:
+                yield dict(dataset, **{key: value})
+            yield dict((k, v) for k, v in dataset.iteritems() if k != key)
+        for value in VALUES:
+            mutated = copy.deepcopy(dataset)
+            mutated['distribution'][0]['mediaType'] = value
+            yield mutated
+        yield dict(dataset, publisher={'name': 'Agency', 'subOrganizationOf': {'name': 1}})
+        yield dict(dataset, publisher={'name': 'Agency', 'subOrganizationOf': {'name': 'Department'}})
+
+
+class TestSchemaValidator(object):
+
+    def test_same_as_draft4(self):
+        cases = list(_cases())
+        for schema_path in SCHEMAS:
+            validator = get_schema_validator(schema_path)
+            assert validator._check is not None
+            for case in cases:
+                assert_equal(validator.is_valid(case), validator.draft4validator.is_valid(case))
+
+    def test_errors_of_invalid_instances(self):
+        validator = get_schema_validator('federal-v1.1/dataset.json')
+        dataset = _datasets()[0]
+        assert_equal(list(validator.iter_errors(dataset)), [])
+
+        invalid = dict(dataset, accessLevel='open')
+        errors = [e.message for e in validator.iter_errors(invalid)]
+        assert errors
+        assert_equal(errors, [e.message for e in validator.draft4validator.iter_errors(invalid)])
+
+    def test_keywords(self):
+        validator = SchemaValidator({
+            'definitions': {'positive': {'type': 'integer', 'minimum': 0, 'exclusiveMinimum': True}},
+            'type': 'object',
+            'properties': {
+                'count': {'$ref': '#/definitions/positive'},
+                'kind': {'oneOf': [{'enum': ['a', 'b']}, {'enum': ['b', 'c']}]},
+                'tags': {'type': 'array', 'items': {'type': 'string'}, 'maxItems': 2},
+                'name': {'not': {'pattern': '^_'}},
+            },
+            'additionalProperties': False,
+        })
+        assert validator.is_valid({'count': 1, 'kind': 'a', 'tags': ['x'], 'name': 'n'})
+        for invalid in ({'count': 0}, {'count': True}, {'kind': 'b'}, {'tags': ['x', 'y', 'z']},
+                        {'tags': [1]}, {'name': '_n'}, {'other': 1}, []):
+            assert not validator.is_valid(invalid), invalid
+            assert_equal(validator.is_valid(invalid), validator.draft4validator.is_valid(invalid))
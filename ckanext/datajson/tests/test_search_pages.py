@@ -0,0 +1,210 @@
+import datetime
+import re
+import threading
+import time
+
+import mock
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.datajson.plugin import DataJsonPlugin, DataJsonController, _iter_pages, _keyset_filter, \
+    _solr_datetime
+
+WINDOW_REGEX = re.compile(r'metadata_modified:\[(\*|"[^"]+") TO "([^"]+)"\]')
+KEYSET_REGEX = re.compile(r'\(metadata_modified:\[\* TO "([^"]+)"\} OR '
+                          r'\(metadata_modified:"([^"]+)" AND id:\[\* TO "([^"]+)"\}\)\)')
+# the shard of ids, not the id of the keyset
+ID_RANGE_REGEX = re.compile(r'id:\[(\*|"[^"]+") TO (\*|"[^"]+")\}(?!\))')
+
+
+def _sort_key(pkg):
+    return _solr_datetime(pkg['metadata_modified']), pkg['id']
+
+
+class FakeIndex(object):
+    """
+    package_search over a list of datasets, understanding the filters built
+    by _iter_ckan_datasets
+    """
+
+    def __init__(self, datasets):
+        self.datasets = datasets
+        self.searches = []
+
+    def __call__(self, context, data_dict):
+        self.searches.append(data_dict)
+        fq = data_dict['fq']
+        assert_equal(data_dict['sort'], 'metadata_modified desc, id desc')
+        results = sorted(self.datasets, key=_sort_key, reverse=True)
+
+        window = WINDOW_REGEX.search(fq)
+        if window:
+            lower, upper = window.groups()
+            lower = None if lower == '*' else lower.strip('"')
+            results = [pkg for pkg in results if (lower is None or _solr_datetime(pkg['metadata_modified']) >= lower)
+                       and _solr_datetime(pkg['metadata_modified']) <= upper]
+        keyset = KEYSET_REGEX.search(fq)
+        if keyset:
+            after = (keyset.group(1), keyset.group(3))
+            results = [pkg for pkg in results if _sort_key(pkg) < after]
+        id_range = ID_RANGE_REGEX.search(fq)
+        if id_range:
+            lower, upper = [None if bound == '*' else bound.strip('"') for bound in id_range.groups()]
+            results = [pkg for pkg in results
+                       if (lower is None or pkg['id'] >= lower) and (upper is None or pkg['id'] < upper)]
+        return {'count': len(results), 'results': [dict(pkg) for pkg in results[:data_dict['rows']]]}
+
+
+def _dataset(package_id, metadata_modified='2020-01-01T00:00:00.000000'):
+    return {'id': package_id, 'metadata_modified': metadata_modified}
+
+
+def _now():
+    return datetime.datetime.utcnow().isoformat()
+
+
+class TestSearchPages(object):
+
+    def setup(self):
+        DataJsonPlugin.search_rows = 2
+        DataJsonPlugin.export_threads = 1
+
+    def _crawl(self, index):
+        with mock.patch('ckanext.datajson.plugin.p.toolkit.get_action', return_value=index):
+            return [pkg['id'] for pkg in DataJsonController._iter_ckan_datasets()]
+
+    def test_solr_datetime(self):
+        assert_equal(_solr_datetime('2019-05-01T10:20:30.123456'), '2019-05-01T10:20:30.123Z')
+        assert_equal(_solr_datetime('2019-05-01T10:20:30.123Z'), '2019-05-01T10:20:30.123Z')
+        # sorted before the later timestamps of the same second
+        assert_equal(_solr_datetime('2019-05-01T10:20:30'), '2019-05-01T10:20:30.000Z')
+        assert_equal(_solr_datetime('2019-05-01T10:20:30.5'), '2019-05-01T10:20:30.500Z')
+        assert _solr_datetime('2019-05-01T10:20:30') < _solr_datetime('2019-05-01T10:20:30.001')
+
+    def test_keyset_filter(self):
+        assert_equal(_keyset_filter('2019-05-01T10:20:30.123456', 'abc'),
+                     '(metadata_modified:[* TO "2019-05-01T10:20:30.123Z"} OR '
+                     '(metadata_modified:"2019-05-01T10:20:30.123Z" AND id:[* TO "abc"}))')
+
+    def test_most_recently_modified_first(self):
+        datasets = [_dataset(package_id, '2020-01-0%dT00:00:00.000000' % day)
+                    for day, package_id in [(3, 'a'), (1, 'b'), (5, 'c'), (2, 'd'), (4, 'e')]]
+        assert_equal(self._crawl(FakeIndex(datasets)), ['c', 'e', 'a', 'd', 'b'])
+
+    def test_ties_on_metadata_modified(self):
+        # the same millisecond for Solr, different microseconds for CKAN
+        datasets = [_dataset(package_id, '2020-01-01T00:00:00.00000%d' % i)
+                    for i, package_id in enumerate(['e', 'a', 'd', 'b', 'c'])]
+        datasets.append(_dataset('0', '2020-01-01T00:00:01'))
+        assert_equal(self._crawl(FakeIndex(datasets)), ['0', 'e', 'd', 'c', 'b', 'a'])
+
+    def test_datasets_modified_during_the_crawl_are_exported_once(self):
+        index = FakeIndex([_dataset(package_id, '2020-01-0%dT00:00:00.000000' % (7 - i))
+                           for i, package_id in enumerate('abcdef')])
+
+        def search(context, data_dict):
+            result = index(context, data_dict)
+            if len(index.searches) == 1:
+                # "a" was returned already, "f" was not reached yet
+                index.datasets[0] = _dataset('a', _now())
+                index.datasets[5] = _dataset('f', _now())
+            return result
+
+        assert_equal(self._crawl(search), ['a', 'b', 'c', 'd', 'e', 'f'])
+
+    def test_datasets_modified_while_catching_up(self):
+        index = FakeIndex([_dataset(package_id, '2020-01-0%dT00:00:00.000000' % (7 - i))
+                           for i, package_id in enumerate('abcdef')])
+
+        def search(context, data_dict):
+            result = index(context, data_dict)
+            if len(index.searches) == 1:
+                index.datasets[4] = _dataset('e', _now())
+                index.datasets[5] = _dataset('f', _now())
+            elif len(index.searches) == 6:
+                # the first search for the modified datasets, the one it did not reach is modified again
+                returned = result['results'][0]['id']
+                time.sleep(0.01)
+                for i, pkg in enumerate(index.datasets):
+                    if pkg['id'] in 'ef' and pkg['id'] != returned:
+                        index.datasets[i] = _dataset(pkg['id'], _now())
+            return result
+
+        DataJsonPlugin.search_rows = 1
+        ids = self._crawl(search)
+        assert_equal(ids[:4], ['a', 'b', 'c', 'd'])
+        assert_equal(sorted(ids[4:]), ['e', 'f'])
+
+    def test_modified_datasets_are_looked_for_until_there_is_none(self):
+        index = FakeIndex([_dataset('a')])
+        self._crawl(index)
+        assert_equal([WINDOW_REGEX.search(search['fq']).group(1) for search in index.searches][:1], ['*'])
+        assert_equal(len(index.searches), 2)
+
+        index = FakeIndex([])
+        assert_equal(self._crawl(index), [])
+        assert_equal(len(index.searches), 1)
+
+
+class TestShardedSearchPages(object):
+
+    def setup(self):
+        DataJsonPlugin.search_rows = 3
+        DataJsonPlugin.export_threads = 4
+        # ids spread over the whole range, metadata_modified unrelated to the id
+        self.datasets = [_dataset('%02x-%d' % (i * 7 % 256, i), '2020-01-01T00:00:%02d.000000' % (i * 13 % 60))
+                         for i in range(100)]
+        self.expected = [pkg['id'] for pkg in sorted(self.datasets, key=_sort_key, reverse=True)]
+
+    def _pages(self, index, threads=4):
+        with mock.patch('ckanext.datajson.plugin.p.toolkit.get_action', return_value=index):
+            return list(_iter_pages('*:*', 'dataset_type:dataset', 3, None, threads))
+
+    def test_shards_cover_all_ids_in_order(self):
+        for threads in (2, 3, 4, 7):
+            pages = self._pages(FakeIndex(self.datasets), threads)
+            assert_equal([pkg['id'] for page in pages for pkg in page], self.expected)
+            assert_equal([len(page) for page in pages], [3] * 33 + [1])
+
+    def test_datasets_modified_during_the_crawl_show_up_once(self):
+        index = FakeIndex(self.datasets)
+
+        def search(context, data_dict):
+            result = index(context, data_dict)
+            if len(index.searches) == 10:
+                for i, pkg in enumerate(index.datasets):
+                    index.datasets[i] = _dataset(pkg['id'], _now())
+            return result
+
+        with mock.patch('ckanext.datajson.plugin.p.toolkit.get_action', return_value=search):
+            ids = [pkg['id'] for pkg in DataJsonController._iter_ckan_datasets()]
+        assert_equal(sorted(ids), sorted(self.expected))
+        # the first page comes before the change
+        assert_equal(ids[:3], self.expected[:3])
+
+    def test_worker_errors_reach_the_consumer(self):
+        index = FakeIndex(self.datasets)
+
+        def search(context, data_dict):
+            if 'id:["80" TO "c0"}' in data_dict['fq']:
+                raise RuntimeError('Solr is down')
+            return index(context, data_dict)
+
+        with assert_raises(RuntimeError):
+            self._pages(search)
+        self._assert_threads_stop()
+
+    def test_early_exit_releases_the_threads(self):
+        with mock.patch('ckanext.datajson.plugin.p.toolkit.get_action', return_value=FakeIndex(self.datasets)):
+            pages = _iter_pages('*:*', 'dataset_type:dataset', 3, None, 4)
+            next(pages)
+            # the shards fill their queues and wait for the consumer
+            time.sleep(0.2)
+            pages.close()
+        self._assert_threads_stop()
+
+    @staticmethod
+    def _assert_threads_stop():
+        deadline = time.time() + 5
+        while any(thread.name.startswith('datajson-search-') for thread in threading.enumerate()):
+            assert time.time() < deadline, 'search threads still running'
+            time.sleep(0.1)
@@ -0,0 +1,181 @@
+import StringIO
+import gzip
+import os
+import shutil
+import tempfile
+
+import mock
+from nose.tools import assert_equal, assert_is_none, assert_raises
+
+from ckanext.datajson.plugin import DataJsonController, DataJsonPlugin
+from ckanext.datajson.snapshot import CatalogSnapshot, iter_file
+
+
+class TestCatalogSnapshot(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.snapshot = CatalogSnapshot(self.directory)
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def _save(self, key, body, version='v1'):
+        self.snapshot.save(key, version, body, self.snapshot.current_generation())
+
+    def test_tee_publishes_complete_catalog(self):
+        assert_is_none(self.snapshot.open('catalog', 'v1'))
+        assert_equal(list(self.snapshot.tee('catalog', 'v1', ['{', '}'])), ['{', '}'])
+        assert_equal(''.join(iter_file(self.snapshot.open('catalog', 'v1'))), '{}')
+
+    def test_gzipped_copy(self):
+        self._save('catalog', '{"dataset": []}')
+        with gzip.GzipFile(fileobj=self.snapshot.open('catalog', 'v1', gzipped=True)) as gz:
+            assert_equal(gz.read(), '{"dataset": []}')
+
+    def test_snapshot_of_another_version_is_not_opened(self):
+        self._save('catalog', '{}')
+        assert_is_none(self.snapshot.open('catalog', 'v2'))
+        assert_is_none(self.snapshot.open('catalog', 'v2', gzipped=True))
+
+        # the snapshot of the new version replaces the old one
+        self._save('catalog', '{"dataset": []}', 'v2')
+        assert_equal(''.join(iter_file(self.snapshot.open('catalog', 'v2'))), '{"dataset": []}')
+        assert_is_none(self.snapshot.open('catalog', 'v1'))
+        assert_equal(len(os.listdir(self.directory)), 2)
+
+    def test_failed_build_is_not_published(self):
+        def chunks():
+            yield '{'
+            raise ValueError('search failed')
+
+        with assert_raises(ValueError):
+            list(self.snapshot.tee('catalog', 'v1', chunks()))
+        assert_is_none(self.snapshot.open('catalog', 'v1'))
+        assert_equal(os.listdir(self.directory), [])
+
+    def test_invalidate_during_build_discards_snapshot(self):
+        def chunks():
+            yield '{'
+            self.snapshot.invalidate()
+            yield '}'
+
+        list(self.snapshot.tee('catalog', 'v1', chunks()))
+        assert_is_none(self.snapshot.open('catalog', 'v1'))
+        assert_equal(os.listdir(self.directory), ['.generation'])
+
+    def test_invalidate_before_save_discards_catalog(self):
+        generation = self.snapshot.current_generation()
+        self.snapshot.invalidate()
+        self.snapshot.save('catalog', 'v1', '{}', generation)
+        assert_is_none(self.snapshot.open('catalog', 'v1'))
+
+    def test_invalidate_while_publishing_hides_snapshot(self):
+        # the build sees the generation it started with up to the end, as if
+        # invalidate() ran right after the check
+        generation = self.snapshot.current_generation()
+        with mock.patch.object(CatalogSnapshot, 'current_generation', return_value=generation):
+            chunks = self.snapshot.tee('catalog', 'v1', ['{}'])
+            next(chunks)
+            self.snapshot.invalidate()
+            list(chunks)
+        assert_is_none(self.snapshot.open('catalog', 'v1'))
+        assert_is_none(self.snapshot.open('catalog', 'v1', gzipped=True))
+
+    def test_empty_catalog_is_not_published(self):
+        assert_equal(list(self.snapshot.tee('catalog', 'v1', iter([]))), [])
+        self._save('catalog', '')
+        assert_is_none(self.snapshot.open('catalog', 'v1'))
+        assert_is_none(self.snapshot.open('catalog', 'v1', gzipped=True))
+
+    def test_invalidate_drops_snapshots(self):
+        self._save('catalog', '{}')
+        self._save('org-gsa', '{}')
+        self.snapshot.invalidate()
+        assert_is_none(self.snapshot.open('catalog', 'v1'))
+        assert_is_none(self.snapshot.open('org-gsa', 'v1'))
+        assert_is_none(self.snapshot.open('catalog', 'v1', gzipped=True))
+        assert_equal(os.listdir(self.directory), ['.generation'])
+
+
+class TestControllerSnapshot(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        DataJsonPlugin.snapshot = CatalogSnapshot(self.directory)
+        DataJsonPlugin.streaming_enabled = False
+        DataJsonPlugin.map_filename = 'export.map.json'
+        self.patches = [
+            mock.patch('ckanext.datajson.plugin._catalog_version', return_value='"v1"'),
+        ]
+        self.catalog_version = self.patches[0].start()
+
+    def teardown(self):
+        for patch in self.patches:
+            patch.stop()
+        DataJsonPlugin.snapshot = None
+        shutil.rmtree(self.directory)
+
+    def _generate(self, make_json, **headers):
+        self.response = mock.Mock(headers={'Cache-Control': '', 'Pragma': ''})
+        with mock.patch('ckanext.datajson.plugin.response', self.response), \
+                mock.patch('ckanext.datajson.plugin.request', headers=headers), \
+                mock.patch.object(DataJsonController, 'make_json', side_effect=make_json):
+            body = DataJsonController().generate_output('json')
+        # a string when built, chunks of the file when served from the snapshot
+        return body if isinstance(body, basestring) else ''.join(body)
+
+    def test_catalog_is_saved(self):
+        assert_equal(self._generate(lambda **kwargs: '{}'), '{}')
+        assert_equal(self._generate(lambda **kwargs: 'not built again'), '{}')
+
+    def test_failed_export_is_not_saved(self):
+        # make_json logs the error and gives an empty body
+        assert_equal(self._generate(lambda **kwargs: ''), '""')
+        assert_equal(self._generate(lambda **kwargs: '{}'), '{}')
+
+    def test_invalidate_during_build_discards_catalog(self):
+        def make_json(**kwargs):
+            # a dataset changed while the catalog was built
+            DataJsonPlugin.snapshot.invalidate()
+            return '{}'
+
+        assert_equal(self._generate(make_json), '{}')
+        assert_equal(self._generate(lambda **kwargs: '{"dataset": []}'), '{"dataset": []}')
+
+    def test_snapshot_of_another_version_is_not_served(self):
+        self._generate(lambda **kwargs: '{}')
+        # a change indexed, not committed yet
+        self.catalog_version.return_value = '"v2"'
+        assert_equal(self._generate(lambda **kwargs: '{"dataset": []}'), '{"dataset": []}')
+        assert_equal(self.response.headers['ETag'], '"v2"')
+        assert_equal(self._generate(lambda **kwargs: 'not built again'), '{"dataset": []}')
+
+    def test_invalidate_after_commit(self):
+        self._generate(lambda **kwargs: '{}')
+        plugin = DataJsonPlugin()
+        session = mock.Mock(info={})
+        plugin.after_commit(session)
+        assert_equal(self._generate(lambda **kwargs: 'not built again'), '{}')
+
+        session.info['datajson_catalog_changed'] = True
+        plugin.after_commit(session)
+        assert_equal(session.info, {})
+        assert_equal(self._generate(lambda **kwargs: '{"dataset": []}'), '{"dataset": []}')
+
+    def test_gzipped_snapshot(self):
+        self._generate(lambda **kwargs: '{}')
+        with gzip.GzipFile(fileobj=StringIO.StringIO(self._generate(None, **{'Accept-Encoding': 'gzip'}))) as gz:
+            assert_equal(gz.read(), '{}')
+        assert_equal(self.response.headers['Content-Encoding'], 'gzip')
+        assert_equal(self.response.headers['ETag'], '"v1-gzip"')
+
+        assert_equal(self._generate(None), '{}')
+        assert_equal(self.response.headers['ETag'], '"v1"')
+
+    def test_not_modified(self):
+        self._generate(lambda **kwargs: '{}')
+        for accept_encoding, etag in (('gzip', '"v1-gzip"'), ('identity', '"v1"')):
+            assert_equal(self._generate(None, **{'Accept-Encoding': accept_encoding, 'If-None-Match': etag}), '')
+            assert_equal(self.response.status_int, 304)
+            assert_equal(self.response.headers['ETag'], etag)
@@ -0,0 +1,108 @@
+import StringIO
+import json
+import urllib2
+
+import mock
+from nose.tools import assert_equal
+
+from ckanext.datajson.cache import LRUCache
+from ckanext.datajson.datajsonvalidator import format_errors
+from ckanext.datajson.jsonstream import BudgetReader
+from ckanext.datajson.plugin import DataJsonController, DataJsonPlugin, _iter_body_validation, \
+    _validate_dataset_text
+
+DATASET = {
+    'title': 'Dataset',
+    'description': 'A dataset',
+    'identifier': 'dataset-1',
+    'accessLevel': 'public',
+    'bureauCode': ['015:11'],
+    'programCode': ['015:001'],
+    'keyword': ['test'],
+    'modified': '2020-01-01',
+    'publisher': {'name': 'Agency'},
+    'contactPoint': {'fn': 'Someone', 'hasEmail': 'mailto:someone@example.com'},
+}
+
+
+def _errors(results):
+    errors = []
+    for count, dataset_name, errs, load_error in results:
+        if load_error:
+            errors.append(load_error)
+        if errs:
+            format_errors(errs, errors)
+    return errors
+
+
+class TestValidatorCache(object):
+
+    def setup(self):
+        DataJsonPlugin.validated_datasets = LRUCache(100)
+        DataJsonPlugin.validation_results = LRUCache(10)
+        DataJsonPlugin.validated_catalogs = LRUCache(10)
+        DataJsonPlugin.validator_max_bytes = 100 * 1024 * 1024
+        DataJsonPlugin.validator_max_seconds = 120
+
+    def test_dataset_errors_are_reused(self):
+        text = json.dumps(dict(DATASET, accessLevel='open'))
+        name, errs = _validate_dataset_text(text, 'dataset 1', set())
+        assert_equal(name, '"Dataset"')
+        assert errs
+        assert_equal(len(DataJsonPlugin.validated_datasets), 1)
+        assert_equal(_validate_dataset_text(text, 'dataset 2', set()), (name, errs))
+
+    def test_duplicate_identifiers_are_checked_again(self):
+        text = json.dumps(DATASET)
+        seen = set()
+        assert_equal(_validate_dataset_text(text, 'dataset 1', seen), ('"Dataset"', {}))
+        name, errs = _validate_dataset_text(text, 'dataset 2', seen)
+        assert_equal(_errors([(2, name, errs, None)]), [
+            ('Invalid Required Field Value', ['The dataset identifier "dataset-1" is used more than once. (1 locations)'])])
+        # the cached errors are left as they were
+        assert_equal(_validate_dataset_text(text, 'dataset 1', set()), ('"Dataset"', {}))
+
+    def test_datasets_without_title_are_not_cached(self):
+        text = json.dumps(dict((k, v) for k, v in DATASET.iteritems() if k != 'title'))
+        assert_equal(_validate_dataset_text(text, 'dataset 1', set())[0], 'dataset 1')
+        assert_equal(_validate_dataset_text(text, 'dataset 2', set())[0], 'dataset 2')
+        assert_equal(len(DataJsonPlugin.validated_datasets), 0)
+
+    def test_body_validation(self):
+        body = json.dumps({'dataset': [DATASET, DATASET, 1]})
+        results = list(_iter_body_validation(BudgetReader(StringIO.StringIO(body))))
+        assert_equal([result[0] for result in results], [1, 2, 3])
+        assert_equal(_errors(results), [
+            ('Invalid Required Field Value', ['The dataset identifier "dataset-1" is used more than once. (1 locations)']),
+            ('Invalid Required Field Value', ['Each dataset must be a JSON object. (1 locations)'])])
+
+        for body, heading in (('{"dataset": []}', 'Catalog Is Empty'), ('{"dataset": [{]}', 'Invalid JSON')):
+            results = list(_iter_body_validation(BudgetReader(StringIO.StringIO(body))))
+            assert_equal(_errors(results)[0][0], heading)
+
+    def _remote(self, body, etag='"v1"'):
+        remote = StringIO.StringIO(body)
+        remote.info = lambda: mock.Mock(**{'getheader.side_effect': {'ETag': etag}.get})
+        return remote
+
+    def test_results_are_sent_while_downloading(self):
+        body = json.dumps({'dataset': [dict(DATASET, accessLevel='open')] + [DATASET] * 5000})
+        remote = self._remote(body)
+        with mock.patch('urllib2.urlopen', return_value=remote):
+            lines = DataJsonController._iter_validation_lines('http://example.com/data.json')
+            assert_equal(json.loads(next(lines))['dataset'], 1)
+            assert remote.tell() < len(body)
+            lines.close()
+
+    def test_unchanged_catalog_is_not_downloaded_again(self):
+        body = json.dumps({'dataset': [dict(DATASET, accessLevel='open')]})
+        with mock.patch('urllib2.urlopen', return_value=self._remote(body)):
+            lines = list(DataJsonController._iter_validation_lines('http://example.com/data.json'))
+        assert_equal(len(lines), 2)
+
+        not_modified = urllib2.HTTPError('http://example.com/data.json', 304, 'Not Modified', {}, None)
+        with mock.patch('urllib2.urlopen', side_effect=not_modified) as urlopen, \
+                mock.patch('ckanext.datajson.plugin._validate_dataset_text') as validate:
+            assert_equal(list(DataJsonController._iter_validation_lines('http://example.com/data.json')), lines)
+        assert_equal(urlopen.call_args[0][0].get_header('If-none-match'), '"v1"')
+        assert not validate.called